@@ -18,8 +18,6 @@ import logging
 import traceback
 import zipfile
 import time
-import random
-import requests
 import threading
 import re
 from decimal import Decimal, ROUND_DOWN
@@ -27,6 +25,7 @@ from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple, Any
 from pymongo import MongoClient
 from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
+from telegram.error import BadRequest
 from telegram.ext import Updater, CommandHandler, CallbackQueryHandler, MessageHandler, Filters, CallbackContext
 from bson import ObjectId
 from html import escape as html_escape
@@ -42,6 +41,21 @@ except Exception as _qr_import_err:
     Image = None
     print(f"⚠️ 二维码依赖未就绪(qrcode/Pillow)，将回退纯文本: {_qr_import_err}")
 
+# ================= 共享数据层（仓库根目录，与总部 mongo.py 共用） =================
+_REPO_ROOT = Path(__file__).resolve().parent.parent
+if str(_REPO_ROOT) not in sys.path:
+    sys.path.insert(0, str(_REPO_ROOT))
+from mongo_shared import (
+    apply_stock_delta, stock_snapshot, claim_stock_items, release_stock_items, CatalogCache,
+    debit_balance, credit_balance, allocate_count_id
+)
+from db_indexes import ensure_dynamic_indexes, reconcile_index_manifest, AGENT_INDEX_MANIFEST
+from delivery_archive import build_archive_parts, item_entries, part_filename, ArchiveTooLarge
+from pack_store import has_pack
+from tron_client import TronClient, DEFAULT_TRONSCAN_BASES
+from chain_watch import register_watch_address, find_transfers, MICRO
+from amount_slots import AmountSlots
+
 # ================= 环境变量加载（支持 --env / ENV_FILE / 默认 .env） =================
 def _resolve_env_file(argv: list) -> Path:
     env_file_cli = None
@@ -129,7 +143,19 @@ class AgentBotConfig:
         self.TRON_API_KEYS = [k.strip() for k in os.getenv("TRON_API_KEYS", "").split(",") if k.strip()]
         self.TRONGRID_API_BASE = os.getenv("TRONGRID_API_BASE", "https://api.trongrid.io").rstrip("/")
         self.TRON_API_KEY_HEADER = os.getenv("TRON_API_KEY_HEADER", "TRON-PRO-API-KEY")
-        self._tron_key_index = 0
+        # ✅ 连接池 + 每个密钥限速 / 429 冷却 / 端点熔断 / 相同请求合并
+        self.tron = TronClient(
+            self.USDT_TRON_CONTRACT,
+            trongrid_base=self.TRONGRID_API_BASE,
+            tronscan_bases=(self.TRONSCAN_TRX20_API,) + DEFAULT_TRONSCAN_BASES,
+            api_keys=self.TRON_API_KEYS,
+            key_header=self.TRON_API_KEY_HEADER,
+            key_rate=float(os.getenv("TRON_API_KEY_RATE", "10")),
+            cooldown=float(os.getenv("TRON_API_COOLDOWN_SECONDS", "30")),
+        )
+        # ✅ 共享链上监听（chain_watch.py）：开启后只查本地 chain_transfers，不再请求 TronGrid
+        self.CHAIN_WATCHER_ENABLED = os.getenv("CHAIN_WATCHER_ENABLED", "0") in ("1", "true", "True")
+        self.CHAIN_DB_NAME = os.getenv("CHAIN_DB_NAME", "qukuailian")
 
         # ✅ 代理自己的通知群
         self.AGENT_NOTIFY_CHAT_ID = os.getenv("AGENT_NOTIFY_CHAT_ID")
@@ -215,6 +241,21 @@ class AgentBotConfig:
             self.agent_profit_account = self.db['agent_profit_account']
             self.withdrawal_requests = self.db['withdrawal_requests']
             self.recharge_orders = self.db['recharge_orders']
+            self.recharge_cursors = self.db['recharge_cursors']  # ✅ 每个收款地址已处理到的链上位置
+            # ✅ 充值识别码位图：每个 (收款地址, 基础金额) 一个文档，识别码 1 ~ 9999
+            self.amount_slots = AmountSlots(self.db['amount_slots'], 10 ** self.RECHARGE_DECIMALS - 1)
+            self.stock_counters = self.db['stock_counters']  # ✅ 总部维护的库存计数器
+            self.balance_ledger = self.db['balance_ledger']  # ✅ 与总部共用的余额流水
+            self.counters = self.db['counters']  # ✅ 与总部共用的编号计数器
+            # ✅ 总部商品目录缓存（总部修改目录时通过 change stream / 版本号失效）
+            self.catalog = CatalogCache(self.fenlei, self.ejfl, self.db['catalog_meta'])
+            reconcile_index_manifest({'agent': self.db}, AGENT_INDEX_MANIFEST)
+
+            chain_db = self.client[self.CHAIN_DB_NAME]
+            self.chain_transfers = chain_db['chain_transfers']
+            if self.CHAIN_WATCHER_ENABLED:
+                register_watch_address(chain_db['watch_addresses'], self.AGENT_USDT_ADDRESS, self.AGENT_BOT_ID)
+                logger.info(f"✅ 收款地址已登记到链上监听：{self.AGENT_USDT_ADDRESS}")
         except Exception as e:
             logger.error(f"❌ 数据库连接失败: {e}")
             raise
@@ -228,19 +269,12 @@ class AgentBotConfig:
 
     def get_agent_user_collection(self):
         suffix = self.AGENT_BOT_ID[6:] if self.AGENT_BOT_ID.startswith('agent_') else self.AGENT_BOT_ID
-        return self.db[f'agent_users_{suffix}']
+        return ensure_dynamic_indexes(self.db[f'agent_users_{suffix}'])
 
     def get_agent_gmjlu_collection(self):
         suffix = self.AGENT_BOT_ID[6:] if self.AGENT_BOT_ID.startswith('agent_') else self.AGENT_BOT_ID
-        return self.db[f'agent_gmjlu_{suffix}']
+        return ensure_dynamic_indexes(self.db[f'agent_gmjlu_{suffix}'])
 
-    def _next_tron_api_key(self) -> Optional[str]:
-        if not self.TRON_API_KEYS:
-            return None
-        key = self.TRON_API_KEYS[self._tron_key_index % len(self.TRON_API_KEYS)]
-        self._tron_key_index = (self._tron_key_index + 1) % max(len(self.TRON_API_KEYS), 1)
-        return key
-    
     def _load_admins_from_env(self):
         """从环境变量 ADMIN_USERS 加载管理员用户ID列表"""
         env_admins = os.getenv("ADMIN_USERS", "").strip()
@@ -513,8 +547,7 @@ class AgentBotCore:
             if exist:
                 coll.update_one({'user_id': user_id}, {'$set': {'last_active': now}})
                 return True
-            max_user = coll.find_one({}, sort=[("count_id", -1)])
-            count_id = (max_user.get('count_id', 0) + 1) if max_user else 1
+            count_id = allocate_count_id(self.config.counters, coll)
             coll.insert_one({
                 'user_id': user_id,
                 'count_id': count_id,
@@ -677,7 +710,7 @@ class AgentBotCore:
                         continue
                     
                     # 获取总部商品信息
-                    hq_product = self.config.ejfl.find_one({'nowuid': nowuid})
+                    hq_product = self.config.catalog.product(nowuid)
                     if not hq_product:
                         continue
                     
@@ -810,10 +843,7 @@ class AgentBotCore:
                     category_stock = {}
                     for cat_name, nowuid_set in category_products.items():
                         if nowuid_set:
-                            stock = self.config.hb.count_documents({
-                                'nowuid': {'$in': list(nowuid_set)},
-                                'state': 0
-                            })
+                            stock = self.sum_product_stock(nowuid_set)
                             category_stock[cat_name] = stock
                         else:
                             category_stock[cat_name] = 0
@@ -967,10 +997,7 @@ class AgentBotCore:
                 nowuid_set = cat_data['nowuids']
                 if nowuid_set:
                     # 统计这些 nowuid 在 hb 表中 state=0 的数量
-                    stock = self.config.hb.count_documents({
-                        'nowuid': {'$in': list(nowuid_set)},
-                        'state': 0
-                    })
+                    stock = self.sum_product_stock(nowuid_set)
                     cat_data['stock'] = stock
                 else:
                     cat_data['stock'] = 0
@@ -1029,10 +1056,7 @@ class AgentBotCore:
                 
                 fallback_result = []
                 for cat_name, nowuid_set in fallback_map.items():
-                    stock = self.config.hb.count_documents({
-                        'nowuid': {'$in': list(nowuid_set)},
-                        'state': 0
-                    })
+                    stock = self.sum_product_stock(nowuid_set)
                     if stock > 0 or self.config.AGENT_SHOW_EMPTY_CATEGORIES:
                         fallback_result.append({
                             '_id': cat_name,
@@ -1118,7 +1142,17 @@ class AgentBotCore:
 
     def get_product_stock(self, nowuid: str) -> int:
         try:
-            return self.config.hb.count_documents({'nowuid': nowuid, 'state': 0})
+            snapshot = stock_snapshot(self.config.stock_counters, nowuids=[nowuid])
+            return snapshot['products'][nowuid]['available']
+        except Exception as e:
+            logger.error(f"❌ 获取库存失败: {e}")
+            return 0
+
+    def sum_product_stock(self, nowuids) -> int:
+        """多个商品的可售库存合计（一次读取库存计数器）"""
+        try:
+            snapshot = stock_snapshot(self.config.stock_counters, nowuids=list(nowuids))
+            return sum(v['available'] for v in snapshot['products'].values())
         except Exception as e:
             logger.error(f"❌ 获取库存失败: {e}")
             return 0
@@ -1126,7 +1160,7 @@ class AgentBotCore:
     def get_product_price(self, nowuid: str) -> Optional[float]:
         try:
             # 获取商品的总部价格（实时）
-            origin = self.config.ejfl.find_one({'nowuid': nowuid})
+            origin = self.config.catalog.product(nowuid)
             if not origin:
                 return None
             original_price = float(origin.get('money', 0.0))
@@ -1180,7 +1214,7 @@ class AgentBotCore:
 
     def update_agent_price(self, product_nowuid: str, new_agent_price: float) -> Tuple[bool, str]:
         try:
-            origin = self.config.ejfl.find_one({'nowuid': product_nowuid})
+            origin = self.config.catalog.product(product_nowuid)
             if not origin:
                 return False, "原始商品不存在"
             
@@ -1352,9 +1386,6 @@ class AgentBotCore:
             return False, "系统异常"
 
     # ---------- 充值创建 ----------
-    def _gen_unique_suffix(self, digits: int = 4) -> int:
-        return random.randint(1, 10**digits - 1)
-
     def _compose_expected_amount(self, base_amount: Decimal, suffix: int) -> Decimal:
         suffix_dec = Decimal(suffix) / Decimal(10**4)
         expected = (base_amount.quantize(Decimal("0.01")) + suffix_dec).quantize(Decimal("0.0001"), rounding=ROUND_DOWN)
@@ -1367,19 +1398,10 @@ class AgentBotCore:
             if base_amount < self.config.RECHARGE_MIN_USDT:
                 return False, f"最低充值金额为 {self.config.RECHARGE_MIN_USDT} USDT", None
 
-            for _ in range(5):
-                code = self._gen_unique_suffix()
-                expected_amount = self._compose_expected_amount(base_amount, code)
-                exists = self.config.recharge_orders.find_one({
-                    'agent_bot_id': self.config.AGENT_BOT_ID,
-                    'status': {'$in': ['pending', 'created']},
-                    'expected_amount': float(expected_amount),
-                    'address': self.config.AGENT_USDT_ADDRESS
-                })
-                if not exists:
-                    break
-            else:
+            allocated = self._allocate_recharge_code(base_amount)
+            if allocated is None:
                 return False, "系统繁忙，请稍后重试", None
+            amount_slot, code, expected_amount = allocated
 
             now = datetime.utcnow()
             expire_at = now + timedelta(minutes=self.config.RECHARGE_EXPIRE_MINUTES)
@@ -1392,6 +1414,7 @@ class AgentBotCore:
                 'base_amount': float(base_amount),
                 'expected_amount': float(expected_amount),
                 'unique_code': code,
+                'amount_slot': amount_slot,
                 'status': 'pending',
                 'created_time': now,
                 'expire_time': expire_at,
@@ -1400,13 +1423,52 @@ class AgentBotCore:
                 'from_address': None,
                 'confirmations': 0
             }
-            ins = self.config.recharge_orders.insert_one(order)
+            try:
+                ins = self.config.recharge_orders.insert_one(order)
+            except Exception:
+                self.config.amount_slots.release_order(order)
+                raise
             order['_id'] = ins.inserted_id
             return True, "创建成功", order
         except Exception as e:
             logger.error(f"❌ 创建充值订单失败: {e}")
             return False, "系统异常，请稍后再试", None
 
+    def _allocate_recharge_code(self, base_amount: Decimal):
+        """
+        从 (收款地址, 基础金额) 的位图中分配识别码
+
+        识别码只在同一基础金额内互斥；合计金额与其他基础金额的待支付订单相同时（如 10.00+0.5001 与 10.50+0.0001）
+        暂时占住该识别码换一个，最后统一释放。
+
+        Returns:
+            (amount_slot, code, expected_amount)；识别码用完时返回 None
+        """
+        address = self.config.AGENT_USDT_ADDRESS
+        key = f"{address}:{base_amount.quantize(Decimal('0.01'))}"
+        slots = self.config.amount_slots
+        held = []
+        try:
+            while True:
+                slot = slots.acquire(key, reclaim=lambda: {o['amount_slot']['slot'] for o in self.config.recharge_orders.find(
+                    {'status': 'pending', 'amount_slot.key': key}, {'amount_slot': 1})})
+                if slot is None:
+                    logger.error(f"❌ 充值识别码已用完：{key}")
+                    return None
+                code = slot + 1
+                expected_amount = self._compose_expected_amount(base_amount, code)
+                if self.config.recharge_orders.find_one({
+                    'address': address,
+                    'expected_amount': float(expected_amount),
+                    'status': {'$in': ['pending', 'created']},
+                }, {'_id': 1}):
+                    held.append(slot)
+                    continue
+                return {'key': key, 'slot': slot}, code, expected_amount
+        finally:
+            for slot in held:
+                slots.release(key, slot)
+
     # ---------- 纯二维码 + caption ----------
     def _build_plain_qr(self, order: Dict) -> Optional[BytesIO]:
         """生成仅包含地址的二维码"""
@@ -1486,105 +1548,14 @@ class AgentBotCore:
             self._send_recharge_text_fallback(chat_id, order, reply_markup)
 
     # ---------- Tron 交易抓取与解析 ----------
-    def _fetch_tronscan_transfers(self, to_address: str, limit: int = 50) -> List[Dict]:
-        try:
-            bases = [
-                self.config.TRONSCAN_TRX20_API,
-                "https://apilist.tronscanapi.com/api/token_trc20/transfers",
-                "https://apilist.tronscan.org/api/token_trc20/transfers",
-            ]
-            tried = set()
-            for base in bases:
-                if not base or base in tried:
-                    continue
-                tried.add(base)
-                params = {
-                    "toAddress": to_address,
-                    "contract": self.config.USDT_TRON_CONTRACT,
-                    "contract_address": self.config.USDT_TRON_CONTRACT,
-                    "limit": min(int(limit), 200),
-                    "sort": "-timestamp",
-                }
-                try:
-                    r = requests.get(base, params=params, timeout=10)
-                    if r.status_code != 200:
-                        logger.warning(f"TronScan API 非 200: {r.status_code} url={base}")
-                        continue
-                    data = r.json() or {}
-                    items = data.get("token_transfers") or data.get("data") or []
-                    return items
-                except Exception as ie:
-                    logger.warning(f"TronScan 调用异常 url={base}: {ie}")
-                    continue
-            return []
-        except Exception as e:
-            logger.warning(f"TronScan API 调用失败: {e}")
-            return []
+    def _fetch_tronscan_transfers(self, to_address: str, limit: int = 50, since_ms: Optional[int] = None) -> List[Dict]:
+        return self.config.tron.tronscan_transfers(to_address, limit, since_ms) or []
 
-    def _fetch_trongrid_trc20_transfers(self, to_address: str, limit: int = 50) -> List[Dict]:
-        try:
-            base = self.config.TRONGRID_API_BASE
-            url = f"{base}/v1/accounts/{to_address}/transactions/trc20"
-            params = {
-                "limit": min(int(limit), 200),
-                "contract_address": self.config.USDT_TRON_CONTRACT
-            }
-            attempts = max(len(self.config.TRON_API_KEYS), 1)
-            last_err = None
-            for _ in range(attempts):
-                headers = {}
-                api_key = self.config._next_tron_api_key()
-                if api_key:
-                    headers[self.config.TRON_API_KEY_HEADER] = api_key
-                try:
-                    r = requests.get(url, params=params, headers=headers, timeout=10)
-                    if r.status_code != 200:
-                        last_err = f"HTTP {r.status_code}"
-                        if r.status_code in (429, 500, 502, 503, 504):
-                            continue
-                        return []
-                    data = r.json() or {}
-                    items = data.get("data") or []
-                    norm = []
-                    for it in items:
-                        to_addr = (it.get("to") or "").lower()
-                        if to_addr != to_address.lower():
-                            continue
-                        token_info = it.get("token_info") or {}
-                        dec = int(token_info.get("decimals") or 6)
-                        raw_val = it.get("value")
-                        amount_str = None
-                        if raw_val is not None:
-                            try:
-                                amount_str = (Decimal(str(raw_val)) / Decimal(10 ** dec)).quantize(Decimal("0.0001"))
-                            except Exception:
-                                amount_str = None
-                        norm.append({
-                            "to_address": it.get("to"),
-                            "from_address": it.get("from"),
-                            "amount_str": str(amount_str) if amount_str is not None else None,
-                            "block_ts": it.get("block_timestamp"),
-                            "transaction_id": it.get("transaction_id"),
-                            "tokenInfo": {"tokenDecimal": dec}
-                        })
-                    return norm
-                except Exception as e:
-                    last_err = str(e)
-                    continue
-            if last_err:
-                logger.warning(f"TronGrid 查询失败（已轮换密钥）：{last_err}")
-            return []
-        except Exception as e:
-            logger.warning(f"TronGrid API 异常: {e}")
-            return []
+    def _fetch_trongrid_trc20_transfers(self, to_address: str, limit: int = 50, since_ms: Optional[int] = None) -> List[Dict]:
+        return self.config.tron.trc20_transfers(to_address, limit, since_ms) or []
 
-    def _fetch_token_transfers(self, to_address: str, limit: int = 50) -> List[Dict]:
-        items = []
-        if getattr(self.config, "TRON_API_KEYS", None):
-            items = self._fetch_trongrid_trc20_transfers(to_address, limit)
-        if not items:
-            items = self._fetch_tronscan_transfers(to_address, limit)
-        return items
+    def _fetch_token_transfers(self, to_address: str, limit: int = 50, since_ms: Optional[int] = None) -> List[Dict]:
+        return self.config.tron.token_transfers(to_address, limit, since_ms)
 
     def _parse_amount(self, it) -> Optional[Decimal]:
         try:
@@ -1608,44 +1579,93 @@ class AgentBotCore:
             return None
 
     # ---------- 充值校验 / 入账 / 轮询 ----------
+    def _normalize_transfer(self, it, address: str) -> Optional[Dict]:
+        """统一 TronGrid / TronScan 的转账字段；不是转入 address 的返回 None"""
+        to_addr = (it.get('to_address') or it.get('to') or it.get('transferToAddress') or '').lower()
+        if to_addr != address.lower():
+            return None
+        ts_ms = it.get('block_ts') or it.get('timestamp') or 0
+        return {
+            'amount': self._parse_amount(it),
+            'ts_ms': int(ts_ms) if ts_ms else 0,
+            'tx_time': datetime.utcfromtimestamp(int(ts_ms) / 1000) if ts_ms else None,
+            'tx_id': it.get('transaction_id') or it.get('hash') or it.get('txHash') or '',
+            'from_address': it.get('from_address') or it.get('from') or '',
+        }
+
+    def _index_transfers_by_amount(self, transfers: List[Dict], address: str) -> Dict[Decimal, List[Dict]]:
+        """按精确金额（4 位小数）索引转账"""
+        index: Dict[Decimal, List[Dict]] = {}
+        for it in transfers:
+            tr = self._normalize_transfer(it, address)
+            if tr and tr['amount'] is not None and tr['tx_time']:
+                index.setdefault(tr['amount'], []).append(tr)
+        return index
+
+    def _match_order(self, order: Dict, index: Dict[Decimal, List[Dict]], used: set) -> Optional[Dict]:
+        expected = Decimal(str(order['expected_amount'])).quantize(Decimal("0.0001"))
+        earliest = order['created_time'] - timedelta(minutes=5)
+        for tr in index.get(expected, []):
+            if tr['tx_time'] >= earliest and tr['tx_id'] not in used:
+                return tr
+        return None
+
+    def _settle_matches(self, orders: List[Dict], index: Dict[Decimal, List[Dict]],
+                        unsettled: Optional[set] = None) -> int:
+        """
+        在内存中为订单匹配转账并入账；已经入账过的交易不会重复使用，返回入账笔数
+
+        Args:
+            unsettled: 可选，收集匹配到订单但入账失败、订单仍是 pending 的交易 tx_id（下一轮需要重试）
+        """
+        matches = []
+        used = set()
+        for od in orders:
+            tr = self._match_order(od, index, used)
+            if tr:
+                used.add(tr['tx_id'])
+                matches.append((od, tr))
+        if not matches:
+            return 0
+        settled_tx = {d['tx_id'] for d in self.config.recharge_orders.find(
+            {'tx_id': {'$in': [tr['tx_id'] for _, tr in matches]}}, {'tx_id': 1})}
+        count = 0
+        for od, tr in matches:
+            if tr['tx_id'] in settled_tx:
+                continue
+            if self._settle_recharge(od, tr['tx_id'], tr['from_address'], tr['tx_time']):
+                count += 1
+                logger.info(f"充值自动入账成功 order={od.get('_id')}")
+            elif unsettled is not None and self.config.recharge_orders.find_one(
+                    {'_id': od['_id'], 'status': 'pending'}, {'_id': 1}):
+                unsettled.add(tr['tx_id'])
+        return count
+
     def verify_recharge_order(self, order: Dict) -> Tuple[bool, str]:
         try:
             if order.get('status') != 'pending':
                 return False, "订单状态不可校验"
             if datetime.utcnow() > order.get('expire_time', datetime.utcnow()):
-                self.config.recharge_orders.update_one({'_id': order['_id']}, {'$set': {'status': 'expired'}})
+                res = self.config.recharge_orders.update_one({'_id': order['_id'], 'status': 'pending'},
+                                                             {'$set': {'status': 'expired'}})
+                if res.modified_count:
+                    self.config.amount_slots.release_order(order)
                 return False, "订单已过期"
 
-            expected = Decimal(str(order['expected_amount'])).quantize(Decimal("0.0001"))
             address = order['address']
             transfers = self._fetch_token_transfers(address, limit=100)
             if not transfers:
                 return False, "未查询到转账记录"
-
-            created_ts = order['created_time']
-            for it in transfers:
-                to_addr = (it.get('to_address') or it.get('to') or it.get('transferToAddress') or '').lower()
-                amt = self._parse_amount(it)
-                ts_ms = it.get('block_ts') or it.get('timestamp') or 0
-                tx_time = datetime.utcfromtimestamp(int(ts_ms) / 1000) if ts_ms else None
-                if to_addr != address.lower():
-                    continue
-                if amt is None or amt != expected:
-                    continue
-                if not tx_time or tx_time < created_ts - timedelta(minutes=5):
-                    continue
-                tx_id = it.get('transaction_id') or it.get('hash') or it.get('txHash') or ''
-                from_addr = it.get('from_address') or it.get('from') or ''
-                self._settle_recharge(order, tx_id, from_addr, tx_time)
+            if self._settle_matches([order], self._index_transfers_by_amount(transfers, address)):
                 return True, "充值成功自动入账"
             return False, "暂未匹配到您的转账"
         except Exception as e:
             logger.error(f"❌ 校验充值失败: {e}")
             return False, "校验异常，请稍后重试"
 
-    def _settle_recharge(self, order: Dict, tx_id: str, from_addr: str, paid_time: datetime):
+    def _settle_recharge(self, order: Dict, tx_id: str, from_addr: str, paid_time: datetime) -> bool:
         try:
-            self.config.recharge_orders.update_one(
+            res = self.config.recharge_orders.update_one(
                 {'_id': order['_id'], 'status': 'pending'},
                 {'$set': {
                     'status': 'paid',
@@ -1654,16 +1674,16 @@ class AgentBotCore:
                     'paid_time': paid_time
                 }}
             )
+            if res.modified_count == 0:
+                # 订单已被其他任务入账 / 取消 / 过期
+                return False
+            self.config.amount_slots.release_order(order)
             amt = float(order['base_amount'])
-            self.config.get_agent_user_collection().update_one(
-                {'user_id': order['user_id']},
-                {'$inc': {'USDT': amt},
-                 '$set': {'last_active': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}}
-            )
-            user_doc = self.config.get_agent_user_collection().find_one(
-                {'user_id': order['user_id']}, {'USDT': 1}
-            )
-            new_balance = float(user_doc.get('USDT', 0.0)) if user_doc else 0.0
+            new_balance = credit_balance(
+                self.config.get_agent_user_collection(), order['user_id'], amt,
+                set_fields={'last_active': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
+                ledger=self.config.balance_ledger, reason='USDT充值', ref=tx_id
+            ) or 0.0
 
             # 用户通知
             try:
@@ -1707,25 +1727,123 @@ class AgentBotCore:
                     )
                 except Exception as ne:
                     logger.warning(f"总部通知发送失败: {ne}")
+            return True
         except Exception as e:
             logger.error(f"❌ 入账失败: {e}")
+            return False
+
+    def _cursor_id(self, address: str) -> str:
+        return f"{self.config.AGENT_BOT_ID}:{address}"
+
+    def _fetch_new_transfers(self, address: str, since_ms: int, limit: int = 200) -> List[Dict]:
+        """
+        从游标开始增量拉取转入 address 的转账（每个地址每轮一次请求）
+
+        游标 {block_ts, tx_ids} 记录已处理到的区块时间和该时间上的交易：
+        请求从 block_ts（含）开始按时间正序，同一时间上已处理过的交易跳过。
+        本函数不推进游标，匹配入账后由 _advance_cursor 推进。
+        """
+        cursor = self.config.recharge_cursors.find_one({'_id': self._cursor_id(address)}) or {}
+        cursor_ts = int(cursor.get('block_ts') or 0)
+        seen = set(cursor.get('tx_ids') or [])
+        start_ms = max(cursor_ts, since_ms)
+        items = self._fetch_token_transfers(address, limit=limit, since_ms=start_ms)
+
+        fresh = []
+        for it in items:
+            tr = self._normalize_transfer(it, address)
+            if not tr or tr['ts_ms'] < start_ms:
+                continue
+            if tr['ts_ms'] == cursor_ts and tr['tx_id'] in seen:
+                continue
+            fresh.append(it)
+        return fresh
+
+    def _advance_cursor(self, address: str, items: List[Dict], unsettled: set):
+        """
+        游标只推进到第一笔未入账成功的转账之前（按时间正序）
 
-    def poll_and_auto_settle_recharges(self, max_orders: int = 80):
+        已入账、或匹配不到任何待支付订单的转账视为已处理；匹配到订单但入账失败的转账
+        及其之后的转账下一轮重新拉取（已入账的交易由 tx_id 去重，不会重复入账）。
+        """
+        cursor = self.config.recharge_cursors.find_one({'_id': self._cursor_id(address)}) or {}
+        max_ts = int(cursor.get('block_ts') or 0)
+        max_ids = set(cursor.get('tx_ids') or [])
+        moved = False
+        transfers = [tr for tr in (self._normalize_transfer(it, address) for it in items) if tr]
+        for tr in sorted(transfers, key=lambda t: t['ts_ms']):
+            if tr['tx_id'] in unsettled:
+                break
+            if tr['ts_ms'] > max_ts:
+                max_ts, max_ids = tr['ts_ms'], {tr['tx_id']}
+            elif tr['ts_ms'] == max_ts:
+                max_ids.add(tr['tx_id'])
+            moved = True
+        if moved:
+            self.config.recharge_cursors.update_one(
+                {'_id': self._cursor_id(address)},
+                {'$set': {'block_ts': max_ts, 'tx_ids': sorted(max_ids), 'updated_at': datetime.utcnow()}},
+                upsert=True
+            )
+
+    def _live_orders_for(self, live_q: Dict, address: str, amounts) -> List[Dict]:
+        """该地址上金额在 amounts 中的全部待支付订单（address + expected_amount + status 索引，不限条数）"""
+        return list(self.config.recharge_orders.find(
+            dict(live_q, address=address, expected_amount={'$in': [float(a) for a in amounts]})
+        ).sort('created_time', 1))
+
+    def poll_and_auto_settle_recharges(self):
+        """
+        每轮每个收款地址只请求一次链上数据，按金额索引后在内存中匹配所有待支付订单
+
+        先拉取转账再查询订单：用户看到金额后才会付款，拉取到的转账对应的订单一定已经写入。
+        订单按转账金额查询，不限条数；游标只越过已入账或确定没有对应订单的转账。
+        """
         try:
             now = datetime.utcnow()
-            q = {
-                'agent_bot_id': self.config.AGENT_BOT_ID,
-                'status': 'pending',
-                'expire_time': {'$gte': now}
-            }
-            orders = list(self.config.recharge_orders.find(q).sort('created_time', -1).limit(max_orders))
-            for od in orders:
-                ok, _ = self.verify_recharge_order(od)
-                if ok:
-                    logger.info(f"充值自动入账成功 order={od.get('_id')}")
+            base_q = {'agent_bot_id': self.config.AGENT_BOT_ID, 'status': 'pending'}
+            for od in self.config.recharge_orders.find(dict(base_q, expire_time={'$lt': now}), {'amount_slot': 1}):
+                res = self.config.recharge_orders.update_one({'_id': od['_id'], 'status': 'pending'},
+                                                             {'$set': {'status': 'expired'}})
+                if res.modified_count:
+                    self.config.amount_slots.release_order(od)
+
+            live_q = dict(base_q, expire_time={'$gte': now})
+            oldest = self.config.recharge_orders.find_one(live_q, {'created_time': 1}, sort=[('created_time', 1)])
+            if not oldest:
+                return
+            # 只需要最早的待支付订单创建前 5 分钟之后的转账
+            since_ms = int((oldest['created_time'] - timedelta(minutes=5) - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+            if self.config.CHAIN_WATCHER_ENABLED:
+                self._settle_from_chain_watch(live_q, since_ms)
+                return
+
+            for address in self.config.recharge_orders.distinct('address', live_q):
+                try:
+                    items = self._fetch_new_transfers(address, since_ms)
+                    if not items:
+                        continue
+                    index = self._index_transfers_by_amount(items, address)
+                    unsettled = set()
+                    if index:
+                        self._settle_matches(self._live_orders_for(live_q, address, index), index, unsettled)
+                    self._advance_cursor(address, items, unsettled)
+                except Exception as e:
+                    logger.warning(f"自动轮询充值异常: {address} {e}")
         except Exception as e:
             logger.warning(f"自动轮询充值异常: {e}")
 
+    def _settle_from_chain_watch(self, live_q: Dict, since_ms: int):
+        """从共享监听写入的 chain_transfers 匹配订单：每个地址一次按金额 $in 的索引查询，无外网请求"""
+        for address in self.config.recharge_orders.distinct('address', live_q):
+            amounts = {int(Decimal(str(od['expected_amount'])) * MICRO)
+                       for od in self.config.recharge_orders.find(dict(live_q, address=address), {'expected_amount': 1})}
+            items = find_transfers(self.config.chain_transfers, address, amounts, since_ms)
+            if items:
+                index = self._index_transfers_by_amount(items, address)
+                self._settle_matches(self._live_orders_for(live_q, address, index), index)
+
     def list_recharges(self, user_id: int, limit: int = 10, include_canceled: bool = False) -> List[Dict]:
         try:
             q = {'agent_bot_id': self.config.AGENT_BOT_ID, 'user_id': user_id}
@@ -1737,88 +1855,104 @@ class AgentBotCore:
             return []
 
     def send_batch_files_to_user(self, user_id: int, items: List[Dict], product_name: str, order_id: str = "") -> int:
+        """打包并发送，返回发送的分卷数"""
+        return len(self.send_archive_to_user(user_id, items, product_name, order_id))
+
+    def resend_file_ids(self, user_id: int, file_ids: List[str]) -> int:
+        """按 file_id 重发已发送过的文件包（不重新上传），返回重发成功的分卷数；file_id 被 Telegram 拒绝时停在该分卷"""
+        bot = Bot(self.config.BOT_TOKEN)
+        resent = 0
+        try:
+            for file_id in file_ids:
+                bot.send_document(chat_id=user_id, document=file_id)
+                resent += 1
+        except BadRequest as e:
+            logger.warning(f"第 {resent + 1} 个 file_id 已失效，需要重新打包: {e}")
+        return resent
+
+    def send_archive_to_user(self, user_id: int, items: List[Dict], product_name: str, order_id: str = "",
+                             resume_file_ids: Optional[List[str]] = None, part_count: int = 0) -> List[str]:
+        """
+        在内存中按上架清单打包并发送，超过 50MB 自动分卷，返回全部分卷的 file_id 列表
+
+        resume_file_ids 为重发时已成功发送的前几个分卷：重新打包的分卷数等于 part_count 时只补发之后的分卷
+        """
         logger.info(f"开始打包发送: {product_name} items={len(items)}")
         try:
             if not items:
-                return 0
+                return []
             bot = Bot(self.config.BOT_TOKEN)
             first = items[0]
             item_type = first.get('leixing', '')
             nowuid = first.get('nowuid', '')
             if item_type == '协议号':
                 base_dir = f"{self.config.FILE_BASE_PATH}/协议号/{nowuid}"
+            elif first.get('files') is not None:
+                # 上架清单是相对总部 号包/{nowuid} 目录记录的
+                base_dir = f"{self.config.FILE_BASE_PATH}/号包/{nowuid}"
             else:
                 base_dir = f"{self.config.FILE_BASE_PATH}/{item_type}/{nowuid}"
-            if not os.path.exists(base_dir):
-                return 0
-            delivery_dir = f"{self.config.FILE_BASE_PATH}/协议号发货"
-            os.makedirs(delivery_dir, exist_ok=True)
-            
+            if not os.path.exists(base_dir) and not has_pack(base_dir):
+                return []
+
             # ✅ 改成：日期_用户ID_订单号后4位.zip
             from datetime import datetime
             date_str = datetime.now().strftime("%Y%m%d")
             short_order_id = order_id[-4:] if order_id else "0000"
-            zip_filename = f"{date_str}_{user_id}_{short_order_id}.zip"
-            zip_path = f"{delivery_dir}/{zip_filename}"
-            
-            files_added = 0
+            archive_name = f"{date_str}_{user_id}_{short_order_id}"
+
+            if item_type == '协议号' or first.get('files') is not None:
+                entries = item_entries(base_dir, items, item_type)
+            else:
+                # 没有上架清单的旧商品：沿用原来整个目录打包的方式
+                entries = []
+                for idx, _ in enumerate(items, 1):
+                    for fn in os.listdir(base_dir):
+                        fp = os.path.join(base_dir, fn)
+                        if os.path.isfile(fp):
+                            entries.append((fp, f"{idx:02d}_{fn}"))
+            if item_type == '协议号' and os.path.isdir(base_dir):
+                for fn in os.listdir(base_dir):
+                    if fn.lower().endswith(('.txt', '.md')) and len(entries) < 500:
+                        fp = os.path.join(base_dir, fn)
+                        if os.path.isfile(fp):
+                            entries.append((fp, fn))
+
             try:
-                with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
-                    if item_type == '协议号':
-                        for it in items:
-                            pname = it.get('projectname', '')
-                            jf = os.path.join(base_dir, f"{pname}.json")
-                            sf = os.path.join(base_dir, f"{pname}.session")
-                            if os.path.exists(jf):
-                                zf.write(jf, f"{pname}.json"); files_added += 1
-                            if os.path.exists(sf):
-                                zf.write(sf, f"{pname}.session"); files_added += 1
-                        for fn in os.listdir(base_dir):
-                            if fn.lower().endswith(('.txt', '.md')) and files_added < 500:
-                                fp = os.path.join(base_dir, fn)
-                                if os.path.isfile(fp):
-                                    zf.write(fp, fn); files_added += 1
-                    else:
-                        for idx, _ in enumerate(items, 1):
-                            for fn in os.listdir(base_dir):
-                                fp = os.path.join(base_dir, fn)
-                                if os.path.isfile(fp):
-                                    zf.write(fp, f"{idx:02d}_{fn}")
-                                    files_added += 1
-                if files_added == 0:
-                    if os.path.exists(zip_path):
-                        os.remove(zip_path)
-                    return 0
-                if os.path.getsize(zip_path) > 50 * 1024 * 1024:
-                    os.remove(zip_path)
-                    return 0
-                with open(zip_path, 'rb') as f:
-                    bot.send_document(
+                parts = build_archive_parts(entries)
+            except ArchiveTooLarge as e:
+                logger.error(f"打包失败，单个文件超过 50MB: {e}")
+                return []
+            if not parts:
+                return []
+
+            file_ids = list(resume_file_ids or []) if len(parts) == part_count else []
+            try:
+                for index, part in enumerate(parts, 1):
+                    if index <= len(file_ids):
+                        continue
+                    part_text = f" ({index}/{len(parts)})" if len(parts) > 1 else ""
+                    message = bot.send_document(
                         chat_id=user_id,
-                        document=f,
+                        document=part['file'],
+                        filename=part_filename(archive_name, index, len(parts)),
                         caption=(f"📁 <b>{self._h(product_name)}</b>\n"
-                                 f"📦 批量发货文件包\n"
+                                 f"📦 批量发货文件包{part_text}\n"
                                  f"🔢 商品数量: {len(items)} 个\n"
-                                 f"📂 文件总数: {files_added} 个\n"
+                                 f"📂 文件总数: {part['files']} 个\n"
                                  f"⏰ 发货时间: {self._to_beijing(datetime.utcnow()).strftime('%Y-%m-%d %H:%M:%S')}"),
                         parse_mode=ParseMode.HTML
                     )
-                try:
-                    os.remove(zip_path)
-                except:
-                    pass
-                return 1
+                    file_ids.append(message.document.file_id)
             except Exception as e:
-                logger.error(f"打包失败: {e}")
-                try:
-                    if os.path.exists(zip_path):
-                        os.remove(zip_path)
-                except:
-                    pass
-                return 0
+                logger.error(f"发送文件包失败: {e}")
+            finally:
+                for part in parts:
+                    part['file'].close()
+            return file_ids
         except Exception as e:
             logger.error(f"批量发送失败: {e}")
-            return 0
+            return []
 
     # ---------- 购买流程 ----------
     def process_purchase(self, user_id: int, product_nowuid: str, quantity: int = 1) -> Tuple[bool, Any]:
@@ -1829,7 +1963,7 @@ class AgentBotCore:
                 return False, "用户不存在"
 
             # ✅ 获取商品原始信息
-            product = self.config.ejfl.find_one({'nowuid': product_nowuid})
+            product = self.config.catalog.product(product_nowuid)
             if not product:
                 return False, "原始商品不存在"
 
@@ -1842,11 +1976,6 @@ class AgentBotCore:
             if not price_cfg:
                 return False, "商品不存在或已下架"
 
-            # ✅ 获取库存
-            items = list(self.config.hb.find({'nowuid': product_nowuid, 'state': 0}).limit(quantity))
-            if len(items) < quantity:
-                return False, "库存不足"
-
             # ✅ 实时计算代理价格
             origin_price = float(product.get('money', 0))
             agent_markup = float(price_cfg.get('agent_markup', 0))
@@ -1858,29 +1987,41 @@ class AgentBotCore:
             if balance < total_cost:
                 return False, "余额不足"
 
-            new_balance = balance - total_cost
-            coll_users.update_one(
-                {'user_id': user_id},
-                {'$set': {'USDT': new_balance, 'last_active': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
-                 '$inc': {'zgje': total_cost, 'zgsl': quantity}}
-            )
+            # ✅ 原子占用库存（与总部共用同一套占用逻辑，并发购买不会超卖）
+            sale_time = self._to_beijing(datetime.utcnow()).strftime('%Y-%m-%d %H:%M:%S')
+            items = claim_stock_items(self.config.hb, product_nowuid, quantity, user_id, sale_time=sale_time,
+                                      counters=self.config.stock_counters, uid=product.get('uid'))
+            if len(items) < quantity:
+                return False, "库存不足"
+
+            # ✅ 原子扣款（余额校验 + 扣款 + 累计消费一次写入），失败时释放已占用的库存
+            try:
+                new_balance = debit_balance(
+                    coll_users, user_id, total_cost,
+                    inc={'zgje': total_cost, 'zgsl': quantity},
+                    set_fields={'last_active': datetime.now().strftime('%Y-%m-%d %H:%M:%S')},
+                    ledger=self.config.balance_ledger, reason='购买', ref=product_nowuid
+                )
+            except Exception:
+                new_balance = None
+                logger.error(f"扣款失败: user={user_id} cost={total_cost}")
+            if new_balance is None:
+                release_stock_items(self.config.hb, items[0]['claim_token'], counters=self.config.stock_counters,
+                                    nowuid=product_nowuid, uid=product.get('uid'))
+                return False, "余额不足"
 
             ids = [i['_id'] for i in items]
-            sale_time = self._to_beijing(datetime.utcnow()).strftime('%Y-%m-%d %H:%M:%S')
-            self.config.hb.update_many(
-                {'_id': {'$in': ids}},
-                {'$set': {'state': 1, 'sale_time': sale_time, 'yssj': sale_time, 'gmid': user_id}}
-            )
 
             # ✅ 订单号先生成
             order_id = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S')}{user_id}"
 
-            files_sent = 0
+            file_ids = []
             try:
                 # ✅ 发货函数传递订单号当作第4参数
-                files_sent = self.send_batch_files_to_user(user_id, items, product.get('projectname', ''), order_id)
+                file_ids = self.send_archive_to_user(user_id, items, product.get('projectname', ''), order_id)
             except Exception as fe:
                 logger.warning(f"发货文件异常: {fe}")
+            files_sent = len(file_ids)
 
             # ✅ 计算利润
             profit_unit = max(agent_markup, 0)
@@ -1907,7 +2048,8 @@ class AgentBotCore:
                 # ✅ 新增字段用于可靠的重新下载
                 'item_ids': ids,  # 所有已售出商品的 ObjectId 列表
                 'first_item_id': str(ids[0]) if ids else '',  # 第一个商品ID（向后兼容/调试）
-                'category': product.get('leixing', '')  # 商品分类
+                'category': product.get('leixing', ''),  # 商品分类
+                'file_ids': file_ids  # ✅ 已发送文件包的 file_id，重新下载时直接按 file_id 重发
             })
 
             # 群通知
@@ -2298,7 +2440,7 @@ class AgentBotHandlers:
                 nowuid = payload.replace("product_", "")
                 try:
                     # 直接显示商品详情（购买页面）
-                    prod = self.core.config.ejfl.find_one({'nowuid': nowuid})
+                    prod = self.core.config.catalog.product(nowuid)
                     if not prod:
                         text = "❌ 商品不存在"
                         kb = [[InlineKeyboardButton("🔙 返回商品列表", callback_data="products")]]
@@ -2834,7 +2976,7 @@ class AgentBotHandlers:
     def show_product_detail(self, query, nowuid: str):
         """显示商品详情 - 完全仿照总部格式"""
         try:
-            prod = self.core.config.ejfl.find_one({'nowuid': nowuid})
+            prod = self.core.config.catalog.product(nowuid)
             if not prod:
                 self.safe_edit_message(query, "❌ 商品不存在", [[InlineKeyboardButton("🔙 返回", callback_data="back_products")]], parse_mode=None)
                 return
@@ -2888,7 +3030,7 @@ class AgentBotHandlers:
     def handle_buy_product(self, query, nowuid: str):
         """处理购买流程 - 完全仿照总部格式"""
         uid = query.from_user.id
-        prod = self.core.config.ejfl.find_one({'nowuid': nowuid})
+        prod = self.core.config.catalog.product(nowuid)
         price = self.core.get_product_price(nowuid)
         stock = self.core.get_product_stock(nowuid)
         user = self.core.get_user_info(uid)
@@ -2937,7 +3079,7 @@ class AgentBotHandlers:
         
         st = self.user_states[uid]
         nowuid = st['product_nowuid']
-        prod = self.core.config.ejfl.find_one({'nowuid': nowuid})
+        prod = self.core.config.catalog.product(nowuid)
         price = self.core.get_product_price(nowuid)
         stock = self.core.get_product_stock(nowuid)
         user = self.core.get_user_info(uid)
@@ -3228,7 +3370,7 @@ class AgentBotHandlers:
         self.safe_edit_message(query, text, kb, parse_mode=None)
 
     def show_price_edit(self, query, nowuid: str):
-        prod = self.core.config.ejfl.find_one({'nowuid': nowuid})
+        prod = self.core.config.catalog.product(nowuid)
         if not prod:
             self.safe_edit_message(query, "❌ 商品不存在", [[InlineKeyboardButton("🔙 返回", callback_data="price_management")]], parse_mode=None)
             return
@@ -3283,7 +3425,7 @@ class AgentBotHandlers:
             return
         
         # ✅ 实时获取总部价格
-        prod = self.core.config.ejfl.find_one({'nowuid': nowuid})
+        prod = self.core.config.catalog.product(nowuid)
         op = float(prod.get('money', 0)) if prod else 0
         
         name = ap_info.get('product_name', 'N/A')
@@ -3602,7 +3744,14 @@ class AgentBotHandlers:
                     query.answer("❌ 无法找到商品信息", show_alert=True)
                     return
             
-            product = self.core.config.ejfl.find_one({'nowuid': nowuid})
+            # ✅ 优先按 file_id 重发（不重新打包上传），file_id 被拒绝时才重新打包并从该分卷补发
+            old_file_ids = order.get('file_ids') or []
+            resent = self.core.resend_file_ids(uid, old_file_ids) if old_file_ids else 0
+            if old_file_ids and resent == len(old_file_ids):
+                query.answer("✅ 文件已重新发送，请查收！", show_alert=True)
+                return
+            
+            product = self.core.config.catalog.product(nowuid)
             if not product:
                 query.answer("❌ 商品已不存在", show_alert=True)
                 return
@@ -3658,10 +3807,14 @@ class AgentBotHandlers:
                     'projectname': product_name
                 }] * quantity
             
-            # 重新发送文件
-            files_sent = self.core.send_batch_files_to_user(uid, items, product_name, order_id)
+            # 重新发送文件，并记录新的 file_id 供下次重发
+            file_ids = self.core.send_archive_to_user(uid, items, product_name, order_id,
+                                                      resume_file_ids=old_file_ids[:resent],
+                                                      part_count=len(old_file_ids))
+            if file_ids:
+                order_coll.update_one({'_id': order['_id']}, {'$set': {'file_ids': file_ids}})
             
-            if files_sent > 0:
+            if file_ids:
                 query.answer("✅ 文件已重新发送，请查收！", show_alert=True)
             else:
                 query.answer("❌ 文件发送失败，请联系客服", show_alert=True)
@@ -3819,6 +3972,7 @@ class AgentBotHandlers:
                         {'$set': {'status': 'canceled', 'canceled_time': datetime.utcnow()}}
                     )
                     if res.modified_count:
+                        self.core.config.amount_slots.release_order(order)
                         q.answer("已取消")
                         kb = InlineKeyboardMarkup([
                             [InlineKeyboardButton("📜 充值记录", callback_data="recharge_list"),
@@ -4361,7 +4515,7 @@ class AgentBot:
 
     def _job_auto_recharge_check(self, context: CallbackContext):
         try:
-            self.core.poll_and_auto_settle_recharges(max_orders=80)
+            self.core.poll_and_auto_settle_recharges()
         except Exception as e:
             logger.warning(f"自动校验任务异常: {e}")
 
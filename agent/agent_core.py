@@ -1,8 +1,15 @@
 import logging
 import os
+import sys
 from datetime import datetime
 from telegram import Bot
 
+# 共享数据层（仓库根目录，与总部 mongo.py 共用）
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if _REPO_ROOT not in sys.path:
+    sys.path.insert(0, _REPO_ROOT)
+from mongo_shared import claim_stock_items, release_stock_items, debit_balance
+
 logger = logging.getLogger(__name__)
 
 class AgentBotCore:
@@ -30,19 +37,10 @@ class AgentBotCore:
             if not agent_price_info:
                 return False, "商品不存在或已下架"
             
-            original_product = self.config.ejfl.find_one({'nowuid': product_nowuid})
+            original_product = self.config.catalog.product(product_nowuid)
             if not original_product:
                 return False, "原始商品不存在"
             
-            # 检查库存
-            available_items = list(self.config.hb.find({
-                'nowuid': product_nowuid,
-                'state': 0
-            }).limit(quantity))
-            
-            if len(available_items) < quantity:
-                return False, "库存不足"
-            
             # 计算费用
             agent_price = agent_price_info['agent_price']
             total_cost = agent_price * quantity
@@ -51,25 +49,25 @@ class AgentBotCore:
             if user_balance < total_cost:
                 return False, "余额不足"
             
-            # 扣除余额
-            new_balance = user_balance - total_cost
-            update_result = agent_users.update_one(
-                {'user_id': user_id},
-                {
-                    '$set': {'USDT': new_balance},
-                    '$inc': {'zgje': total_cost, 'zgsl': quantity}
-                }
+            # 原子占用库存（标记为已售出），库存不足时不会留下任何占用
+            available_items = claim_stock_items(
+                self.config.hb, product_nowuid, quantity, user_id,
+                sale_time=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                counters=self.config.stock_counters, uid=original_product.get('uid')
             )
+            if len(available_items) < quantity:
+                return False, "库存不足"
+            claim_token = available_items[0]['claim_token']
             
-            if update_result.modified_count == 0:
-                return False, "余额扣除失败"
+            # 原子扣除余额（余额不足时过滤条件不匹配，不会扣成负数）
+            new_balance = debit_balance(agent_users, user_id, total_cost,
+                                        inc={'zgje': total_cost, 'zgsl': quantity},
+                                        ledger=self.config.balance_ledger, reason='购买', ref=product_nowuid)
             
-            # 标记商品为已售出
-            item_ids = [item['_id'] for item in available_items]
-            self.config.hb.update_many(
-                {'_id': {'$in': item_ids}},
-                {'$set': {'state': 1, 'sale_time': datetime.now().strftime('%Y-%m-%d %H:%M:%S')}}
-            )
+            if new_balance is None:
+                release_stock_items(self.config.hb, claim_token, counters=self.config.stock_counters,
+                                    nowuid=product_nowuid, uid=original_product.get('uid'))
+                return False, "余额扣除失败"
             
             # 处理商品内容和文件发送
             delivered_items = []
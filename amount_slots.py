@@ -0,0 +1,149 @@
+"""
+充值金额尾数分配（总部 topup 和代理 recharge_orders 共用）
+
+原来随机生成尾数再 find_one 查重，撞了就重试几次，抢充值高峰时容易"系统繁忙"。
+现在每个 (收款地址, 基础金额) 一个位图文档，第 i 位为 1 表示尾数 i 正在被待支付订单使用：
+
+    {_id: key, w0: Int64, w1: Int64, ..., leases: {'<slot>': 占用时间}}     每个字段存 32 位
+
+- acquire()：读一次位图，随机挑一个有空位的字段和空位，
+  用 {wK: {$bitsAllClear: mask}} 条件 + $bit or 原子占用，同时写入该槽位的占用时间；
+  被别人抢先时重读再挑，只要还有空位就不会失败
+- release()：订单到账 / 取消 / 过期时 $bit and 清零
+- 位图满时调用 reclaim() 取实际待支付订单的槽位，只回收不在其中、且占用超过 lease_grace 的槽位
+  （兜底没有走到 release 的订单）。刚占用、订单还没写入的槽位（如正在请求支付接口）不会被回收，
+  每个槽位按占用时间条件清除，不会覆盖其他进程同时占用的位
+
+订单上保存 amount_slot: {'key', 'slot'}，释放时按它清位。
+本模块只接收集合对象作为参数，导入时不连接数据库。
+"""
+import random
+from datetime import datetime, timedelta
+
+from bson.int64 import Int64
+from pymongo.errors import DuplicateKeyError
+
+WORD_BITS = 32
+WORD_MASK = (1 << WORD_BITS) - 1
+
+
+class AmountSlots:
+    """
+    Args:
+        collection: 位图集合
+        size: 每个 key 的尾数个数（槽位 0 ~ size-1）
+        lease_grace: 占用多久之后、仍没有对应的待支付订单才可以回收（秒）
+    """
+
+    def __init__(self, collection, size, lease_grace=300):
+        self.collection = collection
+        self.size = size
+        self.words = (size + WORD_BITS - 1) // WORD_BITS
+        self.lease_grace = timedelta(seconds=lease_grace)
+
+    def _full_mask(self, word):
+        """第 word 个字段全部占满时的值（最后一个字段可能不足 32 位）"""
+        bits = min(WORD_BITS, self.size - word * WORD_BITS)
+        return (1 << bits) - 1
+
+    @staticmethod
+    def _bit(slot):
+        return f'w{slot // WORD_BITS}', 1 << (slot % WORD_BITS)
+
+    def _load(self, key):
+        doc = self.collection.find_one({'_id': key})
+        if doc is not None:
+            return doc
+        doc = {'_id': key, 'size': self.size}
+        doc.update({f'w{i}': Int64(0) for i in range(self.words)})
+        try:
+            self.collection.insert_one(doc)
+        except DuplicateKeyError:
+            return self.collection.find_one({'_id': key})
+        return doc
+
+    def _pick(self, doc):
+        """随机挑一个空位；没有空位返回 None"""
+        words = [i for i in range(self.words) if int(doc.get(f'w{i}', 0)) & WORD_MASK != self._full_mask(i)]
+        if not words:
+            return None
+        word = random.choice(words)
+        value = int(doc.get(f'w{word}', 0))
+        bits = [b for b in range(min(WORD_BITS, self.size - word * WORD_BITS)) if not value >> b & 1]
+        return word * WORD_BITS + random.choice(bits)
+
+    def acquire(self, key, reclaim=None):
+        """
+        占用一个槽位
+
+        Args:
+            reclaim: 位图满时调用，返回已写入待支付订单的槽位集合，其余过期占用的槽位被回收
+
+        Returns:
+            槽位号；全部占满（回收后仍满）时返回 None
+        """
+        doc = self._load(key)
+        reclaimed = False
+        while True:
+            slot = self._pick(doc)
+            if slot is None:
+                if reclaim is None or reclaimed:
+                    return None
+                self.reclaim_stale(key, reclaim(), doc)
+                reclaimed = True
+                doc = self._load(key)
+                continue
+            field, mask = self._bit(slot)
+            res = self.collection.update_one(
+                {'_id': key, field: {'$bitsAllClear': mask}},
+                {'$bit': {field: {'or': Int64(mask)}}, '$set': {f'leases.{slot}': datetime.utcnow()}}
+            )
+            if res.modified_count:
+                return slot
+            # 被其他进程抢先：重读位图再挑
+            doc = self._load(key)
+
+    def release(self, key, slot):
+        field, mask = self._bit(slot)
+        self.collection.update_one({'_id': key}, {'$bit': {field: {'and': Int64(WORD_MASK ^ mask)}},
+                                                  '$unset': {f'leases.{slot}': ''}})
+
+    def release_order(self, order):
+        """按订单上的 amount_slot 释放"""
+        amount_slot = (order or {}).get('amount_slot')
+        if amount_slot:
+            self.release(amount_slot['key'], amount_slot['slot'])
+
+    def reclaim_stale(self, key, pending_slots, doc=None):
+        """
+        回收已占用、但没有对应待支付订单且占用超过 lease_grace 的槽位
+
+        每个槽位按读到的占用时间条件清除：期间被释放又重新占用的槽位占用时间已变化，不会被误清。
+
+        Returns:
+            回收的槽位数
+        """
+        doc = doc or self._load(key)
+        leases = doc.get('leases') or {}
+        cutoff = datetime.utcnow() - self.lease_grace
+        reclaimed = 0
+        for slot in self._used(doc) - set(pending_slots):
+            leased_at = leases.get(str(slot))
+            if leased_at is not None and leased_at > cutoff:
+                continue
+            field, mask = self._bit(slot)
+            # 没有占用时间的是旧版本写入的位，按位图条件清除
+            cond = {f'leases.{slot}': leased_at} if leased_at is not None else {f'leases.{slot}': {'$exists': False}}
+            res = self.collection.update_one(
+                dict(cond, _id=key, **{field: {'$bitsAllSet': mask}}),
+                {'$bit': {field: {'and': Int64(WORD_MASK ^ mask)}}, '$unset': {f'leases.{slot}': ''}}
+            )
+            reclaimed += res.modified_count
+        return reclaimed
+
+    def _used(self, doc):
+        return {i * WORD_BITS + b for i in range(self.words)
+                for b in range(WORD_BITS) if int(doc.get(f'w{i}', 0)) >> b & 1}
+
+    def in_use(self, key):
+        return self._used(self.collection.find_one({'_id': key}) or {})
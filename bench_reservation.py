@@ -0,0 +1,108 @@
+"""
+库存原子占用并发压测
+
+在独立的临时数据库中写入一批可售商品，多线程同时调用 claim_stock_items 抢购同一商品，
+结束后校验：
+- 每件商品最多被一个买家占用（无重复发货）
+- 占用总数不超过库存（无超卖）
+- 库存计数器与 hb 实际状态一致
+
+用法：
+    python bench_reservation.py [--items 2000] [--buyers 64] [--qty 3]
+连接地址读取 MONGO_URI，压测库默认 bench_reservation，结束后自动删除（--keep 保留）
+"""
+import argparse
+import os
+import threading
+import time
+from collections import Counter
+
+import pymongo
+from dotenv import load_dotenv
+
+from mongo_shared import claim_stock_items, stock_snapshot, rebuild_stock_counters, apply_stock_delta
+from db_indexes import HQ_INDEX_MANIFEST, reconcile_indexes
+
+load_dotenv()
+
+BENCH_NOWUID = 'bench_nowuid'
+BENCH_UID = 'bench_uid'
+
+
+def seed(hb, counters, items):
+    hb.delete_many({})
+    counters.delete_many({})
+    # 与线上相同，按索引清单建索引
+    reconcile_indexes(hb, HQ_INDEX_MANIFEST[('bot', 'hb')])
+    docs = [{
+        'leixing': '协议号', 'uid': BENCH_UID, 'nowuid': BENCH_NOWUID,
+        'hbid': f'bench{i}', 'projectname': f'bench_{i}', 'state': 0, 'timer': ''
+    } for i in range(items)]
+    hb.insert_many(docs, ordered=False)
+    apply_stock_delta(counters, BENCH_NOWUID, BENCH_UID, available=items)
+
+
+def run(args):
+    client = pymongo.MongoClient(os.getenv('MONGO_URI', 'mongodb://127.0.0.1:27017/'))
+    db = client[args.db]
+    hb = db['hb']
+    counters = db['stock_counters']
+    seed(hb, counters, args.items)
+
+    results = []
+    lock = threading.Lock()
+    start_event = threading.Event()
+
+    def buyer(buyer_id):
+        start_event.wait()
+        mine = []
+        attempts = 0
+        while True:
+            attempts += 1
+            items = claim_stock_items(hb, BENCH_NOWUID, args.qty, buyer_id, counters=counters, uid=BENCH_UID)
+            if not items:
+                break
+            mine.extend(doc['_id'] for doc in items)
+        with lock:
+            results.append((buyer_id, mine, attempts))
+
+    threads = [threading.Thread(target=buyer, args=(i,)) for i in range(args.buyers)]
+    for t in threads:
+        t.start()
+    began = time.time()
+    start_event.set()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - began
+
+    claimed_ids = [item_id for _, mine, _ in results for item_id in mine]
+    duplicates = [item_id for item_id, n in Counter(claimed_ids).items() if n > 1]
+    calls = sum(attempts for _, _, attempts in results)
+    sold_in_db = hb.count_documents({'nowuid': BENCH_NOWUID, 'state': 1})
+    left_in_db = hb.count_documents({'nowuid': BENCH_NOWUID, 'state': 0})
+    counter = stock_snapshot(counters, nowuids=[BENCH_NOWUID])['products'][BENCH_NOWUID]
+    drift = rebuild_stock_counters(hb, counters, fix=False)['drift']
+
+    print(f"商品数: {args.items}  买家线程: {args.buyers}  每单数量: {args.qty}")
+    print(f"耗时: {elapsed:.2f}s  调用次数: {calls}  占用商品: {len(claimed_ids)}")
+    print(f"吞吐: {len(claimed_ids) / elapsed:.0f} 件/秒  {calls / elapsed:.0f} 次调用/秒")
+    print(f"重复占用: {len(duplicates)}  超卖: {max(len(claimed_ids) - args.items, 0)}")
+    print(f"hb 已售/剩余: {sold_in_db}/{left_in_db}  计数器: {counter}  计数偏差: {len(drift)}")
+
+    ok = (not duplicates and len(claimed_ids) <= args.items and sold_in_db == len(claimed_ids)
+          and counter['sold'] == sold_in_db and counter['available'] == left_in_db)
+    print("✅ 校验通过" if ok else "❌ 校验失败")
+
+    if not args.keep:
+        client.drop_database(args.db)
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='库存原子占用并发压测')
+    parser.add_argument('--items', type=int, default=2000, help='可售商品数量')
+    parser.add_argument('--buyers', type=int, default=64, help='并发买家线程数')
+    parser.add_argument('--qty', type=int, default=3, help='每次购买数量')
+    parser.add_argument('--db', default='bench_reservation', help='压测使用的临时数据库')
+    parser.add_argument('--keep', action='store_true', help='结束后保留压测数据库')
+    raise SystemExit(run(parser.parse_args()))
@@ -22,7 +22,7 @@ from decimal import Decimal
 from threading import Timer, Thread
 from multiprocessing import Process
 from concurrent.futures import ThreadPoolExecutor
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, time as dt_time
 from glob import glob
 from random import randint, shuffle
 from dotenv import load_dotenv
@@ -274,6 +274,9 @@ except ImportError:
 from pymongo import MongoClient
 from mongo import *
 from mongo import topup, user, withdrawal_requests
+from delivery_queue import DeliveryQueue
+from delivery_archive import build_archive_parts, item_entries, part_filename
+from pack_store import PackWriter
 from utils import create_easypay_url, create_payment_with_qrcode
 from pay_server import start_flask_server
 
@@ -520,7 +523,7 @@ def handle_captcha_response(update: Update, context: CallbackContext):
         return
     
     # 获取用户语言设置
-    user_info = user.find_one({'user_id': user_id})
+    user_info = load_user(context, user_id)
     lang = user_info.get('lang', 'zh') if user_info else 'zh'
     
     # 删除验证码消息
@@ -610,7 +613,7 @@ def check_captcha_cooldown(user_id: int, context: CallbackContext, lang: str = '
 def start_verified_user(update: Update, context: CallbackContext, user_id: int):
     """已验证用户的启动流程"""
     # 获取用户信息
-    uinfo = user.find_one({'user_id': user_id})
+    uinfo = load_user(context, user_id)
     if not uinfo:
         return
     
@@ -694,20 +697,20 @@ def inline_query(update: Update, context: CallbackContext):
     # 商品分享卡片（根据 nowuid）
     if query.startswith("share_"):
         nowuid = query.replace("share_", "")
-        product = ejfl.find_one({'nowuid': nowuid})
+        product = catalog.product(nowuid)
         if not product:
             return
 
         pname = product.get('projectname', '未知商品')
         price = float(product.get('money', 0))
-        stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
+        stock = get_product_stock(nowuid)
         desc = product.get('desc', '暂无商品说明')
 
         # 获取一级分类名
         uid = product.get('uid')
         cate_name = '未知分类'
         if uid:
-            cate = fenlei.find_one({'uid': uid})
+            cate = catalog.category(uid)
             if cate:
                 cate_name = cate.get('projectname', '未知分类')
 
@@ -787,7 +790,7 @@ def inline_query(update: Update, context: CallbackContext):
     if is_number(query):
         money = query
         money = float(money) if str(money).count('.') > 0 else int(money)
-        user_list = user.find_one({'user_id': user_id})
+        user_list = load_user(context, user_id)
         USDT = user_list['USDT']
         if USDT >= money:
             if money <= 0:
@@ -880,7 +883,7 @@ def inline_query(update: Update, context: CallbackContext):
             update.inline_query.answer(results=results, cache_time=0)
             return
     uid = query.replace('redpacket ', '')
-    hongbao_list = hongbao.find_one({'uid': uid})
+    hongbao_list = get_red_packet(uid)
     if hongbao_list is None:
         results = [
             InlineQueryResultArticle(
@@ -922,26 +925,7 @@ def inline_query(update: Update, context: CallbackContext):
 
             update.inline_query.answer(results=results, cache_time=0)
         else:
-            qbrtext = []
-            jiangpai = {'0': '🥇', '1': '🥈', '2': '🥉'}
-            count = 0
-            qb_list = list(qb.find({'uid': uid}, sort=[('money', -1)]))
-            for i in qb_list:
-                qbid = i['user_id']
-                qbname = i['fullname'].replace('<', '').replace('>', '')
-                qbtimer = i['timer'][-8:]
-                qbmoney = i['money']
-                if str(count) in jiangpai.keys():
-
-                    qbrtext.append(
-                        f'{jiangpai[str(count)]} <code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-                else:
-                    qbrtext.append(
-                        f'<code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-                count += 1
-            qbrtext = '\n'.join(qbrtext)
-
-            syhb = hbsl - len(qb_list)
+            qbrtext, syhb = red_packet_board(hongbao_list)
 
             fstext = f'''
 🧧 <a href="tg://user?id={user_id}">{fullname}</a> 发送了一个红包
@@ -978,9 +962,9 @@ def shokuan(update: Update, context: CallbackContext):
     # fb_id = int(data.split(':')[0])
     # fb_money = data.split(':')[1]
     # fb_money = float(fb_money) if str((fb_money)).count('.') > 0 else int(standard_num(fb_money))
-    fb_list = zhuanz.find_one({'uid': uid})
-    fb_state = fb_list['state']
-    if fb_state == 1:
+    # ✅ 原子领取转账单：并发点击时只有一个人能把 state 改成 1
+    fb_list = zhuanz.find_one_and_update({'uid': uid, 'state': {'$ne': 1}}, {"$set": {"state": 1}})
+    if fb_list is None:
         fstext = f'''
 ❌ 领取失败
         '''
@@ -988,57 +972,21 @@ def shokuan(update: Update, context: CallbackContext):
         return
     fb_id = fb_list['user_id']
     fb_money = fb_list['money']
-    yh_list = user.find_one({'user_id': fb_id})
-    yh_usdt = yh_list['USDT']
-    if yh_usdt < fb_money:
+    if debit_user_balance(fb_id, fb_money, reason='转账', ref=uid) is None:
         fstext = f'''
 ❌ 领取失败.USDT 操作失败，余额不足
         '''
-        zhuanz.update_one({'uid': uid}, {"$set": {"state": 1}})
         query.answer(fstext, show_alert=bool("true"))
         return
-
-    now_money = standard_num(yh_usdt - fb_money)
-    now_money = float(now_money) if str((now_money)).count('.') > 0 else int(standard_num(now_money))
-    user.update_one({'user_id': fb_id}, {"$set": {'USDT': now_money}})
-
-    zhuanz.update_one({'uid': uid}, {"$set": {"state": 1}})
     user_id = query.from_user.id
     username = query.from_user.username
     fullname = query.from_user.full_name.replace('<', '').replace('>', '')
     lastname = query.from_user.last_name
     timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
 
-    if user.find_one({'user_id': user_id}) is None:
-        try:
-            key_id = user.find_one({}, sort=[('count_id', -1)])['count_id']
-        except:
-            key_id = 0
-        try:
-            key_id += 1
-            user_data(key_id, user_id, username, fullname, lastname, str(1), creation_time=timer,
-                      last_contact_time=timer)
-        except:
-            for i in range(100):
-                try:
-                    key_id += 1
-                    user_data(key_id, user_id, username, fullname, lastname, str(1), creation_time=timer,
-                              last_contact_time=timer)
-                    break
-                except:
-                    continue
-    elif user.find_one({'user_id': user_id})['username'] != username:
-        user.update_one({'user_id': user_id}, {'$set': {'username': username}})
+    register_or_touch_user(user_id, username, fullname, lastname, timer)
 
-    elif user.find_one({'user_id': user_id})['fullname'] != fullname:
-        user.update_one({'user_id': user_id}, {'$set': {'fullname': fullname}})
-
-    user_list = user.find_one({"user_id": user_id})
-    USDT = user_list['USDT']
-
-    now_money = standard_num(USDT + fb_money)
-    now_money = float(now_money) if str((now_money)).count('.') > 0 else int(standard_num(now_money))
-    user.update_one({'user_id': user_id}, {"$set": {'USDT': now_money}})
+    credit_user_balance(user_id, fb_money, reason='收款', ref=uid)
     fstext = f'''
 <a href="tg://user?id={user_id}">{fullname}</a> 已领取 <b>{fb_money}</b> USDT
     '''
@@ -1050,6 +998,23 @@ def shokuan(update: Update, context: CallbackContext):
         pass
 
 
+def red_packet_board(packet):
+    """红包领取排行（直接用红包文档中的领取记录），返回 (排行文本, 剩余个数)"""
+    jiangpai = {'0': '🥇', '1': '🥈', '2': '🥉'}
+    qbrtext = []
+    for count, i in enumerate(red_packet_claims(packet)):
+        qbid = i['user_id']
+        qbname = i['fullname'].replace('<', '').replace('>', '')
+        qbtimer = i['timer'][-8:]
+        qbmoney = standard_num(i['money'])
+        if str(count) in jiangpai.keys():
+            qbrtext.append(
+                f'{jiangpai[str(count)]} <code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
+        else:
+            qbrtext.append(f'<code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
+    return '\n'.join(qbrtext), len(packet.get('shares', []))
+
+
 def lqhb(update: Update, context: CallbackContext):
     query = update.callback_query
     uid = query.data.replace('lqhb ', '')
@@ -1059,98 +1024,29 @@ def lqhb(update: Update, context: CallbackContext):
     lastname = query.from_user.last_name
     timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
 
-    if user.find_one({'user_id': user_id}) is None:
-        try:
-            key_id = user.find_one({}, sort=[('count_id', -1)])['count_id']
-        except:
-            key_id = 0
-        try:
-            key_id += 1
-            user_data(key_id, user_id, username, fullname, lastname, str(1), creation_time=timer,
-                      last_contact_time=timer)
-        except:
-            for i in range(100):
-                try:
-                    key_id += 1
-                    user_data(key_id, user_id, username, fullname, lastname, str(1), creation_time=timer,
-                              last_contact_time=timer)
-                    break
-                except:
-                    continue
-    elif user.find_one({'user_id': user_id})['username'] != username:
-        user.update_one({'user_id': user_id}, {'$set': {'username': username}})
+    register_or_touch_user(user_id, username, fullname, lastname, timer)
+
+    # ✅ 原子领取：一次写入弹出一个预先算好的份额并登记领取人
+    money, hongbao_list = claim_red_packet(uid, user_id, fullname, timer)
+    if hongbao_list is None:
+        query.answer('红包不存在', show_alert=bool("true"))
+        return
+    if money is None:
+        if user_id in hongbao_list.get('claimed_by', []):
+            query.answer('你已领取该红包', show_alert=bool("true"))
+        else:
+            query.answer('红包已抢完', show_alert=bool("true"))
+        return
 
-    elif user.find_one({'user_id': user_id})['fullname'] != fullname:
-        user.update_one({'user_id': user_id}, {'$set': {'fullname': fullname}})
+    credit_user_balance(user_id, money, reason='领取红包', ref=uid)
 
-    user_list = user.find_one({"user_id": user_id})
-    USDT = user_list['USDT']
+    query.answer(f'领取红包成功，金额:{standard_num(money)}', show_alert=bool("true"))
 
-    hongbao_list = hongbao.find_one({'uid': uid})
     fb_id = hongbao_list['user_id']
     fb_fullname = hongbao_list['fullname']
     hbmoney = hongbao_list['hbmoney']
     hbsl = hongbao_list['hbsl']
-    state = hongbao_list['state']
-    if state == 1:
-        query.answer('红包已抢完', show_alert=bool("true"))
-        return
-
-    qhb_list = qb.find_one({"uid": uid, 'user_id': user_id})
-    if qhb_list is not None:
-        query.answer('你已领取该红包', show_alert=bool("true"))
-        return
-    qb_list = list(qb.find({'uid': uid}, sort=[('money', -1)]))
-
-    syhb = hbsl - len(qb_list)
-    # 以下是随机分配金额的代码
-    remaining_money = hbmoney - sum(q['money'] for q in qb_list)  # 计算剩余红包总额
-    if syhb > 1:
-        # 多于一个红包剩余时，使用正态分布随机生成金额
-        mean_money = remaining_money / syhb  # 计算每个红包的平均金额
-        std_dev = mean_money / 3  # 标准差设定为平均金额的1/3
-        money = standard_num(max(0.01, round(random.normalvariate(mean_money, std_dev), 2)))  # 使用正态分布生成金额，并保留两位小数
-        money = float(money) if str(money).count('.') > 0 else int(money)
-    else:
-        # 如果只有一个红包剩余，直接将剩余金额分配给该红包
-        money = round(remaining_money, 2)  # 将剩余金额保留两位小数
-        money = float(money) if str(money).count('.') > 0 else int(money)
-
-    # 将金额保存到数据库
-    qb.insert_one({
-        'uid': uid,
-        'user_id': user_id,
-        'fullname': fullname,
-        'money': money,
-        'timer': timer
-    })
-
-    user_money = standard_num(USDT + money)
-    user_money = float(user_money) if str(user_money).count('.') > 0 else int(user_money)
-    user.update_one({'user_id': user_id}, {"$set": {'USDT': user_money}})
-
-    query.answer(f'领取红包成功，金额:{money}', show_alert=bool("true"))
-
-    jiangpai = {'0': '🥇', '1': '🥈', '2': '🥉'}
-
-    qb_list = list(qb.find({'uid': uid}, sort=[('money', -1)]))
-
-    syhb = hbsl - len(qb_list)
-    qbrtext = []
-    count = 0
-    for i in qb_list:
-        qbid = i['user_id']
-        qbname = i['fullname'].replace('<', '').replace('>', '')
-        qbtimer = i['timer'][-8:]
-        qbmoney = i['money']
-        if str(count) in jiangpai.keys():
-
-            qbrtext.append(
-                f'{jiangpai[str(count)]} <code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-        else:
-            qbrtext.append(f'<code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-        count += 1
-    qbrtext = '\n'.join(qbrtext)
+    qbrtext, syhb = red_packet_board(hongbao_list)
 
     fstext = f'''
 🧧 <a href="tg://user?id={fb_id}">{fb_fullname}</a> 发送了一个红包
@@ -1163,7 +1059,6 @@ def lqhb(update: Update, context: CallbackContext):
         keyboard = [
             [InlineKeyboardButton(context.bot.first_name, url=url)]
         ]
-        hongbao.update_one({'uid': uid}, {"$set": {'state': 1}})
     else:
         url = helpers.create_deep_linked_url(context.bot.username, str(user_id))
         keyboard = [
@@ -1181,36 +1076,18 @@ def xzhb(update: Update, context: CallbackContext):
     query.answer()
     user_id = query.from_user.id
     uid = query.data.replace('xzhb ', '')
-    hongbao_list = hongbao.find_one({'uid': uid})
+    hongbao_list = get_red_packet(uid)
+    if hongbao_list is None:
+        return
     fb_id = hongbao_list['user_id']
     fb_fullname = hongbao_list['fullname']
     state = hongbao_list['state']
     hbmoney = hongbao_list['hbmoney']
     hbsl = hongbao_list['hbsl']
     timer = hongbao_list['timer']
-    jiangpai = {'0': '🥇', '1': '🥈', '2': '🥉'}
+    qbrtext, syhb = red_packet_board(hongbao_list)
     if state == 0:
 
-        qb_list = list(qb.find({'uid': uid}, sort=[('money', -1)]))
-
-        syhb = hbsl - len(qb_list)
-
-        qbrtext = []
-        count = 0
-        for i in qb_list:
-            qbid = i['user_id']
-            qbname = i['fullname'].replace('<', '').replace('>', '')
-            qbtimer = i['timer'][-8:]
-            qbmoney = i['money']
-            if str(count) in jiangpai.keys():
-
-                qbrtext.append(
-                    f'{jiangpai[str(count)]} <code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-            else:
-                qbrtext.append(f'<code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-            count += 1
-        qbrtext = '\n'.join(qbrtext)
-
         fstext = f'''
 🧧 <a href="tg://user?id={fb_id}">{fb_fullname}</a> 发送了一个红包
 🕦 时间:{timer}
@@ -1225,25 +1102,6 @@ def xzhb(update: Update, context: CallbackContext):
         context.bot.send_message(chat_id=user_id, text=fstext, parse_mode='HTML',
                                  reply_markup=InlineKeyboardMarkup(keyboard))
     else:
-
-        qb_list = list(qb.find({'uid': uid}, sort=[('money', -1)]))
-
-        qbrtext = []
-        count = 0
-        for i in qb_list:
-            qbid = i['user_id']
-            qbname = i['fullname'].replace('<', '').replace('>', '')
-            qbtimer = i['timer'][-8:]
-            qbmoney = i['money']
-            if str(count) in jiangpai.keys():
-
-                qbrtext.append(
-                    f'{jiangpai[str(count)]} <code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-            else:
-                qbrtext.append(f'<code>{qbmoney}</code>({qbtimer}) USDT💰 - <a href="tg://user?id={qbid}">{qbname}</a>')
-            count += 1
-        qbrtext = '\n'.join(qbrtext)
-
         fstext = f'''
 🧧 <a href="tg://user?id={fb_id}">{fb_fullname}</a> 发送了一个红包
 🕦 时间:{timer}
@@ -1270,12 +1128,13 @@ def jxzhb(update: Update, context: CallbackContext):
 
     ]
 
-    for i in list(hongbao.find({'user_id': user_id, 'state': 0})):
+    for i in hongbao.find({'user_id': user_id, 'state': 0}):
+        if 'amounts' not in i:
+            i = get_red_packet(i['uid'])
         timer = i['timer'][-14:-3]
         hbsl = i['hbsl']
         uid = i['uid']
-        qb_list = list(qb.find({'uid': uid}, sort=[('money', -1)]))
-        syhb = hbsl - len(qb_list)
+        syhb = len(i['shares'])
         hbmoney = i['hbmoney']
         keyboard.append(
             [InlineKeyboardButton(f'🧧[{timer}] {syhb}/{hbsl} - {hbmoney} USDT', callback_data=f'xzhb {uid}')])
@@ -1337,32 +1196,17 @@ def start(update: Update, context: CallbackContext):
     chat_id = update.effective_chat.id
     now = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
 
-    # 检查是否是新用户
-    is_new_user = user.find_one({'user_id': user_id}) is None
-
-    # 首次注册用户
-    if is_new_user:
-        try:
-            last_id = user.find_one({}, sort=[('count_id', -1)])['count_id']
-        except:
-            last_id = 0
-        for _ in range(100):
-            try:
-                last_id += 1
-                user_data(last_id, user_id, username, fullname, lastname, '1', creation_time=now, last_contact_time=now)
-                break
-            except:
-                continue
-    else:
-        if user.find_one({'user_id': user_id})['fullname'] != fullname:
-            user.update_one({'user_id': user_id}, {'$set': {'fullname': fullname}})
+    # 注册新用户 / 更新老用户资料，一次写入并返回用户信息
+    uinfo, is_new_user = register_or_touch_user(user_id, username, fullname, lastname, now)
+    if uinfo is None:
+        return
 
     # ✅ 管理员状态设置 - 统一使用 user_id 验证
-    if is_admin(user_id):
-        user.update_one({'username': username}, {'$set': {'state': '4'}})
+    if is_admin(user_id) and uinfo.get('state') != '4':
+        user.update_one({'user_id': user_id}, {'$set': {'state': '4'}})
+        uinfo['state'] = '4'
 
     # 获取用户信息
-    uinfo = user.find_one({'user_id': user_id})
     state = uinfo['state']
     sign = uinfo['sign']
     USDT = uinfo['USDT']
@@ -1430,7 +1274,7 @@ def show_admin_panel(update: Update, context: CallbackContext, user_id: int):
     month_usdt = sum_usdt(month_start, now)
 
     total_users = user.count_documents({})
-    total_balance = sum(i.get('USDT', 0) for i in user.find({'USDT': {'$gt': 0}}))
+    total_balance = platform_balance_total()
 
     # ✅ 美化管理员控制台，使用树状结构
     admin_text = f'''
@@ -1627,7 +1471,7 @@ def admin_remove(update: Update, context: CallbackContext):
 
 def admin(update: Update, context: CallbackContext):
     user_id = update.effective_user.id
-    uinfo = user.find_one({'user_id': user_id})
+    uinfo = load_user(context, user_id)
 
     # 权限判断
     if not uinfo or str(uinfo.get('state')) != '4':
@@ -1670,6 +1514,21 @@ def diag_db(update: Update, context: CallbackContext):
             if len(parts) == 2:
                 prefix = parts[0].split('//')[0] + '//'
                 masked_uri = f"{prefix}***:***@{parts[1]}"
+
+        # explain() 检查热点查询是否仍在全表扫描
+        plan_lines = []
+        for row in diagnose_hot_queries():
+            if row.get('error'):
+                mark = "⚠️ explain 失败: " + row['error'][:60].replace('<', '').replace('>', '')
+            elif row['collscan']:
+                mark = "❌ COLLSCAN"
+            else:
+                mark = "✅ " + ' → '.join(row['stages'][:2])
+            plan_lines.append(f"• {row['collection']}（{row['desc']}）: {mark}")
+        plan_text = '\n'.join(plan_lines)
+
+        dm = delivery_queue.metrics()
+        uc = user_cache.stats()
         
         text = f"""🔍 <b>数据库诊断信息</b>
 
@@ -1684,6 +1543,18 @@ def diag_db(update: Update, context: CallbackContext):
 • 代理订单记录: {orders_count} 条
 • 提现申请: {withdrawal_count} 条（{pending_withdrawal_count} 条待处理）
 
+<b>🔎 热点查询计划</b>
+{plan_text}
+
+<b>📦 发货队列</b>
+• 排队 / 处理中 / 失败: {dm['pending']} / {dm['running']} / {dm['failed']}
+• 最久排队: {dm['oldest_pending_seconds']:.0f} 秒
+• 本次启动完成 {dm['done']} 单，重试 {dm['retried']} 次
+• 平均等待 {dm['avg_wait']:.1f} 秒，平均耗时 {dm['avg_latency']:.1f} 秒，P95 {dm['p95_latency']:.1f} 秒
+
+<b>👤 用户缓存</b>
+• 缓存用户: {uc['size']}，命中 {uc['hits']} / 未命中 {uc['misses']}（命中率 {uc['hit_rate']:.0%}）
+
 <b>⏰ 系统时间</b>
 • 当前时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
 
@@ -1701,6 +1572,117 @@ def diag_db(update: Update, context: CallbackContext):
         import traceback
         traceback.print_exc()
 
+def stock_reconcile(update: Update, context: CallbackContext):
+    """库存计数对账命令 - 从 hb 重算 stock_counters 并报告漂移"""
+    user_id = update.effective_user.id
+
+    if not multi_bot_system.is_master_admin(user_id):
+        update.message.reply_text("❌ 您没有权限使用此命令")
+        return
+
+    fix = not (context.args and context.args[0] == 'dry')
+    try:
+        started = time.time()
+        report = reconcile_stock_counters(fix=fix)
+        elapsed = time.time() - started
+
+        lines = [
+            "🧮 <b>库存计数对账</b>",
+            "",
+            f"• 商品: {report['products']} 个",
+            f"• 分类: {report['categories']} 个",
+            f"• 漂移: {len(report['drift'])} 条",
+            f"• 已修正: {'是' if report['fixed'] else '否'}",
+            f"• 耗时: {elapsed:.2f} 秒",
+        ]
+        for item in report['drift'][:20]:
+            expected = item['expected'] or {'available': 0, 'sold': 0}
+            actual = item['actual'] or {'available': 0, 'sold': 0}
+            lines.append(
+                f"<code>{item['_id']}</code> 库存 {actual['available']}→{expected['available']} "
+                f"已售 {actual['sold']}→{expected['sold']}"
+            )
+        if len(report['drift']) > 20:
+            lines.append(f"... 其余 {len(report['drift']) - 20} 条见日志")
+
+        update.message.reply_text('\n'.join(lines), parse_mode='HTML')
+    except Exception as e:
+        update.message.reply_text(f"❌ 库存对账失败：{e}")
+        logging.error(f"Stock reconcile failed: {e}")
+
+def verify_ledger(update: Update, context: CallbackContext):
+    """余额流水校验命令 - 按批并行核对每个用户的 USDT 与 快照 + 流水"""
+    user_id = update.effective_user.id
+
+    if not multi_bot_system.is_master_admin(user_id):
+        update.message.reply_text("❌ 您没有权限使用此命令")
+        return
+
+    update.message.reply_text("⏳ 正在校验余额流水...")
+    try:
+        lines = ["📒 <b>余额流水校验</b>", ""]
+        for report in verify_all_balances():
+            if report.get('error'):
+                lines.append(f"• <code>{report['scope']}</code> ❌ {report['error'][:80]}")
+                continue
+            problems = report['problems']
+            mark = '✅' if not problems else '❌'
+            lines.append(
+                f"• <code>{report['scope']}</code> {mark} 用户 {report['checked']}，一致 {report['ok']}，"
+                f"未记账 {report['untracked']}，异常 {len(problems)}（{report['seconds']:.1f} 秒）"
+            )
+            for item in problems[:10]:
+                lines.append(f"  <code>{item['user_id']}</code> {item['kind']}: {item['detail']}")
+            if len(problems) > 10:
+                lines.append(f"  ... 其余 {len(problems) - 10} 条见日志")
+            for item in problems:
+                logging.warning(f"⚠️ 余额流水异常：{report['scope']} {item['user_id']} {item['kind']} {item['detail']}")
+        update.message.reply_text('\n'.join(lines), parse_mode='HTML')
+    except Exception as e:
+        update.message.reply_text(f"❌ 余额校验失败：{e}")
+        logging.error(f"Ledger verify failed: {e}")
+
+def balance_at(update: Update, context: CallbackContext):
+    """历史余额查询命令 - /balance_at 用户ID 日期（YYYY-MM-DD，查询当天结束时的余额）"""
+    user_id = update.effective_user.id
+
+    if not multi_bot_system.is_master_admin(user_id):
+        update.message.reply_text("❌ 您没有权限使用此命令")
+        return
+
+    try:
+        target_id = int(context.args[0])
+        day = datetime.strptime(context.args[1], '%Y-%m-%d')
+    except (IndexError, ValueError):
+        update.message.reply_text("❌ 用法：/balance_at 用户ID 日期\n示例：/balance_at 123456789 2024-01-31")
+        return
+
+    as_of = day + timedelta(days=1) - timedelta(microseconds=1)
+    balance = user_balance_as_of(target_id, as_of)
+    if balance is None:
+        update.message.reply_text("❌ 查询失败，请查看日志")
+        return
+    update.message.reply_text(f"📒 用户 {target_id} 在 {context.args[1]} 结束时的余额：{standard_num(balance)} USDT")
+
+def balance_snapshot_job(context: CallbackContext):
+    """每日余额快照（总部 + 所有代理），同时补写丢失的最后一条流水"""
+    try:
+        snapshot_all_balances()
+    except Exception as e:
+        logging.error(f"❌ 每日余额快照失败：{e}")
+
+def ranking_refresh_job(context: CallbackContext):
+    """商品排行定时任务：购买/补货后或超过有效期时重新计算"""
+    rankings.refresh_if_needed()
+
+
+def stock_reconcile_job(context: CallbackContext):
+    """定时库存计数对账（每天低峰期执行）"""
+    try:
+        reconcile_stock_counters(fix=True)
+    except Exception as e:
+        logging.error(f"❌ 定时库存对账失败：{e}")
+
 def export_gmjlu_records(update: Update, context: CallbackContext):
     """导出用户购买记录 - 优化版"""
     query = update.callback_query
@@ -1877,7 +1859,7 @@ def sales_dashboard(update: Update, context: CallbackContext):
     user_id = query.from_user.id
 
     # 权限检查
-    uinfo = user.find_one({'user_id': user_id})
+    uinfo = load_user(context, user_id)
     if not uinfo or str(uinfo.get('state')) != '4':
         query.edit_message_text("❌ 无权限访问此功能")
         return
@@ -2012,7 +1994,7 @@ def stock_alerts(update: Update, context: CallbackContext):
     user_id = query.from_user.id
 
     # 权限检查
-    uinfo = user.find_one({'user_id': user_id})
+    uinfo = load_user(context, user_id)
     if not uinfo or str(uinfo.get('state')) != '4':
         query.edit_message_text("❌ 无权限访问此功能")
         return
@@ -2133,7 +2115,7 @@ def data_export_menu(update: Update, context: CallbackContext):
     user_id = query.from_user.id
 
     # 权限检查
-    uinfo = user.find_one({'user_id': user_id})
+    uinfo = load_user(context, user_id)
     if not uinfo or str(uinfo.get('state')) != '4':
         query.edit_message_text("❌ 无权限访问此功能")
         return
@@ -2243,7 +2225,7 @@ def export_users_comprehensive(update: Update, context: CallbackContext):
     user_id = query.from_user.id
 
     # 权限检查
-    uinfo = user.find_one({'user_id': user_id})
+    uinfo = load_user(context, user_id)
     if not uinfo or str(uinfo.get('state')) != '4':
         query.edit_message_text("❌ 无权限访问此功能")
         return
@@ -2322,7 +2304,7 @@ def export_orders_comprehensive(update: Update, context: CallbackContext):
     user_id = query.from_user.id
 
     # 权限检查
-    uinfo = user.find_one({'user_id': user_id})
+    uinfo = load_user(context, user_id)
     if not uinfo or str(uinfo.get('state')) != '4':
         query.edit_message_text("❌ 无权限访问此功能")
         return
@@ -2389,7 +2371,7 @@ def export_financial_data(update: Update, context: CallbackContext):
     user_id = query.from_user.id
 
     # 权限检查
-    uinfo = user.find_one({'user_id': user_id})
+    uinfo = load_user(context, user_id)
     if not uinfo or str(uinfo.get('state')) != '4':
         query.edit_message_text("❌ 无权限访问此功能")
         return
@@ -2501,7 +2483,7 @@ def export_inventory_data(update: Update, context: CallbackContext):
     user_id = query.from_user.id
 
     # 权限检查
-    uinfo = user.find_one({'user_id': user_id})
+    uinfo = load_user(context, user_id)
     if not uinfo or str(uinfo.get('state')) != '4':
         query.edit_message_text("❌ 无权限访问此功能")
         return
@@ -2629,7 +2611,7 @@ def multilang_management(update: Update, context: CallbackContext):
     user_id = query.from_user.id
 
     # 权限检查
-    uinfo = user.find_one({'user_id': user_id})
+    uinfo = load_user(context, user_id)
     if not uinfo or str(uinfo.get('state')) != '4':
         query.edit_message_text("❌ 无权限访问此功能")
         return
@@ -4275,7 +4257,7 @@ def search_goods(update: Update, context: CallbackContext):
         pass
 
     user_id = update.effective_user.id
-    lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
+    lang = user_lang(context, user_id)
     query = ' '.join(context.args).strip()
 
     if not query:
@@ -4283,32 +4265,10 @@ def search_goods(update: Update, context: CallbackContext):
         update.message.reply_text(msg)
         return
 
-    matched = list(ejfl.find({'projectname': {'$regex': query, '$options': 'i'}}))
     buttons = []
-    count = 0
-
-    for item in matched:
-        nowuid = item['nowuid']
-
-        # ✅ 排除分类被删除的商品
-        if not fenlei.find_one({'uid': item['uid']}):
-            continue
-
-        # ✅ 排除无库存商品
-        stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
-        if stock <= 0:
-            continue
-
-        # ✅ 排除未设置价格的商品
-        money = item.get('money', 0)
-        if money <= 0:
-            continue
-
-        pname = item['projectname'] if lang == 'zh' else get_fy(item['projectname'])
-        buttons.append([InlineKeyboardButton(f'🛒 购买「{pname}」', callback_data=f'gmsp {nowuid}:{stock}')])
-        count += 1
-        if count >= 10:
-            break
+    for item in search_products(query)[:10]:
+        pname = item['name'] if lang == 'zh' else get_fy(item['name'])
+        buttons.append([InlineKeyboardButton(f'🛒 购买「{pname}」', callback_data=f"gmsp {item['nowuid']}:{item['stock']}")])
 
     if not buttons:
         msg = "📭 没有找到与关键词匹配的商品" if lang == 'zh' else "📭 No items found matching your keyword"
@@ -4330,29 +4290,29 @@ def hot_goods(update: Update, context: CallbackContext):
         pass
 
     user_id = update.effective_user.id
-    user_lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
+    user_lang = (load_user(context, user_id) or {}).get('lang', 'zh')
 
-    sorted_items = sorted(
-        ejfl.find(),
-        key=lambda item: -hb.count_documents({'nowuid': item['nowuid'], 'state': 0})
-    )
+    # ✅ 排行榜预先计算：近7天销量优先，不足10个用库存排行补齐（已排除分类被删、未设置价格的商品）
+    ranked = rankings.top('sales_7d', 10)
+    seen = {entry['nowuid'] for entry in ranked}
+    for entry in rankings.top('stock', 20):
+        if len(ranked) >= 10:
+            break
+        if entry['nowuid'] not in seen:
+            ranked.append(entry)
+            seen.add(entry['nowuid'])
 
     buttons = []
 
-    for item in sorted_items[:10]:
-        nowuid = item['nowuid']
-        # 🛑 如果分类被删了，就跳过
-        if not fenlei.find_one({'uid': item['uid']}):
-            continue
-
-        # ✅ 跳过未设置价格的商品
-        money = item.get('money', 0)
-        if money <= 0:
+    for entry in ranked:
+        nowuid = entry['nowuid']
+        item = catalog.product(nowuid)
+        if not item:
             continue
 
         pname = item['projectname']
         pname = get_fy(pname) if user_lang == 'en' else pname
-        stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
+        stock = entry['stock']
         buttons.append([InlineKeyboardButton(f"🛒 {pname}", callback_data=f"gmsp {nowuid}:{stock}")])
 
     buttons.append([InlineKeyboardButton("❌ 关闭" if user_lang == 'zh' else "❌ Close", callback_data=f"close {user_id}")])
@@ -4371,24 +4331,20 @@ def new_goods(update: Update, context: CallbackContext):
         pass
 
     user_id = update.effective_user.id
-    user_lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
+    user_lang = (load_user(context, user_id) or {}).get('lang', 'zh')
 
-    latest_items = list(ejfl.find().sort([('_id', -1)]).limit(10))
     buttons = []
 
-    for item in latest_items:
-        nowuid = item['nowuid']
-        if not fenlei.find_one({'uid': item['uid']}):
-            continue
-
-        # ✅ 跳过未设置价格的商品
-        money = item.get('money', 0)
-        if money <= 0:
+    # ✅ 最新上架排行预先计算（已排除分类被删、未设置价格的商品）
+    for entry in rankings.top('newest', 10):
+        nowuid = entry['nowuid']
+        item = catalog.product(nowuid)
+        if not item:
             continue
 
         pname = item['projectname']
         pname = get_fy(pname) if user_lang == 'en' else pname
-        stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
+        stock = entry['stock']
         buttons.append([InlineKeyboardButton(f"🛒 {pname}", callback_data=f"gmsp {nowuid}:{stock}")])
 
     buttons.append([InlineKeyboardButton("❌ 关闭" if user_lang == 'zh' else "❌ Close", callback_data=f"close {user_id}")])
@@ -4408,7 +4364,7 @@ def help_command(update: Update, context: CallbackContext):
         pass
 
     user_id = update.effective_user.id
-    lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
+    lang = user_lang(context, user_id)
     
     # ✅ 从环境变量读取客服联系方式
     customer_service = os.getenv('CUSTOMER_SERVICE', '@lwmmm')
@@ -4474,7 +4430,7 @@ def huifu(update: Update, context: CallbackContext):
     bot_id = context.bot.id
     if chat.type == 'private':
         user_id = update.effective_user.id
-        user_list = user.find_one({"user_id": user_id})
+        user_list = load_user(context, user_id)
         replymessage = update.message.reply_to_message
         text = replymessage.text
         del_message(update.message)
@@ -4804,7 +4760,7 @@ def backstart(update: Update, context: CallbackContext):
     month_usdt = sum_usdt(month_start, now)
 
     total_users = user.count_documents({})
-    total_balance = sum(i.get('USDT', 0) for i in user.find({'USDT': {'$gt': 0}}))
+    total_balance = platform_balance_total()
 
     # ✅ 美化管理员控制台，使用树状结构
     admin_text = f'''
@@ -4864,7 +4820,7 @@ def gmaijilu(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
-    lang = user.find_one({'user_id': user_id})['lang']
+    lang = user_lang(context, user_id)
     df_id = int(query.data.replace('gmaijilu ', ''))
 
     # 查询最近10条记录
@@ -5010,7 +4966,7 @@ def gmainext(update: Update, context: CallbackContext):
     page = data.split(":")[1]
     df_id = int(data.split(':')[0])
     user_id = query.from_user.id
-    lang = user.find_one({'user_id': user_id})['lang']
+    lang = user_lang(context, user_id)
     keyboard = []
     text_list = []
     jilu_list = list(gmjlu.find({"user_id": df_id}, sort=[("timer", -1)], skip=int(page), limit=10))
@@ -5230,11 +5186,51 @@ def backgmjl(update: Update, context: CallbackContext):
     )
 
 
+def resend_order_archive(query, record):
+    """
+    按 file_id 重发订单压缩包（零上传）；file_id 被 Telegram 拒绝时按购买记录里的商品名重新打包，
+    从被拒绝的分卷开始补发（分卷数变了则全部重发），发送后把新的 file_id 写回 gmjlu
+    """
+    resent = 0
+    try:
+        for file_id in record['file_ids']:
+            query.message.reply_document(file_id)
+            resent += 1
+        return True
+    except telegram.error.BadRequest as e:
+        logging.warning(f"⚠️ 订单 {record['bianhao']} 的第 {resent + 1} 个 file_id 已失效，重新打包：{e}")
+
+    nowuid = record.get('nowuid')
+    if not nowuid or not record.get('items'):
+        return False
+    product_dir = f"./协议号/{nowuid}" if record['leixing'] == '协议号' else f"./号包/{nowuid}"
+    items = list(hb.find({'nowuid': nowuid, 'projectname': {'$in': record['items']}},
+                         {'projectname': 1, 'files': 1, '_id': 0}))
+    with delivery_queue.build_slot():
+        parts = build_archive_parts(item_entries(product_dir, items, record['leixing']))
+    if not parts:
+        return False
+    archive_name = f"{record['user_id']}_{record['bianhao']}"
+    # 分卷与上次一致时，前面已重发成功的分卷不再发送
+    file_ids = list(record['file_ids'][:resent]) if len(parts) == len(record['file_ids']) else []
+    try:
+        for index, part in enumerate(parts, 1):
+            if index <= len(file_ids):
+                continue
+            message = query.message.reply_document(part['file'], filename=part_filename(archive_name, index, len(parts)))
+            file_ids.append(message.document.file_id)
+    finally:
+        for part in parts:
+            part['file'].close()
+    gmjlu.update_one({'_id': record['_id']}, {'$set': {'file_ids': file_ids}})
+    return True
+
+
 def zcfshuo(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
-    lang = user.find_one({'user_id': user_id})['lang']
+    lang = user_lang(context, user_id)
     bianhao = query.data.replace('zcfshuo ', '')
 
     gmjlu_list = gmjlu.find_one({'bianhao': bianhao})
@@ -5266,6 +5262,12 @@ def zcfshuo(update: Update, context: CallbackContext):
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
 
+        # ✅ 发货队列发送的压缩包只保存 file_id（不落盘），直接按 file_id 重发，被拒绝时才重新打包
+        if gmjlu_list.get('file_ids'):
+            if not resend_order_archive(query, gmjlu_list):
+                context.bot.send_message(chat_id=user_id, text='❌ 文件已失效，请联系客服' if lang == 'zh' else '❌ File expired, please contact support')
+            return
+
         # ✅ 检查是否是有效的文件路径
         import os
         try:
@@ -5422,6 +5424,43 @@ def generate_24bit_uid():
     return hashed_uid[:24]
 
 
+def ingest_progress(context, user_id, message_id, title):
+    """批量上架进度回调：每写完一块更新一次进度消息"""
+    def progress(done, total):
+        try:
+            context.bot.edit_message_text(
+                chat_id=user_id,
+                message_id=message_id,
+                text=f'{title}\n\n✅ 入库进度：{int(done / total * 100)}%（{done}/{total}）'
+            )
+        except:
+            pass
+    return progress
+
+
+def pack_zip_items(zip_ref, pack):
+    """批量上架的 before_insert 回调：只把本块实际要写入的商品文件从压缩包写入打包存储并落盘"""
+    def write(items):
+        for item in items:
+            pack.add(item['projectname'], [(name, zip_ref.read(name)) for name in item.get('files', [])])
+        pack.flush()
+    return write
+
+
+def ingest_finish(context, user_id, message_id, title, result):
+    """批量上架完成后在进度消息中显示入库数量和速度"""
+    try:
+        context.bot.edit_message_text(
+            chat_id=user_id,
+            message_id=message_id,
+            text=f"{title}\n\n✅ 新增 {result['inserted']} 个，跳过 {result['skipped']} 个"
+                 f"（本批重复 {result['duplicates']} 个，库里已有 {result['existing']} 个）\n"
+                 f"⏱ 用时 {result['elapsed']:.1f} 秒，入库速度 {result['rate']:.0f} 个/秒"
+        )
+    except:
+        pass
+
+
 def newfl(update: Update, context: CallbackContext):
     query = update.callback_query
     user_id = query.from_user.id
@@ -5489,9 +5528,25 @@ def create_product(ejfl, projectname, price, uid):
         "nowuid": nowuid
     }
     ejfl.insert_one(product)
+    catalog_changed()
     return nowuid
 
 
+def product_admin_text(fl_pro, ej_projectname, money, nowuid):
+    """管理员商品卡片文本（库存、已售、销售额来自 product_admin_stats 一次聚合）"""
+    stats = product_admin_stats(nowuid)
+    return f'''
+主分类: {fl_pro}
+二级分类: {ej_projectname}
+
+价格: {money}U
+库存: {stats['available']}
+已售: {stats['sold']}
+销售额: {stats['revenue']}U
+最后售出: {stats['last_sale'] or '暂无'}
+    '''
+
+
 def fejxxi(update: Update, context: CallbackContext):
     query = update.callback_query
     user_id = query.from_user.id
@@ -5529,17 +5584,7 @@ def fejxxi(update: Update, context: CallbackContext):
         [InlineKeyboardButton('返回', callback_data=f'flxxi {uid}')]
     ]
 
-    kc = hb.count_documents({'nowuid': nowuid, 'state': 0})
-    ys = hb.count_documents({'nowuid': nowuid, 'state': 1})
-
-    fstext = f'''
-主分类: {fl_pro}
-二级分类: {ej_projectname}
-
-价格: {money}U
-库存: {kc}
-已售: {ys}
-    '''
+    fstext = product_admin_text(fl_pro, ej_projectname, money, nowuid)
 
     query.edit_message_text(
         text=fstext,
@@ -6292,7 +6337,7 @@ def zdycz(update: Update, context: CallbackContext):
     query = update.callback_query
     user_id = query.from_user.id
     query.answer()
-    lang = user.find_one({'user_id': user_id})['lang']
+    lang = user_lang(context, user_id)
     bot_id = context.bot.id
 
     if lang == 'zh':
@@ -6320,16 +6365,17 @@ def catejflsp(update: Update, context: CallbackContext):
         return
 
     user_id = query.from_user.id
-    user_data = user.find_one({'user_id': user_id})
+    user_data = load_user(context, user_id)
     lang = user_data.get('lang', 'zh')
 
     # 获取所有二级分类并根据库存排序，只显示有库存的商品
-    ej_list = ejfl.find({'uid': uid})
+    ej_list = catalog.products(uid)
+    stock_map = get_stock_snapshot(category=uid)['products']
     
     # ✅ 功能1：只显示有库存的商品
     filtered_ej_list = []
     for item in ej_list:
-        stock_count = hb.count_documents({'nowuid': item['nowuid'], 'state': 0})
+        stock_count = stock_map.get(item['nowuid'], {}).get('available', 0)
         if stock_count > 0:  # 只添加有库存的商品
             item['stock_count'] = stock_count
             filtered_ej_list.append(item)
@@ -6403,10 +6449,10 @@ def gmsp(update: Update, context: CallbackContext, nowuid=None, hsl="1"):
         send_func = update.message.reply_text
 
     # 查询用户语言
-    u = user.find_one({'user_id': user_id})
+    u = load_user(context, user_id)
     lang = u.get('lang', 'zh') if u else 'zh'
 
-    ejfl_list = ejfl.find_one({'nowuid': nowuid})
+    ejfl_list = catalog.product(nowuid)
     if not ejfl_list:
         return send_func("❌ 未找到该商品")
 
@@ -6420,7 +6466,7 @@ def gmsp(update: Update, context: CallbackContext, nowuid=None, hsl="1"):
         return send_func(error_msg)
 
     # ✅ 实时库存查询
-    stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
+    stock = get_product_stock(nowuid)
 
     answer()
     if lang == 'zh':
@@ -6468,7 +6514,7 @@ def gmsp(update: Update, context: CallbackContext, nowuid=None, hsl="1"):
 def gmqq(update: Update, context: CallbackContext):
     query = update.callback_query
     user_id = query.from_user.id
-    lang = user.find_one({'user_id': user_id})['lang']
+    lang = user_lang(context, user_id)
     data = query.data.replace('gmqq ', '')
     nowuid = data.split(':')[0]
     hsl = data.split(':')[1]
@@ -6488,7 +6534,7 @@ def gmqq(update: Update, context: CallbackContext):
         query.answer(error_msg, show_alert=True)
         return
 
-    user_list = user.find_one({'user_id': user_id})
+    user_list = load_user(context, user_id)
     USDT = user_list['USDT']
     if USDT < money:
         fstext = f'''
@@ -6594,6 +6640,7 @@ def ejfpaixu(update: Update, context: CallbackContext):
         ejfl.update_many({"row": row + 1, 'uid': uid}, {"$set": {'row': 99}})
         ejfl.update_many({"row": row, 'uid': uid}, {"$set": {'row': row + 1}})
         ejfl.update_many({"row": 99, 'uid': uid}, {"$set": {'row': row}})
+    catalog_changed()
 
     fl_pro = fenlei.find_one({'uid': uid})['projectname']
     keyboard = [[], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [],
@@ -6669,6 +6716,7 @@ def flpxyd(update: Update, context: CallbackContext):
         fenlei.update_many({"row": row + 1}, {"$set": {'row': 99}})
         fenlei.update_many({"row": row}, {"$set": {'row': row + 1}})
         fenlei.update_many({"row": 99}, {"$set": {'row': row}})
+    catalog_changed()
     keylist = list(fenlei.find({}, sort=[('row', 1)]))
     keyboard = [[], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [],
                 [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [],
@@ -6723,11 +6771,15 @@ def qrscejrow(update: Update, context: CallbackContext):
     nowuid = query.data.replace('qrscejrow ', '').split(':')[1]
     uid = ejfl.find_one({'nowuid': nowuid})['uid']
     bot_id = context.bot.id
+    removed_nowuids = [i['nowuid'] for i in ejfl.find({'uid': uid, "row": row}, {'nowuid': 1})]
     ejfl.delete_many({'uid': uid, "row": row})
     max_list = list(ejfl.find({'row': {"$gt": row}}))
     for i in max_list:
         max_row = i['row']
         ejfl.update_many({'uid': uid, 'row': max_row}, {"$set": {"row": max_row - 1}})
+    catalog_changed()
+    for removed_nowuid in removed_nowuids:
+        search_index_refresh_product(removed_nowuid)
 
     fl_pro = fenlei.find_one({'uid': uid})['projectname']
     keyboard = [[], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [], [],
@@ -6789,11 +6841,10 @@ def backzcd(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
-    lang = user.find_one({'user_id': user_id})['lang']
+    lang = user_lang(context, user_id)
 
     fenlei_data = list(fenlei.find({}, sort=[('row', 1)]))
-    ejfl_data = list(ejfl.find({}))
-    hb_data = list(hb.find({'state': 0}))
+    category_stock = get_category_stock()
 
     keyboard = [[] for _ in range(50)]
 
@@ -6802,10 +6853,7 @@ def backzcd(update: Update, context: CallbackContext):
         projectname = i['projectname']
         row = i['row']
 
-        hsl = sum(
-            1 for j in ejfl_data if j['uid'] == uid
-            for hb_item in hb_data if hb_item['nowuid'] == j['nowuid']
-        )
+        hsl = category_stock.get(uid, 0)
 
         display_name = projectname if lang == 'zh' else get_fy(projectname)
         label = f'{display_name} [{hsl}个]' if lang == 'zh' else f'{display_name} [{hsl}]'
@@ -6840,64 +6888,31 @@ def backzcd(update: Update, context: CallbackContext):
     )
 
 
+# ✅ 商品列表一级分类按钮（主菜单与回调共用）
+def build_category_buttons(lang: str) -> list:
+    """按 row 排序返回一级分类按钮，库存来自分类库存服务，0 库存也显示"""
+    category_stock = get_category_stock()
+    keyboard = []
+    for i in fenlei.find({}, {'uid': 1, 'projectname': 1}, sort=[('row', 1)]):
+        uid = i['uid']
+        stock = category_stock.get(uid, 0)
+        name = i['projectname'] if lang == 'zh' else get_fy(i['projectname'])
+        button_text = f'{name} [{stock}个]' if lang == 'zh' else f'{name} [{stock} items]'
+        keyboard.append([InlineKeyboardButton(button_text, callback_data=f'catejflsp {uid}:{stock}')])
+    return keyboard
+
+
 # ✅ 新增：返回商品列表的回调处理器
 def show_product_list(update: Update, context: CallbackContext):
     """处理返回商品列表的回调"""
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
-    user_data = user.find_one({'user_id': user_id})
+    user_data = load_user(context, user_id)
     lang = user_data.get('lang', 'zh')
 
-    fenlei_data = list(fenlei.find({}, sort=[('row', 1)]))
-    ejfl_data = list(ejfl.find({}))
-    hb_data = list(hb.find({'state': 0}))
-
     # ✅ 一级分类始终显示，显示库存数量（包括0）
-    keyboard = []
-    displayed_categories = []
-    
-    for i in fenlei_data:
-        uid = i['uid']
-        projectname = i['projectname']
-        row = i['row']
-        hsl = sum(
-            1 for j in ejfl_data if j['uid'] == uid
-            for hb_item in hb_data if hb_item['nowuid'] == j['nowuid']
-        )
-        
-        # ✅ 一级分类始终显示（不论库存多少）
-        projectname_display = projectname if lang == 'zh' else get_fy(projectname)
-        displayed_categories.append({
-            'name': projectname_display,
-            'stock': hsl,
-            'uid': uid,
-            'row': row
-        })
-    
-    # 按原有行号排序（保持管理员设置的顺序）
-    displayed_categories.sort(key=lambda x: x['row'])
-    
-    # 每行一个按钮
-    for cat in displayed_categories:
-        # ✅ 显示库存数量，0库存直接显示0
-        if cat['stock'] > 0:
-            if lang == 'zh':
-                button_text = f'{cat["name"]} [{cat["stock"]}个]'
-            else:
-                button_text = f'{cat["name"]} [{cat["stock"]} items]'
-        else:
-            if lang == 'zh':
-                button_text = f'{cat["name"]} [0个]'
-            else:
-                button_text = f'{cat["name"]} [0 items]'
-        
-        keyboard.append([
-            InlineKeyboardButton(
-                button_text, 
-                callback_data=f'catejflsp {cat["uid"]}:{cat["stock"]}'
-            )
-        ])
+    keyboard = build_category_buttons(lang)
 
     if lang == 'zh':
         fstext = (
@@ -6940,53 +6955,94 @@ def is_number(s):
 
     return False
 
-def dabaohao(context, user_id, folder_names, leixing, nowuid, erjiprojectname, fstext, yssj):
-    current_time = datetime.now()
-    formatted_time = current_time.strftime("%Y%m%d%H%M%S")
-    timestamp = str(current_time.timestamp()).replace(".", "")
-    bianhao = formatted_time + timestamp
+# ================================ 发货队列 ================================
+# qrgaimai 只写入 delivery_jobs，由 delivery_queue 的工作线程打包（内存中按上架清单分卷）、发送、记录购买记录
+# 任务重试时用同一个 bianhao：购买记录已存在说明上次已发送成功，不再重复发货；
+# 已发送的分卷 / 消息记录在任务的 progress 上，购买记录写入失败重试时不再重复发送
+
+def deliver_order_job(bot, job):
+    """发货任务处理函数，异常由 delivery_queue 负责退避重试"""
+    payload = job['payload']
+    user_id = payload['user_id']
+    folder_names = payload['folder_names']
+    leixing = payload['leixing']
+    nowuid = payload['nowuid']
+    erjiprojectname = payload['erjiprojectname']
+    fstext = payload['fstext']
+    bianhao = payload['bianhao']
+    amount = payload.get('amount')
     timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
     count = len(folder_names)
 
-    if leixing == '协议号':
-        zip_filename = f"./协议号发货/{user_id}_{int(time.time())}.zip"
-        with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for file_name in folder_names:
-                json_file = os.path.join(f"./协议号/{nowuid}", file_name + ".json")
-                session_file = os.path.join(f"./协议号/{nowuid}", file_name + ".session")
-                if os.path.exists(json_file):
-                    zipf.write(json_file, os.path.basename(json_file))
-                if os.path.exists(session_file):
-                    zipf.write(session_file, os.path.basename(session_file))
-        goumaijilua(leixing, bianhao, user_id, erjiprojectname, zip_filename, fstext, timer, count)
-        context.bot.send_document(chat_id=user_id, document=open(zip_filename, "rb"))
-
-    elif leixing == '直登号':
-        zip_filename = f"./发货/{user_id}_{int(time.time())}.zip"
-        with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for folder_name in folder_names:
-                base_path = os.path.join(f"./号包/{nowuid}", folder_name)
-                if os.path.exists(base_path):
-                    for root, dirs, files in os.walk(base_path):
-                        for file in files:
-                            full_path = os.path.join(root, file)
-                            rel_path = os.path.join(folder_name, os.path.relpath(full_path, base_path))
-                            zipf.write(full_path, rel_path)
-        goumaijilua(leixing, bianhao, user_id, erjiprojectname, zip_filename, fstext, timer, count)
-        context.bot.send_document(chat_id=user_id, document=open(zip_filename, "rb"))
-
-    elif leixing == 'API链接':
-        link_text = '\n'.join(folder_names)
-        context.bot.send_message(chat_id=user_id, text=link_text)
-        goumaijilua(leixing, bianhao, user_id, erjiprojectname, link_text, fstext, timer, count)
-
-    elif leixing == 'txt文本':
-        content = '\n'.join(folder_names)
-        context.bot.send_message(chat_id=user_id, text=content)
-        goumaijilua(leixing, bianhao, user_id, erjiprojectname, content, fstext, timer, count)
+    if gmjlu.find_one({'bianhao': bianhao}, {'_id': 1}):
+        logging.info(f"✅ 订单 {bianhao} 已发货，跳过重复任务")
+        return {'bianhao': bianhao, 'skipped': True}
+
+    if leixing in ('协议号', '直登号'):
+        product_dir = f"./协议号/{nowuid}" if leixing == '协议号' else f"./号包/{nowuid}"
+        items = list(hb.find({'nowuid': nowuid, 'projectname': {'$in': folder_names}},
+                             {'projectname': 1, 'files': 1, '_id': 0}))
+        with delivery_queue.build_slot():
+            parts = build_archive_parts(item_entries(product_dir, items, leixing))
+        if not parts:
+            raise RuntimeError(f"订单 {bianhao} 没有可打包的文件")
+        archive_name = f"{user_id}_{bianhao}"
+        progress = job.get('progress') or {}
+        # 上次尝试已发送的分卷（分卷数变了说明文件有变化，全部重新发送）
+        sent = (progress.get('file_ids') or {}) if progress.get('part_count') == len(parts) else {}
+        try:
+            delivery_queue.ensure_lease(job)
+            delivery_queue.record_progress(job, {'part_count': len(parts)})
+            for index, part in enumerate(parts, 1):
+                if str(index) in sent:
+                    continue
+                message = bot.send_document(chat_id=user_id, document=part['file'],
+                                            filename=part_filename(archive_name, index, len(parts)))
+                sent[str(index)] = message.document.file_id
+                delivery_queue.record_progress(job, {f'file_ids.{index}': sent[str(index)]})
+        finally:
+            for part in parts:
+                part['file'].close()
+        file_ids = [sent[str(index)] for index in range(1, len(parts) + 1)]
+        goumaijilua(leixing, bianhao, user_id, erjiprojectname, f"{archive_name}.zip", fstext, timer, count,
+                    nowuid=nowuid, amount=amount, file_ids=file_ids, items=folder_names, strict=True)
+        return {'bianhao': bianhao, 'parts': len(parts), 'file_ids': file_ids}
+
+    elif leixing in ('API链接', 'txt文本'):
+        text = '\n'.join(folder_names)
+        if not (job.get('progress') or {}).get('sent'):
+            delivery_queue.ensure_lease(job)
+            bot.send_message(chat_id=user_id, text=text)
+            delivery_queue.record_progress(job, {'sent': True})
+        goumaijilua(leixing, bianhao, user_id, erjiprojectname, text, fstext, timer, count, nowuid=nowuid, amount=amount,
+                    strict=True)
 
     else:
-        context.bot.send_message(chat_id=user_id, text=f"❌ 未知商品类型：{leixing}")
+        bot.send_message(chat_id=user_id, text=f"❌ 未知商品类型：{leixing}")
+    return {'bianhao': bianhao}
+
+
+delivery_queue = DeliveryQueue(delivery_jobs, deliver_order_job,
+                               workers=DELIVERY_WORKERS, build_slots=DELIVERY_BUILD_SLOTS)
+
+
+def dabaohao(user_id, folder_names, leixing, nowuid, erjiprojectname, fstext, yssj, amount=None):
+    """写入发货任务（原来每单一个 Timer 线程直接打包发送）"""
+    current_time = datetime.now()
+    formatted_time = current_time.strftime("%Y%m%d%H%M%S")
+    timestamp = str(current_time.timestamp()).replace(".", "")
+    bianhao = formatted_time + timestamp
+    return delivery_queue.enqueue(leixing, {
+        'user_id': user_id,
+        'folder_names': folder_names,
+        'leixing': leixing,
+        'nowuid': nowuid,
+        'erjiprojectname': erjiprojectname,
+        'fstext': fstext,
+        'yssj': yssj,
+        'amount': amount,
+        'bianhao': bianhao,
+    })
 
 
 
@@ -7001,10 +7057,10 @@ def qrgaimai(update: Update, context: CallbackContext):
     nowuid = data.split(':')[0]
     gmsl = int(data.split(':')[1])
     zxymoney = float(data.split(':')[2])
-    user_list = user.find_one({'user_id': user_id})
+    user_list = load_user(context, user_id)
     USDT = user_list['USDT']
     lang = user_list['lang']
-    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
+    kc = get_product_stock(nowuid)
     if kc < gmsl:
         kcbz = '当前库存不足' if lang == 'zh' else get_fy('当前库存不足')
         context.bot.send_message(chat_id=user_id, text=kcbz)
@@ -7013,25 +7069,35 @@ def qrgaimai(update: Update, context: CallbackContext):
         return
     keyboard = [[InlineKeyboardButton('✅已读（点击销毁此消息）', callback_data=f'close {user_id}')]]
     if USDT >= zxymoney:
-        now_price = standard_num(float(USDT) - float(zxymoney))
-        now_price = float(now_price) if str((now_price)).count('.') > 0 else int(standard_num(now_price))
-
-        ejfl_list = ejfl.find_one({'nowuid': nowuid})
+        ejfl_list = catalog.product(nowuid)
 
         fhtype = hb.find_one({'nowuid': nowuid})['leixing']
         projectname = ejfl_list['projectname']
         erjiprojectname = ejfl_list['projectname']
         yijiid = ejfl_list['uid']
-        yiji_list = fenlei.find_one({'uid': yijiid})
+        yiji_list = catalog.category(yijiid)
         yijiprojectname = yiji_list['projectname']
         fstext = ejfl_list['text']
         fstext = fstext if lang == 'zh' else get_fy(fstext)
+
+        # ✅ 扣款前原子占用库存：并发购买同一商品时同一件商品只会发给一个买家
+        timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+        claimed_items = reserve_stock(nowuid, gmsl, user_id, uid=yijiid,
+                                      leixing='谷歌' if fhtype == '谷歌' else None, sale_time=timer)
+        if len(claimed_items) < gmsl:
+            kcbz = '当前库存不足' if lang == 'zh' else get_fy('当前库存不足')
+            context.bot.send_message(chat_id=user_id, text=kcbz)
+            return
+
+        # ✅ 原子扣款：余额校验、扣款、累计消费、重置 sign 一次写入；并发点击时余额不足的一方扣款失败
+        now_price = debit_user_balance(user_id, zxymoney, inc={'zgje': zxymoney, 'zgsl': gmsl}, set_fields={'sign': 0},
+                                       reason='购买', ref=nowuid)
+        if now_price is None:
+            release_stock(claimed_items, nowuid=nowuid, uid=yijiid)
+            yebz = '❌ 余额不足，请及时充值！' if lang == 'zh' else '❌ Insufficient balance, please recharge in time!'
+            context.bot.send_message(chat_id=user_id, text=yebz)
+            return
         if fhtype == '协议号':
-            zgje = user_list['zgje']
-            zgsl = user_list['zgsl']
-            user.update_one({'user_id': user_id},
-                            {"$set": {'USDT': now_price, 'zgje': zgje + zxymoney, 'zgsl': zgsl + gmsl}})
-            user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
             del_message(query.message)
             # for j in list(hb.find({"nowuid": nowuid,'state': 0},limit=gmsl)):
             #     projectname = j['projectname']
@@ -7041,20 +7107,7 @@ def qrgaimai(update: Update, context: CallbackContext):
             #     hb.update_one({'hbid': hbid},{"$set":{'state': 1, 'yssj': timer, 'gmid': user_id}})
             #     folder_names.append(projectname)
 
-            query_condition = {"nowuid": nowuid, "state": 0}
-
-            pipeline = [
-                {"$match": query_condition},
-                {"$limit": gmsl}
-            ]
-            cursor = hb.aggregate(pipeline)
-            document_ids = [doc['_id'] for doc in cursor]
-            cursor = hb.aggregate(pipeline)
-            folder_names = [doc['projectname'] for doc in cursor]
-
-            timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-            update_data = {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}}
-            hb.update_many({"_id": {"$in": document_ids}}, update_data)
+            folder_names = [doc['projectname'] for doc in claimed_items]
 
             # timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
             # update_data = {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}}
@@ -7076,8 +7129,7 @@ def qrgaimai(update: Update, context: CallbackContext):
                 except:
                     pass
 
-            Timer(1, dabaohao,
-                  args=[context, user_id, folder_names, '协议号', nowuid, erjiprojectname, fstext, timer]).start()
+            dabaohao(user_id, folder_names, '协议号', nowuid, erjiprojectname, fstext, timer, zxymoney)
             # shijiancuo = int(time.time())
             # zip_filename = f"./协议号发货/{user_id}_{shijiancuo}.zip"
             # with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
@@ -7108,21 +7160,12 @@ def qrgaimai(update: Update, context: CallbackContext):
 
 
         elif fhtype == '谷歌':
-            zgje = user_list['zgje']
-            zgsl = user_list['zgsl']
-            user.update_one({'user_id': user_id},
-                            {"$set": {'USDT': now_price, 'zgje': zgje + zxymoney, 'zgsl': zgsl + gmsl}})
-            user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
             del_message(query.message)
 
             context.bot.send_message(chat_id=user_id, text=fstext, parse_mode='HTML', disable_web_page_preview=True,
                                      reply_markup=InlineKeyboardMarkup(keyboard))
             folder_names = []
-            for j in list(hb.find({"nowuid": nowuid, 'state': 0, 'leixing': '谷歌'}, limit=gmsl)):
-                projectname = j['projectname']
-                hbid = j['hbid']
-                timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-                hb.update_one({'hbid': hbid}, {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}})
+            for j in claimed_items:
                 data = j['data']
                 us1 = data['账户']
                 us2 = data['密码']
@@ -7147,7 +7190,7 @@ def qrgaimai(update: Update, context: CallbackContext):
             # 组合编号
             bianhao = formatted_time + timestamp
             timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-            goumaijilua('谷歌', bianhao, user_id, erjiprojectname, zip_filename, fstext, timer)
+            goumaijilua('谷歌', bianhao, user_id, erjiprojectname, zip_filename, fstext, timer, gmsl, nowuid=nowuid, amount=zxymoney)
 
             query.message.reply_document(open(zip_filename, "rb"))
 
@@ -7166,22 +7209,11 @@ def qrgaimai(update: Update, context: CallbackContext):
 
 
         elif fhtype == 'API':
-            zgje = user_list['zgje']
-            zgsl = user_list['zgsl']
-            user.update_one({'user_id': user_id},
-                            {"$set": {'USDT': now_price, 'zgje': zgje + zxymoney, 'zgsl': zgsl + gmsl}})
-            user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
             del_message(query.message)
 
             context.bot.send_message(chat_id=user_id, text=fstext, parse_mode='HTML', disable_web_page_preview=True,
                                      reply_markup=InlineKeyboardMarkup(keyboard))
-            folder_names = []
-            for j in list(hb.find({"nowuid": nowuid, 'state': 0}, limit=gmsl)):
-                projectname = j['projectname']
-                hbid = j['hbid']
-                timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-                hb.update_one({'hbid': hbid}, {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}})
-                folder_names.append(projectname)
+            folder_names = [j['projectname'] for j in claimed_items]
 
             shijiancuo = int(time.time())
 
@@ -7202,7 +7234,7 @@ def qrgaimai(update: Update, context: CallbackContext):
             bianhao = formatted_time + timestamp
             timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
             link_text = '\n'.join(folder_names)  # API链接内容应该是账号列表
-            goumaijilua('API链接', bianhao, user_id, erjiprojectname, link_text, fstext, timer)
+            goumaijilua('API链接', bianhao, user_id, erjiprojectname, link_text, fstext, timer, gmsl, nowuid=nowuid, amount=zxymoney)
 
             query.message.reply_document(open(zip_filename, "rb"))
 
@@ -7219,19 +7251,8 @@ def qrgaimai(update: Update, context: CallbackContext):
                 except:
                     pass
         elif fhtype == '会员链接':
-            zgje = user_list['zgje']
-            zgsl = user_list['zgsl']
-            user.update_one({'user_id': user_id},
-                            {"$set": {'USDT': now_price, 'zgje': zgje + zxymoney, 'zgsl': zgsl + gmsl}})
-            user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
             del_message(query.message)
-            folder_names = []
-            for j in list(hb.find({"nowuid": nowuid, 'state': 0}, limit=gmsl)):
-                projectname = j['projectname']
-                hbid = j['hbid']
-                timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-                hb.update_one({'hbid': hbid}, {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}})
-                folder_names.append(projectname)
+            folder_names = [j['projectname'] for j in claimed_items]
 
             context.bot.send_message(chat_id=user_id, text=fstext, parse_mode='HTML', disable_web_page_preview=True,
                                      reply_markup=InlineKeyboardMarkup(keyboard))
@@ -7249,7 +7270,7 @@ def qrgaimai(update: Update, context: CallbackContext):
             # 组合编号
             bianhao = formatted_time + timestamp
             timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-            goumaijilua('会员链接', bianhao, user_id, erjiprojectname, folder_names, fstext, timer, gmsl)
+            goumaijilua('会员链接', bianhao, user_id, erjiprojectname, folder_names, fstext, timer, gmsl, nowuid=nowuid, amount=zxymoney)
 
 
 
@@ -7268,11 +7289,6 @@ def qrgaimai(update: Update, context: CallbackContext):
                 except:
                     pass
         else:
-            zgje = user_list['zgje']
-            zgsl = user_list['zgsl']
-            user.update_one({'user_id': user_id},
-                            {"$set": {'USDT': now_price, 'zgje': zgje + zxymoney, 'zgsl': zgsl + gmsl}})
-            user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
             del_message(query.message)
 
             # folder_names = []
@@ -7283,20 +7299,7 @@ def qrgaimai(update: Update, context: CallbackContext):
             #     hb.update_one({'hbid': hbid}, {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}})
             #     folder_names.append(projectname)
 
-            query_condition = {"nowuid": nowuid, "state": 0}
-
-            pipeline = [
-                {"$match": query_condition},
-                {"$limit": gmsl}
-            ]
-            cursor = hb.aggregate(pipeline)
-            document_ids = [doc['_id'] for doc in cursor]
-            cursor = hb.aggregate(pipeline)
-            folder_names = [doc['projectname'] for doc in cursor]
-
-            timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-            update_data = {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}}
-            hb.update_many({"_id": {"$in": document_ids}}, update_data)
+            folder_names = [doc['projectname'] for doc in claimed_items]
 
             context.bot.send_message(chat_id=user_id, text=fstext, parse_mode='HTML', disable_web_page_preview=True,
                                      reply_markup=InlineKeyboardMarkup(keyboard))
@@ -7314,8 +7317,7 @@ def qrgaimai(update: Update, context: CallbackContext):
                 except:
                     pass
 
-            Timer(1, dabaohao,
-                  args=[context, user_id, folder_names, '直登号', nowuid, erjiprojectname, fstext, timer]).start()
+            dabaohao(user_id, folder_names, '直登号', nowuid, erjiprojectname, fstext, timer, zxymoney)
             # shijiancuo = int(time.time())
             # zip_filename = f"./发货/{user_id}_{shijiancuo}.zip"
             # with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
@@ -7364,6 +7366,17 @@ def qrgaimai(update: Update, context: CallbackContext):
         return
 
 
+def send_admin_archive(query, product_dir, items, leixing, archive_name):
+    """取出库存：在内存中按上架清单打包，超过 50MB 分卷发送"""
+    parts = build_archive_parts(item_entries(product_dir, items, leixing))
+    try:
+        for index, part in enumerate(parts, 1):
+            query.message.reply_document(part['file'], filename=part_filename(archive_name, index, len(parts)))
+    finally:
+        for part in parts:
+            part['file'].close()
+
+
 def qchuall(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
@@ -7379,34 +7392,22 @@ def qchuall(update: Update, context: CallbackContext):
     yiji_list = fenlei.find_one({'uid': yijiid})
     yijiprojectname = yiji_list['projectname']
 
+    # 只删除仍未售出（state 0）的库存，按实际删除数量调整库存计数
+    removed_count = 0
     folder_names = []
     if fhtype == '协议号':
-        for j in list(hb.find({"nowuid": nowuid, 'state': 0})):
-            projectname = j['projectname']
-            hbid = j['hbid']
-            timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-            hb.delete_one({'hbid': hbid})
-            folder_names.append(projectname)
-        shijiancuo = int(time.time())
-        zip_filename = f"./协议号发货/{user_id}_{shijiancuo}.zip"
-        with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-            # 将每个文件及其内容添加到 zip 文件中
-            for file_name in folder_names:
-                # 检查是否存在以 .json 或 .session 结尾的文件
-                json_file_path = os.path.join(f"./协议号/{nowuid}", file_name + ".json")
-                session_file_path = os.path.join(f"./协议号/{nowuid}", file_name + ".session")
-                if os.path.exists(json_file_path):
-                    zipf.write(json_file_path, os.path.basename(json_file_path))
-                if os.path.exists(session_file_path):
-                    zipf.write(session_file_path, os.path.basename(session_file_path))
-        query.message.reply_document(open(zip_filename, "rb"))
+        items = list(hb.find({"nowuid": nowuid, 'state': 0}, {'hbid': 1, 'projectname': 1, 'files': 1}))
+        send_admin_archive(query, f"./协议号/{nowuid}", items, '协议号', f"{user_id}_{int(time.time())}")
+        removed_count = hb.delete_many({'_id': {'$in': [j['_id'] for j in items]}, 'state': 0}).deleted_count
 
     elif fhtype == 'API':
         for j in list(hb.find({"nowuid": nowuid, 'state': 0})):
             projectname = j['projectname']
             hbid = j['hbid']
             timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-            hb.delete_one({'hbid': hbid})
+            if not hb.delete_one({'hbid': hbid, 'state': 0}).deleted_count:
+                continue
+            removed_count += 1
             folder_names.append(projectname)
 
         shijiancuo = int(time.time())
@@ -7423,7 +7424,9 @@ def qchuall(update: Update, context: CallbackContext):
             projectname = j['projectname']
             hbid = j['hbid']
             timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-            hb.update_one({'hbid': hbid}, {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}})
+            if not hb.update_one({'hbid': hbid, 'state': 0}, {"$set": {'state': 1, 'yssj': timer, 'gmid': user_id}}).modified_count:
+                continue
+            removed_count += 1
             data = j['data']
             us1 = data['账户']
             us2 = data['密码']
@@ -7447,38 +7450,19 @@ def qchuall(update: Update, context: CallbackContext):
             projectname = j['projectname']
             hbid = j['hbid']
             timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-            hb.delete_one({'hbid': hbid})
+            if not hb.delete_one({'hbid': hbid, 'state': 0}).deleted_count:
+                continue
+            removed_count += 1
             folder_names.append(projectname)
         folder_names = '\n'.join(folder_names)
 
         context.bot.send_message(chat_id=user_id, text=folder_names, disable_web_page_preview=True)
     else:
-        for j in list(hb.find({"nowuid": nowuid, 'state': 0})):
-            projectname = j['projectname']
-            hbid = j['hbid']
-            timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-            hb.delete_one({'hbid': hbid})
-            folder_names.append(projectname)
-
-        shijiancuo = int(time.time())
-        zip_filename = f"./发货/{user_id}_{shijiancuo}.zip"
-        with zipfile.ZipFile(zip_filename, "w", zipfile.ZIP_DEFLATED) as zipf:
-            # 将每个文件夹及其内容添加到 zip 文件中
-            for folder_name in folder_names:
-                full_folder_path = os.path.join(f"./号包/{nowuid}", folder_name)
-                if os.path.exists(full_folder_path):
-                    # 添加文件夹及其内容
-                    for root, dirs, files in os.walk(full_folder_path):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            # 使用相对路径在压缩包中添加文件，并设置压缩包内部的路径
-                            zipf.write(file_path,
-                                       os.path.join(folder_name, os.path.relpath(file_path, full_folder_path)))
-                else:
-                    # update.message.reply_text(f"文件夹 '{folder_name}' 不存在！")
-                    pass
+        items = list(hb.find({"nowuid": nowuid, 'state': 0}, {'hbid': 1, 'projectname': 1, 'files': 1}))
+        send_admin_archive(query, f"./号包/{nowuid}", items, fhtype, f"{user_id}_{int(time.time())}")
+        removed_count = hb.delete_many({'_id': {'$in': [j['_id'] for j in items]}, 'state': 0}).deleted_count
 
-        query.message.reply_document(open(zip_filename, "rb"))
+    adjust_stock_counters(nowuid, yijiid, available=-removed_count)
 
     ej_list = ejfl.find_one({'nowuid': nowuid})
     uid = ej_list['uid']
@@ -7498,16 +7482,7 @@ def qchuall(update: Update, context: CallbackContext):
          InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
         [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
     ]
-    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
-    fstext = f'''
-主分类: {fl_pro}
-二级分类: {ej_projectname}
-
-价格: {money}U
-库存: {kc}
-已售: {ys}
-    '''
+    fstext = product_admin_text(fl_pro, ej_projectname, money, nowuid)
     context.bot.send_message(chat_id=user_id, text=fstext, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
@@ -7519,7 +7494,7 @@ def qxdingdan(update: Update, context: CallbackContext):
     chat_id = chat.id
     user_id = query.from_user.id
 
-    topup.delete_one({'user_id': user_id})
+    drop_pending_topups(user_id)
     context.bot.delete_message(chat_id=query.from_user.id, message_id=query.message.message_id)
 
 def get_current_rate():
@@ -7547,7 +7522,7 @@ def textkeyboard(update: Update, context: CallbackContext):
         fullname = chat.full_name.replace('<', '').replace('>', '')
         reply_to_message_id = update.effective_message.message_id
         timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-        user_list = user.find_one({"user_id": user_id})
+        user_list = load_user(context, user_id)
         creation_time = user_list['creation_time']
         state = user_list['state']
         sign = user_list['sign']
@@ -7627,28 +7602,17 @@ def textkeyboard(update: Update, context: CallbackContext):
                         if hbsl > 100:
                             context.bot.send_message(chat_id=user_id, text='红包数量最大为100')
                             return
-                        user_list = user.find_one({"user_id": user_id})
-                        USDT = user_list['USDT']
-                        if USDT < money:
+                        if money < 0.01 * hbsl:
+                            context.bot.send_message(chat_id=user_id, text='每个红包至少 0.01 USDT')
+                            return
+                        # ✅ 先原子扣款（同时重置 sign），扣款成功才创建红包
+                        uid = generate_24bit_uid()
+                        if debit_user_balance(user_id, money, set_fields={'sign': 0}, reason='发红包', ref=uid) is None:
                             user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
                             context.bot.send_message(chat_id=user_id, text='⚠️ 操作失败，余额不足')
                             return
-                        user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
-                        uid = generate_24bit_uid()
                         timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-                        hongbao.insert_one({
-                            'uid': uid,
-                            'user_id': user_id,
-                            'fullname': fullname,
-                            'hbmoney': money,
-                            'hbsl': hbsl,
-                            'timer': timer,
-                            'state': 0
-                        })
-                        now_money = standard_num(USDT - money)
-                        now_money = float(now_money) if str((now_money)).count('.') > 0 else int(
-                            standard_num(now_money))
-                        user.update_one({'user_id': user_id}, {"$set": {'USDT': now_money}})
+                        create_red_packet(uid, user_id, fullname, money, hbsl, timer)
                         fstext = f'''
 🧧 <a href="tg://user?id={user_id}">{fullname}</a> 发送了一个红包
 💵总金额:{money} USDT💰 剩余:{hbsl}/{hbsl}
@@ -7682,31 +7646,46 @@ def textkeyboard(update: Update, context: CallbackContext):
                             pass
 
                         money = float(text)
-                        user_info = user.find_one({'user_id': user_id})
+                        user_info = load_user(context, user_id)
                         lang = user_info.get('lang', 'zh')
                         paytype = user_info.get('cz_paytype', 'usdt')
 
                         now = datetime.now()
                         timer = now.strftime('%Y%m%d%H%M%S')
                         timer_str = now.strftime('%Y-%m-%d %H:%M:%S')
-                        expire_str = (now + timedelta(minutes=10)).strftime('%Y-%m-%d %H:%M:%S')
+                        expire_at = now + timedelta(minutes=10)
+                        expire_str = expire_at.strftime('%Y-%m-%d %H:%M:%S')
 
-                        topup.delete_many({'user_id': user_id, 'status': 'pending'})
+                        drop_pending_topups(user_id)
 
-                        # 构建唯一金额（含随机尾数）
-                        while True:
-                            suijishu = round(random.uniform(0.01, 0.50), 2)
-                            if paytype == 'usdt':
-                                final_amount = float(Decimal(str(money)) + Decimal(str(suijishu)))
-                            else:
-                                rate = get_current_rate()
-                                if not rate or rate <= 0:
-                                    context.bot.send_message(chat_id=user_id, text="汇率错误，请稍后重试")
-                                    return
-                                final_amount = round(money * rate + suijishu, 2)
-
-                            if not topup.find_one({'money': final_amount, 'status': 'pending'}):
-                                break
+                        # 构建唯一金额（含随机尾数）；USDT 订单先写入占用金额，发送后补 message_id
+                        usdt_order = None
+                        if paytype == 'usdt':
+                            usdt_order = create_usdt_topup({
+                                'bianhao': timer,
+                                'user_id': user_id,
+                                'usdt': money,
+                                'time': now,
+                                'timer': timer_str,
+                                'expire_time': expire_str,
+                                'expire_at': expire_at,
+                            }, money)
+                            if usdt_order is None:
+                                context.bot.send_message(chat_id=user_id, text="系统繁忙，请稍后重试")
+                                return
+                            suijishu = usdt_order['suijishu']
+                            final_amount = usdt_order['money']
+                        else:
+                            rate = get_current_rate()
+                            if not rate or rate <= 0:
+                                context.bot.send_message(chat_id=user_id, text="汇率错误，请稍后重试")
+                                return
+                            allocated = allocate_rmb_amount(paytype, round(money * rate, 2))
+                            if allocated is None:
+                                context.bot.send_message(chat_id=user_id, text="系统繁忙，请稍后重试")
+                                return
+                            rmb_slot, suijishu, final_amount = allocated
+                            final_amount = round(final_amount, 2)
 
                         # USDT 模式：展示地址和二维码
                         if paytype == 'usdt':
@@ -7765,19 +7744,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                                     reply_markup=InlineKeyboardMarkup(keyboard)
                                 )
 
-                            topup.insert_one({
-                                'bianhao': timer,
-                                'user_id': user_id,
-                                'money': final_amount,
-                                'usdt': money,
-                                'cz_type': 'usdt',
-                                'status': 'pending',
-                                'suijishu': suijishu,
-                                'time': now,
-                                'timer': timer_str,
-                                'expire_time': expire_str,
-                                'message_id': msg.message_id
-                            })
+                            topup.update_one({'_id': usdt_order['_id']}, {'$set': {'message_id': msg.message_id}})
 
                         # 微信 / 支付宝 模式：生成二维码和支付链接
                         elif paytype in ['wechat', 'alipay']:
@@ -7806,6 +7773,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                                 qrcode_path = payment_data['qrcode_path']
                                 
                             except Exception as e:
+                                release_topup_slot({'amount_slot': rmb_slot})
                                 context.bot.send_message(chat_id=user_id, text=f"创建支付链接失败：{e}")
                                 return
 
@@ -7871,7 +7839,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                                     reply_markup=InlineKeyboardMarkup(keyboard)
                                 )
 
-                            topup.insert_one({
+                            rmb_order = {
                                 'bianhao': timer,
                                 'user_id': user_id,
                                 'money': final_amount,
@@ -7882,10 +7850,14 @@ def textkeyboard(update: Update, context: CallbackContext):
                                 'time': now,
                                 'timer': timer_str,
                                 'expire_time': expire_str,
+                                'expire_at': expire_at,
+                                'amount_slot': rmb_slot,
                                 'message_id': msg.message_id,
                                 'pay_url': pay_url,
                                 'qrcode_path': qrcode_path
-                            })
+                            }
+                            topup.insert_one(rmb_order)
+                            topup_expiry.schedule(rmb_order)
 
                         user.update_one({'user_id': user_id}, {"$set": {"sign": 0}})
                     else:
@@ -7910,7 +7882,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                     projectname = ejfl_list['projectname']
                     money = ejfl_list['money']
                     uid = ejfl_list['uid']
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
+                    kc = get_product_stock(nowuid)
                     if is_number(text):
                         gmsl = int(text)
                         zxymoney = standard_num(gmsl * money)
@@ -7986,6 +7958,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                         nowuid = sign.replace('upmoney ', '')
                         money = float(text) if text.count('.') > 0 else int(text)
                         ejfl.update_one({"nowuid": nowuid}, {"$set": {"money": money}})
+                        catalog_changed()
                         user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
 
                         ej_list = ejfl.find_one({'nowuid': nowuid})
@@ -8006,16 +7979,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                              InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
                             [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
                         ]
-                        kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                        ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
-                        fstext = f'''
-主分类: {fl_pro}
-二级分类: {ej_projectname}
-
-价格: {money}U
-库存: {kc}
-已售: {ys}
-                        '''
+                        fstext = product_admin_text(fl_pro, ej_projectname, money, nowuid)
                         context.bot.send_message(chat_id=user_id, text=fstext,
                                                  reply_markup=InlineKeyboardMarkup(keyboard))
 
@@ -8025,6 +7989,8 @@ def textkeyboard(update: Update, context: CallbackContext):
                 elif 'upejflname' in sign:
                     nowuid = sign.replace('upejflname ', '')
                     ejfl.update_one({"nowuid": nowuid}, {"$set": {"projectname": text}})
+                    catalog_changed()
+                    search_index_refresh_product(nowuid)
                     user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
                     uid = ejfl.find_one({'nowuid': nowuid})['uid']
                     fl_pro = fenlei.find_one({'uid': uid})['projectname']
@@ -8054,6 +8020,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                 elif 'upspname' in sign:
                     uid = sign.replace('upspname ', '')
                     fenlei.update_one({"uid": uid}, {"$set": {"projectname": text}})
+                    catalog_changed()
                     user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
 
                     keylist = list(fenlei.find({}, sort=[('row', 1)]))
@@ -8144,6 +8111,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                     nowuid = sign.replace('update_sysm ', '')
                     uid = ejfl.find_one({'nowuid': nowuid})['uid']
                     ejfl.update_one({"nowuid": nowuid}, {"$set": {'sysm': zxh}})
+                    catalog_changed()
                     fstext = f'''
 新的使用说明为:
 {zxh}
@@ -8169,21 +8137,13 @@ def textkeyboard(update: Update, context: CallbackContext):
                          InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
                         [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
                     ]
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
-                    fstext = f'''
-主分类: {fl_pro}
-二级分类: {ej_projectname}
-
-价格: {money}U
-库存: {kc}
-已售: {ys}
-                    '''
+                    fstext = product_admin_text(fl_pro, ej_projectname, money, nowuid)
                     context.bot.send_message(chat_id=user_id, text=fstext, reply_markup=InlineKeyboardMarkup(keyboard))
                 elif 'update_wbts' in sign:
                     nowuid = sign.replace('update_wbts ', '')
                     uid = ejfl.find_one({'nowuid': nowuid})['uid']
                     ejfl.update_one({"nowuid": nowuid}, {"$set": {'text': zxh}})
+                    catalog_changed()
                     fstext = f'''
 新的提示为:
 {zxh}
@@ -8209,16 +8169,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                          InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
                         [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
                     ]
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
-                    fstext = f'''
-主分类: {fl_pro}
-二级分类: {ej_projectname}
-
-价格: {money}U
-库存: {kc}
-已售: {ys}
-                    '''
+                    fstext = product_admin_text(fl_pro, ej_projectname, money, nowuid)
                     context.bot.send_message(chat_id=user_id, text=fstext, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
@@ -8235,12 +8186,10 @@ def textkeyboard(update: Update, context: CallbackContext):
                         return
 
                     progress_msg = context.bot.send_message(chat_id=user_id, text='📤 上传中，请勿重复操作...')
-                    count = 0
                     timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-                    total = len(lines)
-                    step = max(1, total // 10)
+                    items = []
 
-                    for idx, line in enumerate(lines, 1):
+                    for line in lines:
                         # ✅ 支持手机号|链接 转换为 手机号----链接
                         if '|' in line and '----' not in line:
                             parts = line.split('|')
@@ -8257,22 +8206,13 @@ def textkeyboard(update: Update, context: CallbackContext):
                         remark = '----'.join(parts[:-1]).strip()
 
                         if link.startswith('http'):
-                            if hb.find_one({'nowuid': nowuid, 'projectname': line}) is None:
-                                hbid = generate_24bit_uid()
-                                shangchuanhaobao('会员链接', uid, nowuid, hbid, line, timer, remark=remark)
-                                count += 1
-
-                        # 📊 进度反馈（每10%更新一次）
-                        if idx % step == 0 or idx == total:
-                            percent = int(idx / total * 100)
-                            try:
-                                context.bot.edit_message_text(
-                                    chat_id=user_id,
-                                    message_id=progress_msg.message_id,
-                                    text=f'📡 正在处理链接上传...\n\n✅ 当前进度：{percent}%'
-                                )
-                            except:
-                                pass
+                            items.append({'projectname': line, 'remark': remark})
+
+                    title = '📡 正在处理链接上传...'
+                    result = bulk_shangchuanhaobao('会员链接', uid, nowuid, items, timer,
+                                                   progress=ingest_progress(context, user_id, progress_msg.message_id, title))
+                    count = result['inserted']
+                    ingest_finish(context, user_id, progress_msg.message_id, title, result)
 
                     context.bot.send_message(chat_id=user_id, text=f'✅ 本次上传了 {count} 个链接')
                     user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
@@ -8297,17 +8237,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                         [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
                     ]
 
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
-
-                    fstext = f'''
-主分类: {fl_pro}
-二级分类: {ej_projectname}
-
-价格: {money}U
-库存: {kc}
-已售: {ys}
-                    '''
+                    fstext = product_admin_text(fl_pro, ej_projectname, money, nowuid)
                     context.bot.send_message(chat_id=user_id, text=fstext, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
@@ -8325,9 +8255,10 @@ def textkeyboard(update: Update, context: CallbackContext):
 
                     progress_msg = context.bot.send_message(chat_id=user_id, text='📤 上传中，请勿重复操作...')
 
-                    count = 0
                     timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-                    with zipfile.ZipFile(new_file_path, 'r') as zip_ref:
+                    manifests = {}  # 号包目录名 -> 文件（相对 号包/{nowuid}）
+                    # ✅ 写入打包存储 号包/{nowuid}.pack，不再解压成目录树
+                    with zipfile.ZipFile(new_file_path, 'r') as zip_ref, PackWriter(f'号包/{nowuid}') as pack:
                         file_list = zip_ref.infolist()
                         total = len(file_list)
                         step = max(1, total // 10)
@@ -8335,13 +8266,9 @@ def textkeyboard(update: Update, context: CallbackContext):
                         for idx, file_info in enumerate(file_list, 1):
                             match = re.match(r'^([^/\\]+)/.*$', file_info.filename)
                             if match:
-                                folder_name = match.group(1)
-                                if hb.find_one({'nowuid': nowuid, 'projectname': folder_name}) is None:
-                                    hbid = generate_24bit_uid()
-                                    shangchuanhaobao('直登号', uid, nowuid, hbid, folder_name, timer)
-                                    count += 1
-
-                            zip_ref.extract(file_info, f'号包/{nowuid}')
+                                files = manifests.setdefault(match.group(1), [])
+                                if not file_info.is_dir():
+                                    files.append(file_info.filename)
 
                             # 每10%进度更新
                             if idx % step == 0 or idx == total:
@@ -8355,6 +8282,15 @@ def textkeyboard(update: Update, context: CallbackContext):
                                 except:
                                     pass
 
+                        # 查重后只写入新号包的文件（重复的号包不写入，避免覆盖库存中同名号包的文件）
+                        items = [{'projectname': name, 'files': files} for name, files in manifests.items()]
+                        title = '📦 号包入库中...'
+                        result = bulk_shangchuanhaobao('直登号', uid, nowuid, items, timer,
+                                                       progress=ingest_progress(context, user_id, progress_msg.message_id, title),
+                                                       before_insert=pack_zip_items(zip_ref, pack))
+                    count = result['inserted']
+                    ingest_finish(context, user_id, progress_msg.message_id, title, result)
+
                     update.message.reply_text(f'🎉 解压并处理完成！本次上传了 {count} 个号包')
                     user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
 
@@ -8378,17 +8314,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                         [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
                     ]
 
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
-
-                    fstext = f'''
-主分类: {fl_pro}
-二级分类: {ej_projectname}
-
-价格: {money}U
-库存: {kc}
-已售: {ys}
-                    '''
+                    fstext = product_admin_text(fl_pro, ej_projectname, money, nowuid)
                     context.bot.send_message(chat_id=user_id, text=fstext, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
@@ -8421,32 +8347,16 @@ def textkeyboard(update: Update, context: CallbackContext):
                     matches = list(zip(login, password, submail))
 
                     timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-                    count = 0
-                    total = len(matches)
-                    step = max(1, total // 10)
-
-                    for idx, i in enumerate(matches, 1):
-                        login = i[0]
-                        password = i[1]
-                        submail = i[2]
-                        jihe12 = {'账户': login, '密码': password, '子邮件': submail}
-                        if hb.find_one({'nowuid': nowuid, 'projectname': login}) is None:
-                            hbid = generate_24bit_uid()
-                            shangchuanhaobao('谷歌', uid, nowuid, hbid, login, timer)
-                            hb.update_one({'hbid': hbid}, {"$set": {"leixing": '谷歌', 'data': jihe12}})
-                            count += 1
-
-                        # 每10%更新一次进度提示
-                        if idx % step == 0 or idx == total:
-                            percent = int(idx / total * 100)
-                            try:
-                                context.bot.edit_message_text(
-                                    chat_id=user_id,
-                                    message_id=progress_msg.message_id,
-                                    text=f'📥 正在处理谷歌账户...\n\n✅ 进度：{percent}%'
-                                )
-                            except:
-                                pass
+                    items = [
+                        {'projectname': login, 'data': {'账户': login, '密码': password, '子邮件': submail}}
+                        for login, password, submail in matches
+                    ]
+
+                    title = '📥 正在处理谷歌账户...'
+                    result = bulk_shangchuanhaobao('谷歌', uid, nowuid, items, timer,
+                                                   progress=ingest_progress(context, user_id, progress_msg.message_id, title))
+                    count = result['inserted']
+                    ingest_finish(context, user_id, progress_msg.message_id, title, result)
 
                     update.message.reply_text(f'处理完成！本次上传了{count}个谷歌号')
                     user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
@@ -8469,16 +8379,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                          InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
                         [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
                     ]
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
-                    fstext = f'''
-主分类: {fl_pro}
-二级分类: {ej_projectname}
-
-价格: {money}U
-库存: {kc}
-已售: {ys}
-                    '''
+                    fstext = product_admin_text(fl_pro, ej_projectname, money, nowuid)
                     context.bot.send_message(chat_id=user_id, text=fstext, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
@@ -8509,27 +8410,13 @@ def textkeyboard(update: Update, context: CallbackContext):
                             link_list.append(line.strip())
 
                     timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-                    count = 0
-                    total = len(link_list)
-                    step = max(1, total // 10)
-
-                    for idx, i in enumerate(link_list, 1):
-                        if hb.find_one({'nowuid': nowuid, 'projectname': i}) is None:
-                            hbid = generate_24bit_uid()
-                            shangchuanhaobao('API', uid, nowuid, hbid, i, timer)
-                            count += 1
-
-                        # 每10%更新一次进度提示
-                        if idx % step == 0 or idx == total:
-                            percent = int(idx / total * 100)
-                            try:
-                                context.bot.edit_message_text(
-                                    chat_id=user_id,
-                                    message_id=progress_msg.message_id,
-                                    text=f'📥 正在处理链接...\n\n✅ 进度：{percent}%'
-                                )
-                            except:
-                                pass
+                    items = [{'projectname': i} for i in link_list]
+
+                    title = '📥 正在处理链接...'
+                    result = bulk_shangchuanhaobao('API', uid, nowuid, items, timer,
+                                                   progress=ingest_progress(context, user_id, progress_msg.message_id, title))
+                    count = result['inserted']
+                    ingest_finish(context, user_id, progress_msg.message_id, title, result)
 
                     update.message.reply_text(f'处理完成！本次上传了{count}个api链接')
                     user.update_one({'user_id': user_id}, {"$set": {'sign': 0}})
@@ -8552,16 +8439,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                          InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
                         [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
                     ]
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
-                    fstext = f'''
-主分类: {fl_pro}
-二级分类: {ej_projectname}
-
-价格: {money}U
-库存: {kc}
-已售: {ys}
-                    '''
+                    fstext = product_admin_text(fl_pro, ej_projectname, money, nowuid)
                     context.bot.send_message(chat_id=user_id, text=fstext, reply_markup=InlineKeyboardMarkup(keyboard))
 
                 elif 'update_xyh' in sign:
@@ -8580,30 +8458,28 @@ def textkeyboard(update: Update, context: CallbackContext):
                     new_file_path = f'./临时文件夹/{filename}'
                     new_file.download(new_file_path)
 
-                    context.bot.send_message(chat_id=user_id, text='上传中，请勿重复操作')
+                    progress_msg = context.bot.send_message(chat_id=user_id, text='上传中，请勿重复操作')
                     # 解压缩文件
-                    count = 0
-                    tj_dict = {}
+                    manifests = {}  # 协议号 -> 解压出的 json / session（相对 协议号/{nowuid}）
                     timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-                    with zipfile.ZipFile(new_file_path, 'r') as zip_ref:
+                    # ✅ 写入打包存储 协议号/{nowuid}.pack，不再每个协议号解压两个散文件
+                    with zipfile.ZipFile(new_file_path, 'r') as zip_ref, PackWriter(f'协议号/{nowuid}') as pack:
                         for file_info in zip_ref.infolist():
                             filename = file_info.filename
                             if filename.endswith('.json') or filename.endswith('.session'):
-                                # 仅解压 session 或者 json 格式的文件
+                                # 仅保存 session 或者 json 格式的文件
                                 fli1 = filename.replace('.json', '').replace('.session', '')
-                                if fli1 not in tj_dict.keys():
-
-                                    hbid = generate_24bit_uid()
-                                    if hb.find_one({'nowuid': nowuid, 'projectname': fli1}) is None:
-                                        tj_dict[fli1] = 1
-                                        shangchuanhaobao('协议号', uid, nowuid, hbid, fli1, timer)
-
-                                zip_ref.extract(member=file_info, path=f'协议号/{nowuid}')
-                                pass
+                                manifests.setdefault(fli1, []).append(filename)
                             else:
                                 pass
-                    for i in tj_dict:
-                        count += 1
+                        items = [{'projectname': name, 'files': files} for name, files in manifests.items()]
+
+                        title = '📦 协议号入库中...'
+                        result = bulk_shangchuanhaobao('协议号', uid, nowuid, items, timer,
+                                                       progress=ingest_progress(context, user_id, progress_msg.message_id, title),
+                                                       before_insert=pack_zip_items(zip_ref, pack))
+                    count = result['inserted']
+                    ingest_finish(context, user_id, progress_msg.message_id, title, result)
 
                     update.message.reply_text(f'解压并处理完成！本次上传了{count}个协议号')
 
@@ -8627,16 +8503,7 @@ def textkeyboard(update: Update, context: CallbackContext):
                          InlineKeyboardButton('修改价格', callback_data=f'upmoney {nowuid}')],
                         [InlineKeyboardButton('❌关闭', callback_data=f'close {user_id}')]
                     ]
-                    kc = len(list(hb.find({'nowuid': nowuid, 'state': 0})))
-                    ys = len(list(hb.find({'nowuid': nowuid, 'state': 1})))
-                    fstext = f'''
-主分类: {fl_pro}
-二级分类: {ej_projectname}
-
-价格: {money}U
-库存: {kc}
-已售: {ys}
-                    '''
+                    fstext = product_admin_text(fl_pro, ej_projectname, money, nowuid)
                     context.bot.send_message(chat_id=user_id, text=fstext, reply_markup=InlineKeyboardMarkup(keyboard))
 
 
@@ -8837,7 +8704,7 @@ def textkeyboard(update: Update, context: CallbackContext):
             elif text == '发红包':
                 del_message(update.message)
 
-                lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
+                lang = user_lang(context, user_id)
 
                 if lang == 'zh':
                     fstext = "从下面的列表中选择一个红包"
@@ -8928,7 +8795,7 @@ def textkeyboard(update: Update, context: CallbackContext):
 
             elif text == 'TRX能量':
                 del_message(update.message)
-                lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
+                lang = user_lang(context, user_id)
                 
                 # ✅ 从环境变量读取TRX兑换地址
                 trx_address = os.getenv('TRX_EXCHANGE_ADDRESS', 'TSyYxxxxxxExampleAddrxxxxxYtR')
@@ -9078,7 +8945,7 @@ def textkeyboard(update: Update, context: CallbackContext):
             elif text == '⬅️ 返回主菜单' or text == '⬅️ Return to Main Menu':
                 del_message(update.message)
                 # 获取用户语言设置
-                uinfo = user.find_one({'user_id': user_id})
+                uinfo = load_user(context, user_id)
                 lang = uinfo.get('lang', 'zh')
                 
                 # ✅ 预设的主要按钮英文翻译
@@ -9210,55 +9077,8 @@ def textkeyboard(update: Update, context: CallbackContext):
 
             elif text == '🛒商品列表' or text == '🛒Product List':
                 del_message(update.message)
-                fenlei_data = list(fenlei.find({}, sort=[('row', 1)]))
-                ejfl_data = list(ejfl.find({}))
-                hb_data = list(hb.find({'state': 0}))
-
                 # ✅ 一级分类始终显示，显示库存数量（包括0）
-                keyboard = []
-                displayed_categories = []
-                
-                for i in fenlei_data:
-                    uid = i['uid']
-                    projectname = i['projectname']
-                    row = i['row']
-                    hsl = sum(
-                        1 for j in ejfl_data if j['uid'] == uid
-                        for hb_item in hb_data if hb_item['nowuid'] == j['nowuid']
-                    )
-                    
-                    # ✅ 一级分类始终显示（不论库存多少）
-                    projectname_display = projectname if lang == 'zh' else get_fy(projectname)
-                    displayed_categories.append({
-                        'name': projectname_display,
-                        'stock': hsl,
-                        'uid': uid,
-                        'row': row
-                    })
-                
-                # 按原有行号排序（保持管理员设置的顺序）
-                displayed_categories.sort(key=lambda x: x['row'])
-                
-                # 每行一个按钮
-                for cat in displayed_categories:
-                    # ✅ 显示库存数量，0库存直接显示0
-                    if cat['stock'] > 0:
-                        if lang == 'zh':
-                            button_text = f'{cat["name"]} [{cat["stock"]}个]'
-                        else:
-                            button_text = f'{cat["name"]} [{cat["stock"]} items]'
-                    else:
-                        if lang == 'zh':
-                            button_text = f'{cat["name"]} [0个]'
-                        else:
-                            button_text = f'{cat["name"]} [0 items]'
-                    
-                    keyboard.append([
-                        InlineKeyboardButton(
-                            button_text, 
-                            callback_data=f'catejflsp {cat["uid"]}:{cat["stock"]}'
-                        )
-                    ])
+                keyboard = build_category_buttons(lang)
 
                 if lang == 'zh':
                     fstext = (
@@ -9316,51 +9136,8 @@ def textkeyboard(update: Update, context: CallbackContext):
                 
                 query_text = text.strip()
                 
-                # ✅ 在商品名称中搜索关键词（支持模糊匹配）
-                matched_products = []
-                
-                # 搜索所有商品
-                for product in ejfl.find():
-                    nowuid = product['nowuid']
-                    uid = product.get('uid')
-                    
-                    # 跳过分类被删除的商品
-                    if not fenlei.find_one({'uid': uid}):
-                        continue
-                    
-                    # 检查库存
-                    stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
-                    if stock <= 0:
-                        continue
-                    
-                    # 检查价格
-                    money = product.get('money', 0)
-                    if money <= 0:
-                        continue
-                    
-                    # 关键词匹配逻辑（不区分大小写）
-                    product_name = product['projectname'].lower()
-                    query_lower = query_text.lower()
-                    
-                    # 支持多种匹配方式
-                    if (query_lower in product_name or 
-                        any(keyword in product_name for keyword in query_lower.split()) or
-                        # 支持数字匹配（如+86, +885等）
-                        query_text in product_name or
-                        # 支持国家名称匹配
-                        any(country in product_name for country in [query_text, query_lower])):
-                        
-                        # 获取分类信息
-                        category = fenlei.find_one({'uid': uid})
-                        category_name = category.get('projectname', '未知分类') if category else '未知分类'
-                        
-                        matched_products.append({
-                            'nowuid': nowuid,
-                            'name': product['projectname'],
-                            'category': category_name,
-                            'price': money,
-                            'stock': stock
-                        })
+                # ✅ 通过搜索索引匹配区号/国家名/关键词（支持模糊匹配），结果已合并库存
+                matched_products = search_products(query_text)
                 
                 # 处理查询结果
                 if not matched_products:
@@ -9439,12 +9216,14 @@ def check_stock_callback(update: Update, context: CallbackContext, page=0, lang=
 
     # 获取所有商品（过滤掉所属一级分类被删除的）
     all_goods = []
-    for g in ejfl.find().sort("row", 1):
+    goods_list = list(ejfl.find().sort("row", 1))
+    stock_map = get_stock_snapshot(nowuids=[g['nowuid'] for g in goods_list])['products']
+    for g in goods_list:
         nowuid = g['nowuid']
         uid = g.get('uid')
         if not fenlei.find_one({'uid': uid}):
             continue
-        stock_count = hb.count_documents({'nowuid': nowuid, 'state': 0})
+        stock_count = stock_map[nowuid]['available']
         if stock_count <= 0:
             continue
         g['stock'] = stock_count
@@ -9509,7 +9288,7 @@ def ck_page_callback(update: Update, context: CallbackContext):
     user_id = query.from_user.id
 
     # 🔧 从数据库获取用户语言偏好
-    lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
+    lang = user_lang(context, user_id)
     check_stock_callback(update, context, page=page, lang=lang)
 
 
@@ -9519,7 +9298,7 @@ def stock_page_handler(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
-    lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
+    lang = user_lang(context, user_id)
     page = int(query.data.split()[1])
     check_stock_callback(update, context, page, lang)
 
@@ -9529,58 +9308,10 @@ def show_product_list(update: Update, context: CallbackContext):
     query = update.callback_query
     query.answer()
     user_id = query.from_user.id
-    lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
+    lang = user_lang(context, user_id)
     
-    # 获取分类和商品数据
-    fenlei_data = list(fenlei.find({}, sort=[('row', 1)]))
-    ejfl_data = list(ejfl.find({}))
-    hb_data = list(hb.find({'state': 0}))
-
     # ✅ 一级分类始终显示，显示库存数量（包括0）
-    keyboard = []
-    displayed_categories = []
-    
-    for i in fenlei_data:
-        uid = i['uid']
-        projectname = i['projectname']
-        row = i['row']
-        hsl = sum(
-            1 for j in ejfl_data if j['uid'] == uid
-            for hb_item in hb_data if hb_item['nowuid'] == j['nowuid']
-        )
-        
-        # ✅ 一级分类始终显示（不论库存多少）
-        projectname_display = projectname if lang == 'zh' else get_fy(projectname)
-        displayed_categories.append({
-            'name': projectname_display,
-            'stock': hsl,
-            'uid': uid,
-            'row': row
-        })
-    
-    # 按原有行号排序（保持管理员设置的顺序）
-    displayed_categories.sort(key=lambda x: x['row'])
-    
-    # 每行一个按钮
-    for cat in displayed_categories:
-        # ✅ 显示库存数量，0库存直接显示0
-        if cat['stock'] > 0:
-            if lang == 'zh':
-                button_text = f'{cat["name"]} [{cat["stock"]}个]'
-            else:
-                button_text = f'{cat["name"]} [{cat["stock"]} items]'
-        else:
-            if lang == 'zh':
-                button_text = f'{cat["name"]} [0个]'
-            else:
-                button_text = f'{cat["name"]} [0 items]'
-        
-        keyboard.append([
-            InlineKeyboardButton(
-                button_text, 
-                callback_data=f'catejflsp {cat["uid"]}:{cat["stock"]}'
-            )
-        ])
+    keyboard = build_category_buttons(lang)
 
     if lang == 'zh':
         fstext = (
@@ -9617,7 +9348,7 @@ def czfs_callback(update: Update, context: CallbackContext):
     
     # 检查是否启用了微信支付宝功能
     if not ENABLE_ALIPAY_WECHAT and paytype in ['wechat', 'alipay']:
-        lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
+        lang = user_lang(context, user_id)
         if lang == 'zh':
             query.answer("❌ 微信支付宝功能已关闭，请选择USDT充值", show_alert=True)
         else:
@@ -9625,7 +9356,7 @@ def czfs_callback(update: Update, context: CallbackContext):
         return
     
     user.update_one({'user_id': user_id}, {'$set': {'cz_paytype': paytype}})
-    lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
+    lang = user_lang(context, user_id)
 
     if lang == 'zh':
         pay_map = {
@@ -9681,7 +9412,7 @@ def czback_callback(update: Update, context: CallbackContext):
     query.answer()
 
     user.update_one({'user_id': user_id}, {'$unset': {'cz_paytype': ""}})
-    lang = user.find_one({'user_id': user_id}).get('lang', 'zh')
+    lang = user_lang(context, user_id)
     
     # ✅ 从环境变量读取客服联系方式
     customer_service = os.getenv('CUSTOMER_SERVICE', '@lwmmm')
@@ -9782,7 +9513,7 @@ def czmoney_callback(update: Update, context: CallbackContext):
     query.answer()
     user_id = query.from_user.id
     amount = float(query.data.split()[1])
-    user_data = user.find_one({'user_id': user_id})
+    user_data = load_user(context, user_id)
     paytype = user_data.get('cz_paytype', 'wechat')
     lang = user_data.get('lang', 'zh')
 
@@ -9805,12 +9536,6 @@ def czmoney_callback(update: Update, context: CallbackContext):
     base_rmb = round(amount * USDT_TO_CNY, 2)
     bianhao = datetime.now().strftime('%Y%m%d') + str(int(time.time()))
 
-    while True:
-        suijishu = round(random.uniform(0.01, 0.50), 2)
-        final_rmb = round(base_rmb + suijishu, 2)
-        if not topup.find_one({"money": final_rmb, "status": "pending"}):
-            break
-
     # 删除旧订单
     old = topup.find_one({'user_id': user_id, 'status': 'pending'})
     if old:
@@ -9821,7 +9546,15 @@ def czmoney_callback(update: Update, context: CallbackContext):
                 context.bot.delete_message(chat_id=user_id, message_id=msg_id)
             except:
                 pass
-    topup.delete_many({'user_id': user_id, 'status': 'pending'})
+    drop_pending_topups(user_id)
+
+    # 分配唯一尾数（位图，O(1)）
+    allocated = allocate_rmb_amount(paytype, base_rmb)
+    if allocated is None:
+        query.answer("系统繁忙，请稍后重试", show_alert=True)
+        return
+    amount_slot, suijishu, final_rmb = allocated
+    final_rmb = round(final_rmb, 2)
 
     # 创建支付链接和二维码
     try:
@@ -9840,6 +9573,7 @@ def czmoney_callback(update: Update, context: CallbackContext):
         qrcode_path = payment_data['qrcode_path']
     except Exception as e:
         print(f"[错误] 创建支付链接和二维码失败：{e}")
+        release_topup_slot({'amount_slot': amount_slot})
         query.answer("支付通道异常，请稍后重试", show_alert=True)
         return
 
@@ -9914,10 +9648,11 @@ def czmoney_callback(update: Update, context: CallbackContext):
             )
         except Exception as e2:
             print(f"[错误] 发送支付消息失败：{e2}")
+            release_topup_slot({'amount_slot': amount_slot})
             return
 
     try:
-        topup.insert_one({
+        order = {
             'bianhao': bianhao,
             'user_id': user_id,
             'money': final_rmb,
@@ -9929,12 +9664,17 @@ def czmoney_callback(update: Update, context: CallbackContext):
             'status': 'pending',
             'cz_type': paytype,
             'expire_time': expire_str,
+            'expire_at': expire_time,
+            'amount_slot': amount_slot,
             'message_id': msg.message_id,
             'pay_url': pay_url,
             'qrcode_path': qrcode_path
-        })
+        }
+        topup.insert_one(order)
+        topup_expiry.schedule(order)
         print(f"[订单创建成功] 用户ID: {user_id} 金额: {final_rmb} 单号: {bianhao} 二维码: {qrcode_path}")
     except Exception as e:
+        release_topup_slot({'amount_slot': amount_slot})
         print(f"[错误] 插入订单失败：{e}")
 
 
@@ -9963,6 +9703,8 @@ def cancel_order_callback(update: Update, context: CallbackContext):
         pass
 
     topup.update_one({'_id': order['_id']}, {'$set': {'status': 'cancelled'}})
+    pending_recharges.discard(order.get('amount_micro'))
+    release_topup_slot(order)
 
     context.bot.send_message(chat_id=user_id, text="✅ 订单已取消 Order Cancelled.")
 
@@ -9976,28 +9718,36 @@ def yuecz(update: Update, context: CallbackContext):
     user_id = query.from_user.id
     bot_id = context.bot.id
 
-    user_data = user.find_one({'user_id': user_id})
+    user_data = load_user(context, user_id)
     lang = user_data.get('lang', 'zh')
 
     # 删除旧订单
-    topup.delete_many({'user_id': user_id, 'status': 'pending'})
+    drop_pending_topups(user_id)
 
     # 编号生成
     timer = time.strftime('%Y%m%d', time.localtime())
     bianhao = timer + str(int(time.time()))
 
-    # 随机尾数金额
-    while True:
-        suijishu = round(random.uniform(0.01, 0.50), 4)
-        total_money = float(Decimal(str(base_amount)) + Decimal(str(suijishu)))
-        if not topup.find_one({'money': total_money, 'status': 'pending'}):
-            break
-
     now = datetime.now()
     expire = now + timedelta(minutes=10)
     timer_str = now.strftime('%Y-%m-%d %H:%M:%S')
     expire_str = expire.strftime('%Y-%m-%d %H:%M:%S')
 
+    # 先写入订单占用唯一金额（随机尾数），再发送充值详情
+    order = create_usdt_topup({
+        'bianhao': bianhao,
+        'user_id': user_id,
+        'usdt': base_amount,
+        'timer': timer_str,
+        'expire_time': expire_str,
+        'expire_at': expire,
+        'time': now,                # ✅ MongoDB 可识别的时间字段
+    }, base_amount, digits=4)
+    if order is None:
+        context.bot.send_message(chat_id=user_id, text="系统繁忙，请稍后重试" if lang == 'zh' else "System busy, please try again")
+        return
+    total_money = order['money']
+
     trc20 = shangtext.find_one({'projectname': '充值地址'})['text']
 
     # ✅ 中文模板
@@ -10055,20 +9805,7 @@ def yuecz(update: Update, context: CallbackContext):
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
 
-    # 插入订单（补齐 cz_type、status、time 字段）
-    topup.insert_one({
-        'bianhao': bianhao,
-        'user_id': user_id,
-        'money': total_money,
-        'usdt': base_amount,
-        'suijishu': suijishu,
-        'timer': timer_str,
-        'expire_time': expire_str,
-        'time': now,                # ✅ MongoDB 可识别的时间字段
-        'cz_type': 'usdt',          # ✅ 正确标识 usdt 充值类型
-        'status': 'pending',
-        'message_id': message.message_id
-    })
+    topup.update_one({'_id': order['_id']}, {'$set': {'message_id': message.message_id}})
 
 
 
@@ -10078,7 +9815,7 @@ def handle_all_callbacks(update: Update, context: CallbackContext):
 
     # 查询用户语言
     try:
-        user_doc = user.find_one({'user_id': user_id})
+        user_doc = load_user(context, user_id)
         lang = user_doc.get('lang', 'zh') if user_doc else 'zh'
     except Exception as e:
         print(f"查询用户语言失败: {e}")
@@ -10984,53 +10721,89 @@ def jiexi(context: CallbackContext):
     trc20 = shangtext.find_one({'projectname': '充值地址'})['text']
 
     # 获取所有未处理的区块记录
-    qukuai_list = qukuai.find({'state': 0, 'to_address': trc20})
+    qukuai_list = list(qukuai.find({'state': 0, 'to_address': trc20}))
+    if not qukuai_list:
+        return
+
+    # ✅ 按整数 micro-USDT 精确匹配待支付订单，整批只查一次
+    for i in qukuai_list:
+        i['amount_micro'] = int(Decimal(str(i['quant'])))
+    orders = pending_recharges.match([i['amount_micro'] for i in qukuai_list])
 
     for i in qukuai_list:
         txid = i['txid']
-        quant = i['quant']
         from_address = i['from_address']
-        quant123 = Decimal(quant) / Decimal('1000000')
-        quant = float(quant123)
+        quant = from_micro(i['amount_micro'])
         today_money = quant
 
-        # 查找是否有相同金额的订单（带浮点误差容差 ±0.001）
-        dj_list = topup.find_one({
-            "money": {"$gte": round(quant - 0.001, 3), "$lte": round(quant + 0.001, 3)}
-        })
+        try:
+            dj_list = orders.get(i['amount_micro'])
+            if not dj_list:
+                # 上次结算在订单改为 success 之后中断：按 qukuai_id 找回订单继续入账
+                dj_list = pending_recharges.resume(qukuai, i)
+                if dj_list is None:
+                    # 暂未匹配到订单（订单可能刚创建、内存映射尚未刷新）：保留 state 0，超过订单有效期再标记失败
+                    if unmatched_expired(i):
+                        qukuai.update_one({'_id': i['_id'], 'state': 0}, {"$set": {"state": 2}})
+                    continue
+                user_list = user.find_one({'user_id': dj_list.get('user_id')})
+            else:
+                user_list = user.find_one({'user_id': dj_list['user_id']}) if 'user_id' in dj_list else None
+                if not user_list:
+                    # 未找到用户，标记为失败
+                    qukuai.update_one({'_id': i['_id'], 'state': 0}, {"$set": {"state": 2}})
+                    continue
 
-        if dj_list is not None and 'message_id' in dj_list and 'user_id' in dj_list:
-            message_id = dj_list['message_id']
-            user_id = dj_list['user_id']
+                # 原子结算：订单 pending -> success、转账 state 0 -> 1 都成功才入账，重复处理时直接跳过
+                if pending_recharges.settle(qukuai, i, dj_list) is None:
+                    continue
+        except Exception as e:
+            # 单笔结算失败不影响本批其他转账，qukuai 行保持 state 0 下一轮重试
+            print(f"❌ 充值结算失败：{txid} {e}")
+            continue
+        user_list = user_list or {}
+        release_topup_slot(dj_list)
+        user_id = dj_list['user_id']
 
-            # 删除原始充值详情消息
+        # 删除原始充值详情消息（兼容新旧字段名）
+        message_id = dj_list.get('message_id') or dj_list.get('msg_id')
+        if message_id:
             try:
                 context.bot.delete_message(chat_id=user_id, message_id=message_id)
             except Exception as e:
                 print(f"⚠️ 删除充值详情消息失败：{e}")
 
-            # 获取用户信息
-            user_list = user.find_one({'user_id': user_id})
-            if not user_list:
-                qukuai.update_one({'txid': txid}, {"$set": {"state": 2}})
-                continue
-
-            username = user_list.get('username', '无')
-            fullname = user_list.get('fullname', '无').replace('<', '').replace('>', '')
-            old_usdt = float(user_list.get('USDT', 0))
+        username = user_list.get('username', '无')
+        fullname = user_list.get('fullname', '无').replace('<', '').replace('>', '')
 
-            # 更新余额
-            now_price = standard_num(old_usdt + quant)
-            now_price = float(now_price) if '.' in str(now_price) else int(now_price)
-            user.update_one({'user_id': user_id}, {"$set": {'USDT': now_price}})
+        # 更新余额（原子入账，返回入账后的余额）
+        new_balance = credit_user_balance(user_id, quant, reason='USDT充值', ref=txid)
+        if new_balance is None:
+            # 订单和转账都已标记成功但余额没有写入：记录到订单上并通知管理员人工补账，不自动重试（避免重复入账）
+            topup.update_one({'_id': dj_list['_id']}, {'$set': {'credit_failed': True}})
+            alert_text = f'''
+❗️ <b>充值入账失败，请人工补账</b>
+用户: <a href="tg://user?id={user_id}">{fullname}</a> @{username}
+充值: {today_money} USDT
+订单: <code>{dj_list.get('bianhao', dj_list['_id'])}</code>
+<a href="https://tronscan.org/#/transaction/{txid}">充值详细</a>
+            '''
+            for admin in user.find({'state': '4'}):
+                try:
+                    context.bot.send_message(chat_id=admin['user_id'], text=alert_text, parse_mode='HTML',
+                                             disable_web_page_preview=True)
+                except:
+                    continue
+            continue
+        now_price = standard_num(new_balance)
 
-            # 写入充值日志
-            timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-            order_id = str(uuid.uuid4())
-            user_logging(order_id, '充值', user_id, today_money, timer)
+        # 写入充值日志
+        timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+        order_id = str(uuid.uuid4())
+        user_logging(order_id, '充值', user_id, today_money, timer)
 
-            # 用户通知
-            user_text = f'''
+        # 用户通知
+        user_text = f'''
 <b>🎉 恭喜您，成功充值！</b> 💰
 
 <b>充值金额:</b> <u>{today_money} USDT</u>  
@@ -11039,63 +10812,34 @@ def jiexi(context: CallbackContext):
 
 <b>您的账户余额:</b> <b>{now_price} USDT</b>  
 <b>祝您一切顺利！</b> 🥳💫
-            '''
-            close_btn = InlineKeyboardMarkup([
-                [InlineKeyboardButton("❌ 关闭", callback_data="close")]
-            ])
-            context.bot.send_message(
-                chat_id=user_id,
-                text=user_text,
-                parse_mode='HTML',
-                reply_markup=close_btn
-            )
+        '''
+        close_btn = InlineKeyboardMarkup([
+            [InlineKeyboardButton("❌ 关闭", callback_data="close")]
+        ])
+        context.bot.send_message(
+            chat_id=user_id,
+            text=user_text,
+            parse_mode='HTML',
+            reply_markup=close_btn
+        )
 
-            # 通知管理员
-            admin_text = f'''
+        # 通知管理员
+        admin_text = f'''
 用户: <a href="tg://user?id={user_id}">{fullname}</a> @{username} 充值成功
 地址: <code>{from_address}</code>
 充值: {today_money} USDT
 <a href="https://tronscan.org/#/transaction/{txid}">充值详细</a>
-            '''
-            for admin in user.find({'state': '4'}):
-                try:
-                    context.bot.send_message(
-                        chat_id=admin['user_id'],
-                        text=admin_text,
-                        parse_mode='HTML',
-                        disable_web_page_preview=True
-                    )
-                except:
-                    continue
-
-            # 删除订单消息，更新订单状态为成功
-            existing_order = topup.find_one({'user_id': user_id, 'status': 'pending'})
-            if existing_order:
-                # 兼容新旧字段名
-                msg_id = existing_order.get('message_id') or existing_order.get('msg_id')
-                if msg_id:
-                    try:
-                        context.bot.delete_message(chat_id=user_id, message_id=msg_id)
-                    except:
-                        pass
-            
-            # 更新订单状态为成功（不删除，用于收入统计）
-            topup.update_one(
-                {'user_id': user_id, 'status': 'pending'}, 
-                {
-                    '$set': {
-                        'status': 'success',
-                        'success_time': datetime.now(),
-                        'txid': txid,
-                        'from_address': from_address
-                    }
-                }
-            )
-            qukuai.update_one({'txid': txid}, {"$set": {"state": 1}})
-
-        else:
-            # 未找到订单或字段缺失，标记为失败
-            qukuai.update_one({'txid': txid}, {"$set": {"state": 2}})
+        '''
+        for admin in user.find({'state': '4'}):
+            try:
+                context.bot.send_message(
+                    chat_id=admin['user_id'],
+                    text=admin_text,
+                    parse_mode='HTML',
+                    disable_web_page_preview=True
+                )
+            except:
+                continue
 
 def validate_txid_format(txid: str) -> bool:
     """
@@ -11322,56 +11066,32 @@ def handle_admin_txhash_message(update: Update, context: CallbackContext):
     )
     return
 
-def jianceguoqi(context: CallbackContext):
-    while True:
-        for i in topup.find({}):
-            # 忽略没有 message_id 的数据
-            if 'message_id' not in i:
-                continue
+def expire_topups(context: CallbackContext):
+    """删除到期的待支付充值订单并通知用户（只处理到期的订单，不扫描整个 topup）"""
+    for order in topup_expiry.pop_expired():
+        release_topup_slot(order)
+        user_id = order.get('user_id')
+        bianhao = order.get('bianhao', '')
 
+        # 删除原来的充值页面（兼容新旧字段名）
+        message_id = order.get('message_id') or order.get('msg_id')
+        if message_id:
             try:
-                timer = i['timer']
-                bianhao = i['bianhao']
-                user_id = i['user_id']
-                message_id = i['message_id']
-
-                dt = datetime.strptime(timer, '%Y-%m-%d %H:%M:%S')
-                new_dt = dt + timedelta(minutes=10)
-                current_time = datetime.now()
-
-                if current_time >= new_dt:
-                    # 删除原来的充值页面
-                    try:
-                        context.bot.delete_message(chat_id=user_id, message_id=message_id)
-                    except Exception as e:
-                        print(f"⚠️ 删除旧支付消息失败：{e}")
-
-                    # 发送一条新的通知说明
-                    keyboard = [[InlineKeyboardButton("✅已读（点击销毁此消息）", callback_data=f'close {user_id}')]]
-                    try:
-                        context.bot.send_message(
-                            chat_id=user_id,
-                            text=f"❌ <b>订单超时</b>\n\n订单号：<code>{bianhao}</code>\n状态：<b>支付超时或金额错误</b>",
-                            parse_mode='HTML',
-                            reply_markup=InlineKeyboardMarkup(keyboard)
-                        )
-                    except Exception as e:
-                        print(f"⚠️ 发送超时通知失败：{e}")
-
-                    # 删除订单记录
-                    topup.delete_one({'_id': i['_id']})
-
+                context.bot.delete_message(chat_id=user_id, message_id=message_id)
             except Exception as e:
-                print(f"⚠️ 检查超时订单失败：{e}")
-
-        time.sleep(3)
-
-def suoyouchengxu(context: CallbackContext):
-    Timer(1, jianceguoqi, args=[context]).start()
+                print(f"⚠️ 删除旧支付消息失败：{e}")
 
-    job = context.job_queue.get_jobs_by_name('suoyouchengxu')
-    if job != ():
-        job[0].schedule_removal()
+        # 发送一条新的通知说明
+        keyboard = [[InlineKeyboardButton("✅已读（点击销毁此消息）", callback_data=f'close {user_id}')]]
+        try:
+            context.bot.send_message(
+                chat_id=user_id,
+                text=f"❌ <b>订单超时</b>\n\n订单号：<code>{bianhao}</code>\n状态：<b>支付超时或金额错误</b>",
+                parse_mode='HTML',
+                reply_markup=InlineKeyboardMarkup(keyboard)
+            )
+        except Exception as e:
+            print(f"⚠️ 发送超时通知失败：{e}")
 
 def fbgg(update: Update, context: CallbackContext):
     chat = update.effective_chat
@@ -11379,7 +11099,7 @@ def fbgg(update: Update, context: CallbackContext):
         return
 
     user_id = chat.id
-    user_data = user.find_one({'user_id': user_id})
+    user_data = load_user(context, user_id)
 
     if not user_data:
         context.bot.send_message(chat_id=user_id, text="❌ 你还未注册，无法使用该功能")
@@ -11490,7 +11210,7 @@ def adm(update: Update, context: CallbackContext):
     text = update.message.text
     text_parts = text.split(' ')
 
-    user_data = user.find_one({'user_id': user_id})
+    user_data = load_user(context, user_id)
     if not user_data or user_data.get('state') != '4':
         return
 
@@ -11526,14 +11246,17 @@ def adm(update: Update, context: CallbackContext):
         return
 
     timer = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
-    current_balance = target_user.get('USDT', 0)
-    new_balance = round(current_balance + amount, 2) if is_add else round(current_balance - amount, 2)
 
-    # 更新数据库
+    # 更新数据库（原子加减并记录流水，扣款允许扣成负数，与原来一致）
     order_id = generate_24bit_uid()
     action = '充值' if is_add else '扣款'
+    new_balance = credit_user_balance(target_id, amount if is_add else -amount,
+                                      reason=f'管理员{action}', ref=order_id)
+    if new_balance is None:
+        context.bot.send_message(chat_id=user_id, text="❌ 余额更新失败，请稍后重试")
+        return
+    new_balance = standard_num(new_balance)
     user_logging(order_id, action, target_id, amount, timer)
-    user.update_one({'user_id': target_id}, {'$set': {'USDT': new_balance}})
 
     # 发送给管理员
     admin_text = f"""
@@ -11577,7 +11300,7 @@ def cha(update: Update, context: CallbackContext):
         lastname = chat['last_name']
         text = update.message.text
         text1 = text.split(' ')
-        user_list = user.find_one({'user_id': user_id})
+        user_list = load_user(context, user_id)
         USDT = user_list['USDT']
         state = user_list['state']
         if state == '4':
@@ -13300,7 +13023,8 @@ def handle_adjust_balance_command(update: Update, context: CallbackContext):
         print(f"🔍 余额计算: old_balance={old_balance}, new_balance={new_balance}, amount_change={amount_change}")
         
         # 更新用户余额
-        success = update_agent_bot_user_balance(agent_bot_id, target_user_id, amount_change)
+        success = update_agent_bot_user_balance(agent_bot_id, target_user_id, amount_change,
+                                                reason=f'管理员调整:{operation}')
         
         # 在 handle_adjust_balance_command 函数的成功部分，替换通知部分：
         
@@ -14343,7 +14067,8 @@ def handle_user_balance_set(update: Update, context: CallbackContext):
             success = update_agent_bot_user_balance(
                 target_agent_id, 
                 target_user_id,
-                amount
+                amount,
+                reason='/uset'
             )
             
             if success:
@@ -14455,7 +14180,8 @@ def handle_user_balance_set(update: Update, context: CallbackContext):
         success = update_agent_bot_user_balance(
             bot['agent_bot_id'], 
             target_user_id,
-            amount
+            amount,
+            reason='/uset'
         )
         
         if success:
@@ -14576,7 +14302,8 @@ def handle_uset_callback(update: Update, context: CallbackContext):
         success = update_agent_bot_user_balance(
             agent_bot_id,
             target_user_id,
-            amount
+            amount,
+            reason='/uset'
         )
         
         if success:
@@ -14754,6 +14481,9 @@ def main():
     dispatcher.add_handler(CommandHandler("admin_add", admin_add, run_async=True))
     dispatcher.add_handler(CommandHandler("admin_remove", admin_remove, run_async=True))
     dispatcher.add_handler(CommandHandler("diag_db", diag_db, run_async=True))  # Database diagnostics
+    dispatcher.add_handler(CommandHandler("stock_reconcile", stock_reconcile, run_async=True))  # 库存计数对账
+    dispatcher.add_handler(CommandHandler("verify_ledger", verify_ledger, run_async=True))  # 余额流水校验
+    dispatcher.add_handler(CommandHandler("balance_at", balance_at, run_async=True))  # 历史余额查询
     # 🆕 用户提现管理命令
     dispatcher.add_handler(CommandHandler("my_withdrawals", check_my_withdrawals, run_async=True))
     # 在main()函数的dispatcher部分添加：
@@ -14855,7 +14585,7 @@ def main():
     dispatcher.add_handler(CallbackQueryHandler(zcfshuo, pattern='zcfshuo'))
     dispatcher.add_handler(CallbackQueryHandler(gmainext, pattern='gmainext '))
     # 添加页码信息处理器（不执行任何操作，只是防止错误）
-    dispatcher.add_handler(CallbackQueryHandler(lambda update, context: update.callback_query.answer("页码信息" if user.find_one({'user_id': update.callback_query.from_user.id}).get('lang', 'zh') == 'zh' else "Page Info"), pattern='page_info'))
+    dispatcher.add_handler(CallbackQueryHandler(lambda update, context: update.callback_query.answer("页码信息" if user_lang(context, update.callback_query.from_user.id) == 'zh' else "Page Info"), pattern='page_info'))
     dispatcher.add_handler(CallbackQueryHandler(update_txt, pattern='update_txt '))
     dispatcher.add_handler(CallbackQueryHandler(backgmjl, pattern='backgmjl '))
     dispatcher.add_handler(CallbackQueryHandler(qchuall, pattern='qchuall '))
@@ -14965,8 +14695,17 @@ def main():
     # handle_admin_txhash_message 放在组1，用于处理管理员输入交易哈希
     # ✅ 添加 Filters.private 使 filter 更精确，只处理私聊消息  
     dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command & Filters.private, handle_admin_txhash_message, run_async=True), group=1)
-    updater.job_queue.run_repeating(suoyouchengxu, 1, 1, name='suoyouchengxu')
+    # 待支付充值订单到期：启动时按索引重建到期堆，之后只处理到期的订单
+    try:
+        logging.info(f"✅ 待支付充值订单 {topup_expiry.rebuild()} 个已加入到期调度")
+    except Exception as e:
+        logging.error(f"❌ 重建充值订单到期调度失败：{e}")
+    updater.job_queue.run_repeating(expire_topups, 3, 1, name='expire_topups')
     updater.job_queue.run_repeating(jiexi, 3, 1, name='chongzhi')
+    updater.job_queue.run_daily(stock_reconcile_job, dt_time(4, 30), name='stock_reconcile')
+    updater.job_queue.run_repeating(ranking_refresh_job, 60, 30, name='ranking_refresh')
+    updater.job_queue.run_daily(balance_snapshot_job, dt_time(0, 5), name='balance_snapshot')
+    delivery_queue.start(updater.bot)
     updater.start_polling(timeout=BOT_TIMEOUT)
     updater.idle()
 
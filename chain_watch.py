@@ -0,0 +1,258 @@
+"""
+链上收款监听（总部和所有代理共用一个进程）
+
+原来每个代理进程各自按 RECHARGE_POLL_INTERVAL_SECONDS 请求 TronGrid，100 个代理就是 100 个轮询器
+共用同一批 API 密钥。现在由一个监听进程统一轮询所有收款地址：
+- 总部的 充值地址（shangtext）和每个代理启动时登记在 watch_addresses 中的 AGENT_USDT_ADDRESS
+- 每个地址一个游标（chain_cursors），每轮只拉取新的转账（TronClient：连接池、密钥限速、熔断）
+- 转账规范化后写入 chain_transfers（_id 为 txid，金额为整数 micro-USDT），按 (to_address, amount_micro, block_ts) 建索引
+- 转入总部地址的转账同时写入 qukuai（state 0），总部 jiexi 无需改动
+
+代理开启 CHAIN_WATCHER_ENABLED 后只查本地 chain_transfers，不再访问外网。
+集合都在 MONGO_DB_MAIN（默认 qukuailian）中；本模块导入时不连接数据库。
+
+用法：
+    python chain_watch.py [--interval 5] [--once]
+读取与总部相同的 MONGO_URI / MONGO_DB_BOT / MONGO_DB_MAIN 以及 TRON_API_KEYS 等环境变量。
+"""
+import argparse
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from pymongo import UpdateOne
+
+MICRO = 1_000_000
+
+# 没有游标的地址从多久之前开始拉取
+INITIAL_LOOKBACK = timedelta(minutes=30)
+
+CHAIN_INDEXES = {
+    'chain_transfers': [
+        [('to_address', 1), ('amount_micro', 1), ('block_ts', 1)],
+        [('to_address', 1), ('block_ts', 1)],
+    ],
+    'watch_addresses': [
+        [('last_seen', -1)],
+    ],
+}
+
+
+def ensure_chain_indexes(chain_db):
+    for name, indexes in CHAIN_INDEXES.items():
+        for keys in indexes:
+            chain_db[name].create_index(keys, background=True)
+
+
+# ================================ 地址登记 ================================
+
+def register_watch_address(watch_addresses, address, owner):
+    """代理启动时登记收款地址（同一地址可以有多个使用者）"""
+    watch_addresses.update_one(
+        {'_id': address},
+        {'$addToSet': {'owners': owner}, '$set': {'last_seen': datetime.utcnow()}},
+        upsert=True
+    )
+
+
+def watched_addresses(watch_addresses, shangtext=None):
+    """所有需要监听的地址；返回 (地址列表, 总部地址或 None)"""
+    addresses = [doc['_id'] for doc in watch_addresses.find({}, {'_id': 1})]
+    hq_address = None
+    if shangtext is not None:
+        doc = shangtext.find_one({'projectname': '充值地址'})
+        hq_address = (doc or {}).get('text') or None
+        if hq_address and hq_address not in addresses:
+            addresses.append(hq_address)
+    return addresses, hq_address
+
+
+# ================================ 转账规范化 ================================
+
+def _amount_micro(it):
+    """TronGrid（value + token_info.decimals）/ TronScan（quant + tokenInfo.tokenDecimal）-> 整数 micro-USDT"""
+    token_info = it.get('token_info') or it.get('tokenInfo') or {}
+    decimals = int(token_info.get('decimals') or token_info.get('tokenDecimal') or 6)
+    raw = it.get('value') if it.get('value') is not None else it.get('quant')
+    if raw is None:
+        if it.get('amount_str') is None:
+            return None
+        return int(Decimal(str(it['amount_str'])) * MICRO)
+    return int(Decimal(str(raw)) * MICRO / Decimal(10 ** decimals))
+
+
+def normalize_transfer(it, address, contract):
+    """转入 address 的转账 -> chain_transfers 文档；字段不全或不是转入该地址时返回 None"""
+    to_addr = it.get('to_address') or it.get('to') or ''
+    if to_addr.lower() != address.lower():
+        return None
+    tx_id = it.get('transaction_id') or it.get('hash') or ''
+    ts_ms = int(it.get('block_ts') or it.get('block_timestamp') or it.get('timestamp') or 0)
+    try:
+        amount_micro = _amount_micro(it)
+    except Exception:
+        amount_micro = None
+    if not tx_id or not ts_ms or amount_micro is None:
+        return None
+    return {
+        '_id': tx_id,
+        'to_address': address,
+        'from_address': it.get('from_address') or it.get('from') or '',
+        'amount_micro': amount_micro,
+        'block_ts': ts_ms,
+        'tx_time': datetime.utcfromtimestamp(ts_ms / 1000),
+        'contract': contract,
+    }
+
+
+def as_transfer_item(doc):
+    """chain_transfers 文档 -> 代理 _parse_amount / _normalize_transfer 使用的字段"""
+    amount = (Decimal(doc['amount_micro']) / MICRO).quantize(Decimal('0.0001'))
+    return {
+        'to_address': doc['to_address'],
+        'from_address': doc.get('from_address'),
+        'amount_str': str(amount),
+        'block_ts': doc['block_ts'],
+        'transaction_id': doc['_id'],
+    }
+
+
+def find_transfers(chain_transfers, address, amounts_micro, since_ms):
+    """代理查询本地转账：只取待支付订单金额对应的记录"""
+    return [as_transfer_item(doc) for doc in chain_transfers.find({
+        'to_address': address,
+        'amount_micro': {'$in': list(amounts_micro)},
+        'block_ts': {'$gte': int(since_ms)},
+    })]
+
+
+# ================================ 监听 ================================
+
+class ChainWatcher:
+    """
+    Args:
+        client: TronClient
+        chain_db: 存放 chain_transfers / chain_cursors / watch_addresses 的数据库（MONGO_DB_MAIN）
+        shangtext: 总部 shangtext 集合；为 None 时不监听总部地址
+    """
+
+    def __init__(self, client, chain_db, shangtext=None, contract=None):
+        self.client = client
+        self.contract = contract or client.contract
+        self.transfers = chain_db['chain_transfers']
+        self.cursors = chain_db['chain_cursors']
+        self.watch_addresses = chain_db['watch_addresses']
+        self.qukuai = chain_db['qukuai']
+        self.shangtext = shangtext
+
+    def poll_address(self, address, hq=False):
+        """拉取一个地址的新转账并入库，返回新写入的条数"""
+        cursor = self.cursors.find_one({'_id': address}) or {}
+        cursor_ts = int(cursor.get('block_ts') or 0)
+        seen = set(cursor.get('tx_ids') or [])
+        start_ms = cursor_ts or int((datetime.utcnow() - INITIAL_LOOKBACK - datetime(1970, 1, 1)).total_seconds() * 1000)
+        items = self.client.token_transfers(address, limit=200, since_ms=start_ms)
+
+        docs = []
+        for it in items:
+            doc = normalize_transfer(it, address, self.contract)
+            if not doc or doc['block_ts'] < start_ms:
+                continue
+            if doc['block_ts'] == cursor_ts and doc['_id'] in seen:
+                continue
+            docs.append(doc)
+        if not docs:
+            return 0
+
+        now = datetime.utcnow()
+        result = self.transfers.bulk_write(
+            [UpdateOne({'_id': d['_id']}, {'$setOnInsert': dict(d, seen_at=now)}, upsert=True) for d in docs],
+            ordered=False
+        )
+        if hq:
+            # 总部 jiexi 读取 qukuai（quant 为 micro 单位）
+            self.qukuai.bulk_write([UpdateOne({'txid': d['_id']}, {'$setOnInsert': {
+                'txid': d['_id'],
+                'from_address': d['from_address'],
+                'to_address': d['to_address'],
+                'quant': d['amount_micro'],
+                'block_ts': d['block_ts'],
+                'time': d['tx_time'],
+                'state': 0,
+            }}, upsert=True) for d in docs], ordered=False)
+
+        max_ts = max(d['block_ts'] for d in docs)
+        ids = {d['_id'] for d in docs if d['block_ts'] == max_ts}
+        if max_ts == cursor_ts:
+            ids |= seen
+        self.cursors.update_one(
+            {'_id': address},
+            {'$set': {'block_ts': max_ts, 'tx_ids': sorted(ids), 'updated_at': now}},
+            upsert=True
+        )
+        return result.upserted_count
+
+    def poll_once(self):
+        addresses, hq_address = watched_addresses(self.watch_addresses, self.shangtext)
+        total = 0
+        for address in addresses:
+            try:
+                total += self.poll_address(address, hq=(address == hq_address))
+            except Exception as e:
+                logging.error(f"❌ 监听地址失败 {address}: {e}")
+        return len(addresses), total
+
+    def run(self, interval=5.0):
+        logging.info(f"✅ 链上监听已启动，间隔 {interval}s")
+        while True:
+            started = time.time()
+            try:
+                count, new = self.poll_once()
+                if new:
+                    logging.info(f"✅ {count} 个地址，新转账 {new} 笔")
+            except Exception as e:
+                logging.error(f"❌ 链上监听异常：{e}")
+            time.sleep(max(interval - (time.time() - started), 0.5))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='链上收款监听（总部 + 所有代理）')
+    parser.add_argument('--interval', type=float, default=float(os.getenv('CHAIN_WATCH_INTERVAL', '5')))
+    parser.add_argument('--no-hq', action='store_true', help='不监听总部充值地址（总部仍使用其他 qukuai 数据源时）')
+    parser.add_argument('--once', action='store_true', help='只轮询一轮')
+    args = parser.parse_args()
+
+    import pymongo
+    from dotenv import load_dotenv
+    from tron_client import TronClient, DEFAULT_TRONSCAN_BASES
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    mongo = pymongo.MongoClient(os.getenv('MONGO_URI', 'mongodb://127.0.0.1:27017/'))
+    chain_db = mongo[os.getenv('MONGO_DB_MAIN', 'qukuailian')]
+    shangtext = None if args.no_hq else mongo[os.getenv('MONGO_DB_BOT', '9hao1bot')]['shangtext']
+    ensure_chain_indexes(chain_db)
+
+    tronscan_api = os.getenv('TRONSCAN_TRX20_API')
+    client = TronClient(
+        os.getenv('USDT_TRON_CONTRACT', 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t'),
+        trongrid_base=os.getenv('TRONGRID_API_BASE', 'https://api.trongrid.io'),
+        tronscan_bases=((tronscan_api,) if tronscan_api else ()) + DEFAULT_TRONSCAN_BASES,
+        api_keys=[k.strip() for k in os.getenv('TRON_API_KEYS', '').split(',') if k.strip()],
+        key_header=os.getenv('TRON_API_KEY_HEADER', 'TRON-PRO-API-KEY'),
+        key_rate=float(os.getenv('TRON_API_KEY_RATE', '10')),
+        cooldown=float(os.getenv('TRON_API_COOLDOWN_SECONDS', '30')),
+    )
+    watcher = ChainWatcher(client, chain_db, shangtext)
+    if args.once:
+        count, new = watcher.poll_once()
+        print(f"✅ {count} 个地址，新转账 {new} 笔")
+        return 0
+    watcher.run(args.interval)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
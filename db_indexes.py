@@ -0,0 +1,244 @@
+"""
+索引清单与启动时索引对账
+
+所有热点集合需要的索引集中声明在这里：
+- 启动时 reconcile_index_manifest() 在后台线程中补建缺失的索引（已存在的跳过，不删除多余索引；
+  清单要求 unique 而现有同键索引不是唯一索引时，先建好唯一索引再删除原索引，有重复数据建不成则保留原索引）
+- 代理的动态集合 agent_users_* / agent_gmjlu_* 在首次使用时由 ensure_dynamic_indexes() 建索引
+- explain_hot_queries() 用 explain() 检查热点查询是否仍在全表扫描（COLLSCAN），供 /diag_db 展示
+
+本模块只接收数据库/集合对象作为参数，导入时不连接数据库，总部和代理都可以使用。
+"""
+import logging
+import threading
+from datetime import datetime
+
+# ================================ 索引清单 ================================
+# 键为 (数据库, 集合名)，数据库取值：'main' -> MONGO_DB_MAIN，'bot' -> MONGO_DB_BOT
+# 每个索引为 (键列表, 选项)，名称由 MongoDB 按键自动生成
+
+HQ_INDEX_MANIFEST = {
+    ('bot', 'hb'): [
+        ([('nowuid', 1), ('state', 1)], {}),
+        ([('nowuid', 1), ('projectname', 1)], {}),
+        # 购买占用后按 claim_token 取回 / 回滚（只有已售商品带该字段）
+        ([('claim_token', 1)], {'sparse': True}),
+    ],
+    ('bot', 'user'): [
+        # 并发 /start 的 upsert 依赖唯一索引防止重复用户（启动时先由 mongo.dedupe_users 清理重复）
+        ([('user_id', 1)], {'unique': True}),
+        ([('state', 1)], {}),
+        ([('count_id', 1)], {}),
+    ],
+    ('bot', 'gmjlu'): [
+        ([('user_id', 1), ('timer', -1)], {}),
+        ([('timer', -1)], {}),
+        ([('nowuid', 1), ('timer', -1)], {}),
+        ([('bianhao', 1)], {}),
+    ],
+    ('bot', 'topup'): [
+        ([('status', 1), ('time', -1)], {}),
+        ([('money', 1), ('status', 1)], {}),
+        ([('user_id', 1), ('status', 1)], {}),
+        # 待支付订单到期调度（expire_topups 兜底查询）
+        ([('status', 1), ('expire_at', 1)], {}),
+        # 尾数位图占满时按待支付订单重建
+        ([('amount_slot.key', 1), ('status', 1)], {}),
+        # 待支付 USDT 订单金额唯一（整数 micro-USDT）
+        ([('amount_micro', 1)], {'unique': True, 'partialFilterExpression': {
+            'status': 'pending', 'amount_micro': {'$exists': True}}}),
+        # 充值结算中断后按转账找回订单（jiexi 未匹配的转账）
+        ([('qukuai_id', 1)], {'sparse': True}),
+    ],
+    ('bot', 'fyb'): [
+        ([('text', 1)], {}),
+    ],
+    ('bot', 'balance_ledger'): [
+        ([('scope', 1), ('user_id', 1), ('seq', 1)], {}),
+        ([('scope', 1), ('at', 1)], {}),
+    ],
+    ('bot', 'balance_snapshots'): [
+        ([('scope', 1), ('user_id', 1), ('at', -1)], {}),
+        ([('scope', 1), ('date', 1)], {}),
+    ],
+    ('main', 'qukuai'): [
+        ([('state', 1), ('to_address', 1)], {}),
+        ([('txid', 1)], {}),
+    ],
+}
+
+# 代理数据库（代理机器人启动时对账，数据库取值 'agent' -> DATABASE_NAME）
+AGENT_INDEX_MANIFEST = {
+    ('agent', 'recharge_orders'): [
+        ([('agent_bot_id', 1), ('status', 1), ('expire_time', 1)], {}),
+        ([('tx_id', 1)], {}),
+        ([('amount_slot.key', 1), ('status', 1)], {}),
+        ([('address', 1), ('expected_amount', 1), ('status', 1)], {}),
+    ],
+}
+
+# 代理动态集合，按集合名前缀匹配
+DYNAMIC_INDEX_MANIFEST = {
+    'agent_users_': [
+        ([('user_id', 1)], {}),
+        ([('creation_time', -1)], {}),
+        ([('count_id', 1)], {}),
+    ],
+    'agent_gmjlu_': [
+        ([('user_id', 1), ('timer', -1)], {}),
+        ([('bianhao', 1)], {}),
+    ],
+}
+
+# 热点查询（/diag_db 用 explain() 检查）：(数据库, 集合名, 过滤条件, 排序, 说明)
+HOT_QUERIES = [
+    ('bot', 'hb', {'nowuid': '_', 'state': 0}, None, '可售库存'),
+    ('bot', 'hb', {'nowuid': '_', 'projectname': '_'}, None, '上传查重'),
+    ('bot', 'hb', {'claim_token': '_'}, None, '占用取回'),
+    ('bot', 'user', {'user_id': 0}, None, '用户信息'),
+    ('bot', 'user', {'state': '4'}, None, '管理员列表'),
+    ('bot', 'user', {'count_id': 0}, None, '用户编号'),
+    ('bot', 'gmjlu', {'user_id': 0}, [('timer', -1)], '购买记录'),
+    ('bot', 'gmjlu', {'nowuid': '_'}, None, '商品销售统计'),
+    ('bot', 'topup', {'status': 'success'}, [('time', -1)], '充值记录'),
+    ('bot', 'topup', {'money': 0.0, 'status': 'pending'}, None, '充值金额'),
+    ('bot', 'topup', {'amount_micro': {'$in': [0]}, 'status': 'pending'}, None, '充值金额匹配'),
+    ('bot', 'topup', {'status': 'pending', 'expire_at': {'$lte': datetime(2000, 1, 1)}}, None, '充值订单到期'),
+    ('bot', 'topup', {'qukuai_id': '_', 'status': 'success'}, None, '充值结算找回'),
+    ('bot', 'fyb', {'text': '_'}, None, '翻译缓存'),
+    ('bot', 'balance_ledger', {'scope': '_', 'user_id': 0}, [('seq', -1)], '余额流水'),
+    ('main', 'qukuai', {'state': 0, 'to_address': '_'}, None, '待解析转账'),
+    ('main', 'qukuai', {'txid': '_'}, None, '交易哈希'),
+]
+
+# ================================ 对账 ================================
+
+def _key_signature(keys):
+    return tuple((field, direction) for field, direction in keys)
+
+def _upgrade_to_unique(collection, name, keys):
+    """
+    把同键的普通索引重建为唯一索引，返回是否成功
+
+    MongoDB 不允许同一键模式只差 unique 的两个索引并存，所以先在反向键模式上建一个临时唯一索引
+    （唯一性相同，同样能服务等值查询），建好后再删除原索引、按原键模式建唯一索引、删除临时索引，
+    整个过程中集合上始终有可用的索引和唯一约束；有重复数据时临时索引建不成，原索引保持不动
+    """
+    if not all(isinstance(direction, int) for _, direction in keys):
+        logging.error(f"❌ 不支持升级为唯一索引的索引类型：{collection.name} {keys}")
+        return False
+    temp_name = f"{name}_unique_tmp"
+    try:
+        collection.create_index([(field, -direction) for field, direction in keys],
+                                name=temp_name, background=True, unique=True)
+    except Exception as e:
+        logging.error(f"❌ 唯一索引创建失败，保留原普通索引：{collection.name} {keys} - {e}")
+        return False
+    collection.drop_index(name)
+    collection.create_index(keys, background=True, unique=True)
+    collection.drop_index(temp_name)
+    return True
+
+def reconcile_indexes(collection, specs):
+    """补建集合缺失的索引，返回新建的索引名列表"""
+    existing = {_key_signature(info['key']): (name, info)
+                for name, info in collection.index_information().items()}
+    created = []
+    for keys, options in specs:
+        found = existing.get(_key_signature(keys))
+        if found:
+            name, info = found
+            if options.get('unique') and not info.get('unique') and _upgrade_to_unique(collection, name, keys):
+                created.append(name)
+            continue
+        name = collection.create_index(keys, background=True, **options)
+        created.append(name)
+    return created
+
+def _reconcile_all(databases, manifest):
+    total = 0
+    for (db_key, name), specs in manifest.items():
+        try:
+            created = reconcile_indexes(databases[db_key][name], specs)
+            if created:
+                total += len(created)
+                logging.info(f"✅ 创建索引 {name}: {', '.join(created)}")
+        except Exception as e:
+            logging.error(f"❌ 创建索引失败：{name} - {e}")
+    logging.info(f"✅ 索引对账完成，新建 {total} 个")
+
+def reconcile_index_manifest(databases, manifest=None, wait=False):
+    """
+    按清单补建索引
+
+    Args:
+        databases: {'main': main_db, 'bot': bot_db}
+        wait: False 时在后台线程执行，不阻塞启动
+    """
+    manifest = manifest or HQ_INDEX_MANIFEST
+    if wait:
+        _reconcile_all(databases, manifest)
+        return None
+    worker = threading.Thread(target=_reconcile_all, args=(databases, manifest),
+                              name='index-reconcile', daemon=True)
+    worker.start()
+    return worker
+
+# 本进程内已经处理过的动态集合
+_dynamic_done = set()
+_dynamic_lock = threading.Lock()
+
+def ensure_dynamic_indexes(collection):
+    """代理动态集合首次使用时建索引（每个进程每个集合只执行一次）"""
+    key = (collection.database.name, collection.name)
+    with _dynamic_lock:
+        if key in _dynamic_done:
+            return collection
+        _dynamic_done.add(key)
+    for prefix, specs in DYNAMIC_INDEX_MANIFEST.items():
+        if collection.name.startswith(prefix):
+            try:
+                created = reconcile_indexes(collection, specs)
+                if created:
+                    logging.info(f"✅ 创建索引 {collection.name}: {', '.join(created)}")
+            except Exception as e:
+                with _dynamic_lock:
+                    _dynamic_done.discard(key)
+                logging.error(f"❌ 创建索引失败：{collection.name} - {e}")
+            break
+    return collection
+
+# ================================ 查询计划诊断 ================================
+
+def _plan_stages(plan):
+    """递归列出执行计划中的所有 stage（兼容经典引擎和 SBE 的 queryPlan 结构）"""
+    if not isinstance(plan, dict):
+        return []
+    stages = [plan['stage']] if 'stage' in plan else []
+    for child_key in ('inputStage', 'queryPlan'):
+        stages += _plan_stages(plan.get(child_key))
+    for child in plan.get('inputStages', []):
+        stages += _plan_stages(child)
+    return stages
+
+def explain_hot_queries(databases, queries=None):
+    """
+    对热点查询执行 explain()
+
+    Returns:
+        [{'collection', 'desc', 'filter', 'stages', 'collscan'}]，explain 失败时带 'error'
+    """
+    results = []
+    for db_key, name, query_filter, sort, desc in queries or HOT_QUERIES:
+        row = {'collection': name, 'desc': desc, 'filter': query_filter, 'stages': [], 'collscan': False}
+        try:
+            cursor = databases[db_key][name].find(query_filter)
+            if sort:
+                cursor = cursor.sort(sort)
+            plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+            row['stages'] = _plan_stages(plan)
+            row['collscan'] = 'COLLSCAN' in row['stages']
+        except Exception as e:
+            row['error'] = str(e)
+        results.append(row)
+    return results
@@ -0,0 +1,150 @@
+"""
+发货压缩包构建（总部发货队列和代理发货共用）
+
+- 直接写入有上限的内存缓冲（SpooledTemporaryFile，超过 SPOOL_MEMORY_BYTES 才落到临时文件），
+  不再在 协议号发货 / 发货 目录下留下 zip 文件
+- 商品已经写入打包存储（pack_store）时直接从 mmap 读取；否则用上架时保存在 hb 文档上的
+  files 清单，不再逐个 os.path.exists / os.walk；没有清单的旧商品按原来的目录规则回退
+- 已经压缩过的文件（zip、图片、视频等）用 ZIP_STORED 直接存储，其余用 ZIP_DEFLATED
+- 超过 MAX_PART_BYTES（Telegram Bot 上传上限 50MB）自动分卷，每卷都是独立可解压的 zip
+
+本模块只读本地文件，不访问数据库。
+"""
+import os
+import zipfile
+from tempfile import SpooledTemporaryFile
+
+from pack_store import pack_reader
+
+MAX_PART_BYTES = 50 * 1024 * 1024
+SPOOL_MEMORY_BYTES = 8 * 1024 * 1024
+
+# 已压缩格式，再压缩只浪费 CPU
+INCOMPRESSIBLE_EXTS = {
+    '.zip', '.rar', '.7z', '.gz', '.tgz', '.bz2', '.xz',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mov', '.apk',
+}
+
+# 每个条目在本地文件头 + 中央目录中的固定开销（不含文件名），分卷时按此预留
+_ENTRY_OVERHEAD = 30 + 46 + 64
+
+
+class ArchiveTooLarge(Exception):
+    """单个文件本身就超过分卷上限"""
+
+
+def manifest_for_account(projectname):
+    """协议号清单：上传时实际解压出的 json / session 由调用方按存在与否筛选"""
+    return [f"{projectname}.json", f"{projectname}.session"]
+
+
+def item_entries(product_dir, items, leixing):
+    """
+    根据上架清单列出要打包的文件
+
+    Args:
+        product_dir: 商品文件目录（协议号/{nowuid} 或 号包/{nowuid}）
+        items: hb 文档，files 为相对 product_dir 的路径列表
+        leixing: '协议号' 按文件名平铺，其余保持 号包 的目录结构
+
+    Returns:
+        [(本地路径或文件内容 bytes, 压缩包内路径)]
+    """
+    entries = []
+    reader = pack_reader(product_dir)
+    for item in items:
+        name = item.get('projectname', '')
+        packed = reader.files(name) if reader else None
+        if packed is not None:
+            for rel_path, data in packed:
+                arcname = os.path.basename(rel_path) if leixing == '协议号' else rel_path
+                entries.append((data, arcname))
+            continue
+        files = item.get('files')
+        if files is None:
+            files = _legacy_files(product_dir, name, leixing)
+        for rel_path in files:
+            arcname = os.path.basename(rel_path) if leixing == '协议号' else rel_path
+            entries.append((os.path.join(product_dir, rel_path), arcname))
+    return entries
+
+
+def _legacy_files(product_dir, name, leixing):
+    """上架时没有记录清单的旧商品：按原来的规则扫描目录"""
+    if leixing == '协议号':
+        return [f for f in manifest_for_account(name) if os.path.exists(os.path.join(product_dir, f))]
+    base_path = os.path.join(product_dir, name)
+    files = []
+    for root, dirs, filenames in os.walk(base_path):
+        for filename in filenames:
+            files.append(os.path.relpath(os.path.join(root, filename), product_dir))
+    return files
+
+
+def _compression_for(arcname):
+    ext = os.path.splitext(arcname)[1].lower()
+    return zipfile.ZIP_STORED if ext in INCOMPRESSIBLE_EXTS else zipfile.ZIP_DEFLATED
+
+
+def build_archive_parts(entries, max_part_bytes=MAX_PART_BYTES, spool_bytes=SPOOL_MEMORY_BYTES):
+    """
+    把文件写入一个或多个 zip 分卷
+
+    entries 为 [(本地路径或文件内容 bytes, 压缩包内路径)]
+
+    按未压缩大小保守估计（压缩后只会更小），写入某个文件可能超过上限时先结束当前分卷。
+    清单中已经不存在的文件跳过。
+
+    Returns:
+        [{'file': 已回到开头的文件对象, 'size', 'files'}]，调用方发送后负责 close()
+    """
+    parts = []
+    current = None
+
+    def finish():
+        current['zip'].close()
+        current['file'].seek(0, os.SEEK_END)
+        size = current['file'].tell()
+        current['file'].seek(0)
+        parts.append({'file': current['file'], 'size': size, 'files': current['files']})
+
+    try:
+        for source, arcname in entries:
+            if isinstance(source, (bytes, bytearray)):
+                size = len(source)
+            else:
+                try:
+                    size = os.path.getsize(source)
+                except OSError:
+                    continue
+            needed = size + size // 1000 + _ENTRY_OVERHEAD + 2 * len(arcname.encode('utf-8'))
+            if needed > max_part_bytes:
+                raise ArchiveTooLarge(f"{arcname} ({size} bytes)")
+            if current and current['estimate'] + needed > max_part_bytes:
+                finish()
+                current = None
+            if current is None:
+                spooled = SpooledTemporaryFile(max_size=spool_bytes)
+                current = {'file': spooled, 'zip': zipfile.ZipFile(spooled, 'w'),
+                           'estimate': 22, 'files': 0}
+            if isinstance(source, (bytes, bytearray)):
+                current['zip'].writestr(arcname, source, compress_type=_compression_for(arcname))
+            else:
+                current['zip'].write(source, arcname, compress_type=_compression_for(arcname))
+            current['estimate'] += needed
+            current['files'] += 1
+        if current:
+            finish()
+            current = None
+    except Exception:
+        if current:
+            current['file'].close()
+        for part in parts:
+            part['file'].close()
+        raise
+    return parts
+
+
+def part_filename(base, index, total):
+    """分卷文件名：只有一卷时不加序号"""
+    return f"{base}.zip" if total == 1 else f"{base}_part{index}of{total}.zip"
@@ -0,0 +1,264 @@
+"""
+持久化发货队列（delivery_jobs）
+
+下单后只把发货任务写入 delivery_jobs 集合，由固定数量的工作线程处理：
+- 工作线程用 find_one_and_update 原子领取任务（带租约和 lease_token），进程崩溃后租约过期的任务会被重新领取；
+  完成 / 重试的写入都以 lease_token 为条件，处理函数发送前调用 ensure_lease() 确认租约仍属于自己，
+  租约已被其他工作线程接管时放弃本次处理，不会重复发货
+- 处理失败按指数退避重试，超过最大次数标记为 failed，保留错误信息供排查
+- 打包压缩占用磁盘 IO，通过 build_slot() 限制同时打包的任务数，
+  避免几十个批量订单同时压缩目录
+- metrics() 返回队列深度、处理中数量和最近任务的延迟
+
+- 处理函数可以用 record_progress() 把已完成的步骤（如已发送分卷的 file_id）写到任务上，
+  重试时从 job['progress'] 读取并跳过已完成的步骤
+
+任务文档：
+    {_id, kind, payload, state: pending|running|done|failed, attempts, next_run_at,
+     lease_until, lease_token, worker, created_at, started_at, finished_at, progress, result, error}
+
+本模块不在导入时访问数据库，集合和处理函数由调用方传入。
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import pymongo
+from pymongo import ReturnDocument
+
+JOB_PENDING = 'pending'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+class LeaseLost(Exception):
+    """任务租约已过期并被其他工作线程重新领取"""
+
+
+def ensure_delivery_indexes(jobs):
+    jobs.create_index([('state', 1), ('next_run_at', 1)], background=True)
+    jobs.create_index([('state', 1), ('lease_until', 1)], background=True)
+
+
+class DeliveryQueue:
+    """
+    Args:
+        jobs: delivery_jobs 集合
+        handler: handler(bot, job) -> dict，返回值保存为任务的 result；抛出异常则重试
+        workers: 工作线程数
+        build_slots: 同时打包的任务数上限
+        max_attempts: 最大尝试次数
+        backoff: 第一次重试的等待秒数，之后每次翻倍（最多 backoff_max）
+        lease: 单个任务的租约秒数，超时未完成视为工作线程已崩溃
+    """
+
+    def __init__(self, jobs, handler, workers=4, build_slots=2, max_attempts=5,
+                 backoff=5, backoff_max=300, lease=600, poll_interval=1.0):
+        self.jobs = jobs
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._build_slots = threading.BoundedSemaphore(build_slots)
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+        self.bot = None
+        self._stats_lock = threading.Lock()
+        self._latencies = deque(maxlen=200)   # 最近完成任务的 (排队秒数, 总耗时秒数)
+        self._counts = {'done': 0, 'retried': 0, 'failed': 0}
+
+    # ================================ 入队 ================================
+
+    def enqueue(self, kind, payload):
+        """写入发货任务并唤醒工作线程，返回任务 ID"""
+        now = datetime.now()
+        job_id = uuid.uuid4().hex
+        self.jobs.insert_one({
+            '_id': job_id,
+            'kind': kind,
+            'payload': payload,
+            'state': JOB_PENDING,
+            'attempts': 0,
+            'next_run_at': now,
+            'created_at': now,
+        })
+        self._wakeup.set()
+        return job_id
+
+    # ================================ 工作线程 ================================
+
+    def start(self, bot):
+        """启动工作线程，bot 为发送消息使用的 telegram.Bot"""
+        self.bot = bot
+        if self._threads:
+            return
+        try:
+            ensure_delivery_indexes(self.jobs)
+        except Exception as e:
+            logging.error(f"❌ 创建发货队列索引失败：{e}")
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._run, args=(f'delivery-{i}',),
+                                      name=f'delivery-{i}', daemon=True)
+            worker.start()
+            self._threads.append(worker)
+        logging.info(f"✅ 发货队列已启动：{self.workers} 个工作线程")
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+    def _claim(self, worker):
+        """领取一个到期的待处理任务，或租约已过期的处理中任务"""
+        now = datetime.now()
+        return self.jobs.find_one_and_update(
+            {'$or': [
+                {'state': JOB_PENDING, 'next_run_at': {'$lte': now}},
+                {'state': JOB_RUNNING, 'lease_until': {'$lt': now}},
+            ]},
+            {'$set': {'state': JOB_RUNNING, 'worker': worker, 'started_at': now,
+                      'lease_until': now + timedelta(seconds=self.lease), 'lease_token': uuid.uuid4().hex},
+             '$inc': {'attempts': 1}},
+            sort=[('next_run_at', pymongo.ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    @staticmethod
+    def _owned(job):
+        """仍由本次领取持有的任务"""
+        return {'_id': job['_id'], 'state': JOB_RUNNING, 'lease_token': job.get('lease_token')}
+
+    def ensure_lease(self, job):
+        """
+        发送前确认租约仍属于本次领取，并续期一个租约周期
+
+        Raises:
+            LeaseLost: 租约已过期并被其他工作线程领取
+        """
+        renewed = self.jobs.find_one_and_update(
+            self._owned(job),
+            {'$set': {'lease_until': datetime.now() + timedelta(seconds=self.lease)}},
+            projection={'_id': 1}
+        )
+        if renewed is None:
+            raise LeaseLost(job['_id'])
+
+    def record_progress(self, job, updates):
+        """
+        记录处理进度，updates 的键写入 progress 下（如 {'file_ids.1': file_id}），重试时保留
+
+        Raises:
+            LeaseLost: 租约已过期并被其他工作线程领取
+        """
+        res = self.jobs.update_one(
+            self._owned(job),
+            {'$set': {f'progress.{key}': value for key, value in updates.items()}}
+        )
+        if not res.matched_count:
+            raise LeaseLost(job['_id'])
+
+    def _run(self, worker):
+        while not self._stop.is_set():
+            try:
+                job = self._claim(worker)
+            except Exception as e:
+                logging.error(f"❌ 领取发货任务失败：{e}")
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+                continue
+            self._process(job)
+
+    def _process(self, job):
+        started = time.time()
+        try:
+            result = self.handler(self.bot, job) or {}
+        except LeaseLost:
+            logging.warning(f"⚠️ 发货任务租约已被接管，放弃本次处理：{job['_id']}")
+            return
+        except Exception as e:
+            self._retry_or_fail(job, e)
+            return
+        finished = datetime.now()
+        res = self.jobs.update_one(
+            self._owned(job),
+            {'$set': {'state': JOB_DONE, 'finished_at': finished, 'result': result},
+             '$unset': {'lease_until': '', 'error': ''}}
+        )
+        if not res.modified_count:
+            logging.warning(f"⚠️ 发货任务完成时租约已被接管：{job['_id']}")
+            return
+        with self._stats_lock:
+            self._counts['done'] += 1
+            self._latencies.append(((job['started_at'] - job['created_at']).total_seconds(),
+                                    (finished - job['created_at']).total_seconds()))
+        logging.info(f"✅ 发货完成：{job['_id']} {job['kind']}，用时 {time.time() - started:.2f} 秒")
+
+    def _retry_or_fail(self, job, error):
+        if job['attempts'] >= self.max_attempts:
+            self.jobs.update_one(
+                self._owned(job),
+                {'$set': {'state': JOB_FAILED, 'finished_at': datetime.now(), 'error': str(error)},
+                 '$unset': {'lease_until': ''}}
+            )
+            with self._stats_lock:
+                self._counts['failed'] += 1
+            logging.error(f"❌ 发货失败（已重试 {job['attempts']} 次）：{job['_id']} - {error}")
+            return
+        delay = min(self.backoff * 2 ** (job['attempts'] - 1), self.backoff_max)
+        self.jobs.update_one(
+            self._owned(job),
+            {'$set': {'state': JOB_PENDING, 'error': str(error),
+                      'next_run_at': datetime.now() + timedelta(seconds=delay)},
+             '$unset': {'lease_until': ''}}
+        )
+        with self._stats_lock:
+            self._counts['retried'] += 1
+        logging.warning(f"⚠️ 发货任务 {job['_id']} 第 {job['attempts']} 次失败，{delay} 秒后重试：{error}")
+
+    @contextmanager
+    def build_slot(self):
+        """打包压缩时占用一个名额，超出上限的任务在这里排队"""
+        self._build_slots.acquire()
+        try:
+            yield
+        finally:
+            self._build_slots.release()
+
+    # ================================ 指标 ================================
+
+    def metrics(self):
+        """
+        Returns:
+            {'pending', 'running', 'failed', 'oldest_pending_seconds',
+             'done', 'retried', 'failed_total', 'avg_wait', 'avg_latency', 'p95_latency'}
+            计数来自 delivery_jobs，done/retried/failed_total/延迟为本进程启动以来
+        """
+        now = datetime.now()
+        metrics = {state: self.jobs.count_documents({'state': state})
+                   for state in (JOB_PENDING, JOB_RUNNING, JOB_FAILED)}
+        oldest = self.jobs.find_one({'state': JOB_PENDING}, {'created_at': 1},
+                                    sort=[('created_at', pymongo.ASCENDING)])
+        metrics['oldest_pending_seconds'] = (now - oldest['created_at']).total_seconds() if oldest else 0
+        with self._stats_lock:
+            latencies = list(self._latencies)
+            metrics['done'] = self._counts['done']
+            metrics['retried'] = self._counts['retried']
+            metrics['failed_total'] = self._counts['failed']
+        if latencies:
+            totals = sorted(total for _, total in latencies)
+            metrics['avg_wait'] = sum(wait for wait, _ in latencies) / len(latencies)
+            metrics['avg_latency'] = sum(totals) / len(totals)
+            metrics['p95_latency'] = totals[min(int(len(totals) * 0.95), len(totals) - 1)]
+        else:
+            metrics['avg_wait'] = metrics['avg_latency'] = metrics['p95_latency'] = 0.0
+        return metrics
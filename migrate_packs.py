@@ -0,0 +1,109 @@
+"""
+把已有的 协议号/{nowuid}/ 散文件和 号包/{nowuid}/ 目录树迁移到打包存储（pack_store）
+
+- 协议号：同名的 .json / .session 归为一个商品
+- 号包：每个一级子目录为一个商品，目录内所有文件按相对 号包/{nowuid} 的路径写入
+- 已经在包内的商品跳过，可以重复执行
+- 加 --delete 时，写入并读回校验一致后删除原文件（协议号只删 json/session，其他文件保留）
+
+用法：
+    python migrate_packs.py [--base .] [--kind 协议号|号包|all] [--nowuid xxx] [--delete] [--dry-run]
+代理机器人的 FILE_BASE_PATH 指向同一目录时，迁移后无需额外操作即可读取。
+"""
+import argparse
+import os
+import shutil
+import time
+
+from pack_store import PackWriter, pack_reader
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def account_items(product_dir):
+    """协议号目录：{projectname: [(相对路径, 本地路径)]}"""
+    items = {}
+    for entry in os.scandir(product_dir):
+        if entry.is_file() and entry.name.endswith(('.json', '.session')):
+            name = entry.name[:-len('.json')] if entry.name.endswith('.json') else entry.name[:-len('.session')]
+            items.setdefault(name, []).append((entry.name, entry.path))
+    return items
+
+
+def package_items(product_dir):
+    """号包目录：{目录名: [(相对路径, 本地路径)]}"""
+    items = {}
+    for entry in os.scandir(product_dir):
+        if not entry.is_dir():
+            continue
+        files = items.setdefault(entry.name, [])
+        for root, dirs, filenames in os.walk(entry.path):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                files.append((os.path.relpath(path, product_dir).replace(os.sep, '/'), path))
+    return items
+
+
+def migrate_product(product_dir, kind, delete=False, dry_run=False):
+    """迁移一个商品目录，返回 (迁移商品数, 跳过数, 字节数)"""
+    items = account_items(product_dir) if kind == '协议号' else package_items(product_dir)
+    reader = pack_reader(product_dir)
+    existing = reader.names() if reader else set()
+    todo = {name: files for name, files in items.items() if name not in existing}
+    size = sum(os.path.getsize(path) for files in todo.values() for _, path in files)
+    if dry_run or not todo:
+        return len(todo), len(items) - len(todo), size
+
+    with PackWriter(product_dir) as writer:
+        for name, files in todo.items():
+            writer.add(name, [(rel_path, _read(path)) for rel_path, path in files])
+
+    if delete:
+        reader = pack_reader(product_dir)
+        for name, files in todo.items():
+            packed = dict(reader.files(name) or [])
+            if any(packed.get(rel_path) != _read(path) for rel_path, path in files):
+                print(f"❌ 校验失败，保留原文件: {product_dir} / {name}")
+                continue
+            if kind == '协议号':
+                for _, path in files:
+                    os.remove(path)
+            else:
+                shutil.rmtree(os.path.join(product_dir, name), ignore_errors=True)
+    return len(todo), len(items) - len(todo), size
+
+
+def run(args):
+    kinds = ['协议号', '号包'] if args.kind == 'all' else [args.kind]
+    started = time.time()
+    total_items = total_skipped = total_bytes = 0
+    for kind in kinds:
+        root = os.path.join(args.base, kind)
+        if not os.path.isdir(root):
+            continue
+        for entry in sorted(os.scandir(root), key=lambda e: e.name):
+            if not entry.is_dir() or (args.nowuid and entry.name != args.nowuid):
+                continue
+            moved, skipped, size = migrate_product(entry.path, kind, delete=args.delete, dry_run=args.dry_run)
+            total_items += moved
+            total_skipped += skipped
+            total_bytes += size
+            if moved or skipped:
+                print(f"{kind}/{entry.name}: 迁移 {moved}  已存在 {skipped}  {size / 1024 / 1024:.1f} MB")
+    action = "预计迁移" if args.dry_run else "已迁移"
+    print(f"✅ {action} {total_items} 个商品（跳过 {total_skipped}），{total_bytes / 1024 / 1024:.1f} MB，"
+          f"用时 {time.time() - started:.1f} 秒")
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='迁移协议号/号包散文件到打包存储')
+    parser.add_argument('--base', default='.', help='协议号、号包所在目录（代理为 FILE_BASE_PATH）')
+    parser.add_argument('--kind', default='all', choices=['协议号', '号包', 'all'])
+    parser.add_argument('--nowuid', help='只迁移指定商品')
+    parser.add_argument('--delete', action='store_true', help='校验通过后删除原文件')
+    parser.add_argument('--dry-run', action='store_true', help='只统计，不写入')
+    raise SystemExit(run(parser.parse_args()))
@@ -3,13 +3,29 @@ import random
 import re
 import pymongo
 from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+from decimal import Decimal
 import logging
 from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup
 from datetime import datetime, timedelta
 import time
+import uuid
 from dotenv import load_dotenv
 import os
 import threading
+import queue
+from mongo_shared import (
+    apply_stock_delta, stock_snapshot, rebuild_stock_counters, ensure_stock_counter_indexes,
+    claim_stock_items, release_stock_items, CatalogCache, bump_catalog_version,
+    debit_balance, credit_balance, balance_amount,
+    write_balance_snapshots, balance_as_of, platform_balance, verify_balances,
+    allocate_count_id, UserCache, CachedUsers
+)
+from search_index import ProductSearchIndex
+from recharge_match import PendingRecharges, TopupExpiry, ORDER_TTL, to_micro, from_micro, unmatched_expired
+from amount_slots import AmountSlots
+from ranking import RankingService
+from db_indexes import reconcile_index_manifest, ensure_dynamic_indexes, explain_hot_queries
 
 # 加载环境变量
 load_dotenv()
@@ -50,8 +66,13 @@ class Config:
     
     # 时间配置
     STOCK_NOTIFICATION_DELAY = int(os.getenv('STOCK_NOTIFICATION_DELAY', '3'))
+    STOCK_NOTIFY_QUEUE_SIZE = int(os.getenv('STOCK_NOTIFY_QUEUE_SIZE', '10000'))
     MESSAGE_DELETE_DELAY = int(os.getenv('MESSAGE_DELETE_DELAY', '3'))
     
+    # 发货队列配置：工作线程数、同时打包数
+    DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', '4'))
+    DELIVERY_BUILD_SLOTS = int(os.getenv('DELIVERY_BUILD_SLOTS', '2'))
+    
     # 验证关键配置
     @classmethod
     def validate(cls):
@@ -74,7 +95,10 @@ RESTOCK_GROUP = Config.RESTOCK_GROUP
 BOT_TOKEN = Config.BOT_TOKEN
 NOTIFY_CHANNEL_ID = Config.NOTIFY_CHANNEL_ID
 STOCK_NOTIFICATION_DELAY = Config.STOCK_NOTIFICATION_DELAY
+STOCK_NOTIFY_QUEUE_SIZE = Config.STOCK_NOTIFY_QUEUE_SIZE
 BOT_USERNAME = Config.BOT_USERNAME
+DELIVERY_WORKERS = Config.DELIVERY_WORKERS
+DELIVERY_BUILD_SLOTS = Config.DELIVERY_BUILD_SLOTS
 
 # ✅ 数据库连接和集合管理优化
 class DatabaseManager:
@@ -111,6 +135,13 @@ class DatabaseManager:
         self.qb = self.bot_db['qb']
         self.zhuanz = self.bot_db['zhuanz']
         self.withdrawal_requests = self.bot_db['withdrawal_requests']
+        self.stock_counters = self.bot_db['stock_counters']
+        self.catalog_meta = self.bot_db['catalog_meta']
+        self.delivery_jobs = self.bot_db['delivery_jobs']
+        self.balance_ledger = self.bot_db['balance_ledger']
+        self.balance_snapshots = self.bot_db['balance_snapshots']
+        self.counters = self.bot_db['counters']
+        self.amount_slots = self.bot_db['amount_slots']
     
     def close(self):
         """关闭数据库连接"""
@@ -125,7 +156,10 @@ teleclient = db_manager.client
 main_db = db_manager.main_db
 qukuai = db_manager.qukuai
 bot_db = db_manager.bot_db
-user = db_manager.user
+# ✅ 用户集合带进程内缓存：写操作自动失效对应用户，handler 通过 load_user / user_lang 读取
+user_cache = UserCache(db_manager.user, ttl=float(os.getenv('USER_CACHE_TTL', '30')),
+                       max_size=int(os.getenv('USER_CACHE_SIZE', '5000')))
+user = CachedUsers(db_manager.user, user_cache)
 shangtext = db_manager.shangtext
 get_key = db_manager.get_key
 topup = db_manager.topup
@@ -143,14 +177,59 @@ hongbao = db_manager.hongbao
 qb = db_manager.qb
 zhuanz = db_manager.zhuanz
 withdrawal_requests = db_manager.withdrawal_requests
+stock_counters = db_manager.stock_counters
+catalog_meta = db_manager.catalog_meta
+delivery_jobs = db_manager.delivery_jobs
+balance_ledger = db_manager.balance_ledger
+balance_snapshots = db_manager.balance_snapshots
+counters = db_manager.counters
+amount_slots = db_manager.amount_slots
+
+# ✅ 商品目录缓存（fenlei + ejfl），管理员修改目录后调用 catalog_changed()
+catalog = CatalogCache(fenlei, ejfl, catalog_meta)
+
+def catalog_changed():
+    """目录被修改：递增版本号（其他进程据此失效）并立即失效本进程缓存"""
+    bump_catalog_version(catalog_meta)
+    catalog.invalidate()
+
+# ✅ 商品排行（/hot /new），定时任务调用 rankings.refresh_if_needed()，购买/补货后标记需要刷新
+rankings = RankingService(catalog, stock_counters, gmjlu)
+
+# ✅ 商品搜索索引（区号 / 国家名 / 关键词），首次搜索时从目录缓存构建，之后增量维护
+search_index = ProductSearchIndex()
+_search_index_lock = threading.Lock()
+
+def _ensure_search_index():
+    if not search_index.built:
+        with _search_index_lock:
+            if not search_index.built:
+                search_index.build(catalog.products())
+                logging.info("✅ 商品搜索索引构建完成")
+
+def search_index_refresh_product(nowuid: str):
+    """新增或改名商品后更新搜索索引"""
+    if not search_index.built:
+        return
+    product = catalog.product(nowuid)
+    if product:
+        search_index.update_product(nowuid, product.get('projectname', ''))
+    else:
+        search_index.remove_product(nowuid)
 
 # ✅ 库存通知管理优化
+# 单个调度线程 + 有界事件队列：
+#   上架时只把 (nowuid, projectname, count) 放入队列，不再每件商品起一个线程
+#   调度线程把同一 nowuid 的补货合并，窗口从该商品第一次补货开始 STOCK_NOTIFICATION_DELAY 秒
+#   到期的商品一次批量查询 ejfl / fenlei / 库存计数后逐个发送
 class StockNotificationManager:
     def __init__(self):
-        self.notify_cache = {}
+        self.notify_cache = {}  # nowuid -> {'projectname', 'count', 'due'}
         self.last_notify_time = {}
         self.notification_lock = threading.Lock()
         self.bot_instance = None
+        self.events = queue.Queue(maxsize=STOCK_NOTIFY_QUEUE_SIZE)
+        self.worker = None
     
     def get_bot(self):
         """获取或创建 Bot 实例"""
@@ -158,13 +237,17 @@ class StockNotificationManager:
             self.bot_instance = Bot(token=BOT_TOKEN)
         return self.bot_instance
     
-    def add_stock_notification(self, nowuid: str, projectname: str):
-        """添加库存通知"""
+    def add_stock_notification(self, nowuid: str, projectname: str, count: int = 1):
+        """合并库存通知（同一商品在窗口内只发一条）"""
         with self.notification_lock:
             if nowuid not in self.notify_cache:
-                self.notify_cache[nowuid] = {'projectname': projectname, 'count': 1}
+                self.notify_cache[nowuid] = {
+                    'projectname': projectname,
+                    'count': count,
+                    'due': time.time() + STOCK_NOTIFICATION_DELAY
+                }
             else:
-                self.notify_cache[nowuid]['count'] += 1
+                self.notify_cache[nowuid]['count'] += count
     
     def send_notification(self, nowuid: str, projectname: str, price: float, stock: int, count: int):
         """发送单个商品的库存通知"""
@@ -209,53 +292,94 @@ class StockNotificationManager:
         except Exception as e:
             logging.error(f"❌ 推送失败：{e}")
     
-    def send_batched_notifications(self):
-        """发送批量库存通知"""
+    def _pop_due(self, force: bool = False) -> dict:
+        """取出已到期的通知（force=True 时取出全部）"""
+        now = time.time()
         with self.notification_lock:
-            if not self.notify_cache:
-                return
-            
-            notifications_to_send = self.notify_cache.copy()
-            self.notify_cache.clear()
+            due = {nowuid: info for nowuid, info in self.notify_cache.items() if force or info['due'] <= now}
+            for nowuid in due:
+                del self.notify_cache[nowuid]
+        return due
+    
+    def _deliver(self, notifications: dict):
+        """批量查询商品/分类名称和库存后逐个发送"""
+        nowuids = list(notifications)
+        products = {nowuid: catalog.product(nowuid) for nowuid in nowuids}
+        parents = {doc['uid']: doc['projectname'] for doc in catalog.categories()}
+        stocks = get_stock_snapshot(nowuids=nowuids)['products']
         
-        for nowuid, info in notifications_to_send.items():
+        for nowuid, info in notifications.items():
             try:
                 # 获取二级分类信息
-                product = ejfl.find_one({'nowuid': nowuid})
+                product = products.get(nowuid)
                 if not product:
                     logging.warning(f"❌ 未找到商品信息：nowuid={nowuid}")
                     continue
                 
-                # 获取一级分类信息
-                uid = product.get('uid')
-                parent_category = fenlei.find_one({'uid': uid})
-                parent_name = parent_category['projectname'] if parent_category else "未知分类"
-                
                 # 构建完整的商品名称：一级分类/二级分类
+                parent_name = parents.get(product.get('uid'), "未知分类")
                 product_name = f"{parent_name}/{product['projectname']}"
                 
                 price = float(product.get('money', 0))
-                stock = hb.count_documents({'nowuid': nowuid, 'state': 0})
+                stock = stocks[nowuid]['available']
                 self.send_notification(nowuid, product_name, price, stock, info['count'])
+                self.last_notify_time[nowuid] = time.time()
                 
             except Exception as e:
                 logging.error(f"❌ 发送库存通知失败：nowuid={nowuid}, error={e}")
         
-        logging.info(f"📢 批量库存通知完成，共发送 {len(notifications_to_send)} 个通知")
+        logging.info(f"📢 批量库存通知完成，共发送 {len(notifications)} 个通知")
     
-    def schedule_notification(self, nowuid: str, projectname: str):
-        """安排延迟通知"""
-        self.add_stock_notification(nowuid, projectname)
-        
-        def delayed_notify():
-            time.sleep(STOCK_NOTIFICATION_DELAY)
+    def send_batched_notifications(self):
+        """立即发送所有待发送的库存通知"""
+        notifications = self._pop_due(force=True)
+        if notifications:
+            self._deliver(notifications)
+    
+    def _next_timeout(self):
+        """距离最早到期通知的秒数，没有待发送通知时返回 None（一直等待新事件）"""
+        with self.notification_lock:
+            if not self.notify_cache:
+                return None
+            earliest = min(info['due'] for info in self.notify_cache.values())
+        return max(earliest - time.time(), 0)
+    
+    def _run(self):
+        """调度线程：收集事件、合并、到期发送"""
+        while True:
             try:
-                self.send_batched_notifications()
+                nowuid, projectname, count = self.events.get(timeout=self._next_timeout())
+                self.add_stock_notification(nowuid, projectname, count)
+                # 一次取完队列中已有的事件
+                while True:
+                    nowuid, projectname, count = self.events.get_nowait()
+                    self.add_stock_notification(nowuid, projectname, count)
+            except queue.Empty:
+                pass
+            
+            try:
+                notifications = self._pop_due()
+                if notifications:
+                    self._deliver(notifications)
             except Exception as e:
                 logging.error(f"❌ 延迟通知失败：{e}")
-        
-        threading.Thread(target=delayed_notify, daemon=True).start()
-        logging.info(f"🔔 已启动库存通知延迟任务：{projectname} (nowuid={nowuid})")
+    
+    def _ensure_worker(self):
+        with self.notification_lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, name='stock-notifier', daemon=True)
+                self.worker.start()
+                logging.info("🔔 库存通知调度线程已启动")
+    
+    def schedule_notification(self, nowuid: str, projectname: str, count: int = 1):
+        """安排延迟通知"""
+        self._ensure_worker()
+        try:
+            self.events.put((nowuid, projectname, count), timeout=1)
+        except queue.Full:
+            # 队列已满时直接合并，不丢通知
+            logging.warning(f"⚠️ 库存通知队列已满，直接合并：nowuid={nowuid}")
+            self.add_stock_notification(nowuid, projectname, count)
 
 # 初始化库存通知管理器
 stock_manager = StockNotificationManager()
@@ -315,10 +439,11 @@ def fanyibao(projectname, text, fanyi):
     except Exception as e:
         logging.error(f"❌ 插入翻译包失败：{projectname} - {e}")
 
-def goumaijilua(leixing, bianhao, user_id, projectname, text, ts, timer, count):
-    """购买记录插入函数"""
+def goumaijilua(leixing, bianhao, user_id, projectname, text, ts, timer, count, nowuid=None, amount=None, file_ids=None, items=None,
+                strict=False):
+    """购买记录插入函数，strict=True 时写入失败抛出异常（发货队列据此重试）"""
     try:
-        gmjlu.insert_one({
+        record = {
             'leixing': leixing,
             'bianhao': bianhao,
             'user_id': user_id,
@@ -327,10 +452,21 @@ def goumaijilua(leixing, bianhao, user_id, projectname, text, ts, timer, count):
             'ts': ts,
             'timer': timer,
             'count': count   # ✅ 记录实际数量
-        })
+        }
+        if nowuid:
+            record['nowuid'] = nowuid  # ✅ 销量排行按 nowuid 统计
+        if amount is not None:
+            record['amount'] = float(amount)  # ✅ 实付金额，商品统计汇总销售额
+        if file_ids:
+            record['file_ids'] = file_ids  # ✅ 已发送文件（分卷）的 Telegram file_id
+        if items:
+            record['items'] = items  # ✅ 已售商品名，file_id 失效时据此重新打包
+        gmjlu.insert_one(record)
         logging.info(f"✅ 插入购买记录：{user_id} - {projectname}")
     except Exception as e:
         logging.error(f"❌ 插入购买记录失败：{user_id} - {projectname} - {e}")
+        if strict:
+            raise
 
 def xieyihaobaocun(uid, nowuid, hbid, projectname, timer):
     """协议号保存函数"""
@@ -363,6 +499,7 @@ def shangchuanhaobao(leixing, uid, nowuid, hbid, projectname, timer, remark=''):
             'remark': remark
         })
         logging.info(f"✅ 上架商品成功：{projectname} (nowuid={nowuid})")
+        apply_stock_delta(stock_counters, nowuid, uid, available=1)
 
         # ✅ 使用优化的库存通知管理器
         stock_manager.schedule_notification(nowuid, projectname)
@@ -370,6 +507,92 @@ def shangchuanhaobao(leixing, uid, nowuid, hbid, projectname, timer, remark=''):
     except Exception as e:
         logging.error(f"❌ 上架商品失败：{projectname} - {e}")
 
+INGEST_CHUNK_SIZE = 1000
+
+def bulk_shangchuanhaobao(leixing, uid, nowuid, items, timer, progress=None, before_insert=None) -> dict:
+    """
+    批量上架商品（号包/协议号/谷歌/API/链接上传共用）
+
+    items 为 [{'projectname', 'remark'(可选), 'data'(可选), 'files'(可选)}]：
+    1. 本批内部按 projectname 去重，再分块用一次 $in 查询排除库里已有的
+    2. 每块写入前回调 before_insert(本块将要写入的 items)，号包 / 协议号在这里只把新商品的文件写入打包存储
+    3. insert_many(ordered=False) 分块写入，每块写完回调 progress(已处理, 总数)
+    4. 整批只调整一次库存计数、只触发一次补货通知
+
+    Returns:
+        {'inserted', 'skipped', 'duplicates', 'existing', 'elapsed', 'rate'}：
+        skipped 为上传的全部条目中没有入库的数量，其中 duplicates 为本批内重复（或没有名称）的条目，
+        existing 为库里已有的商品，其余为写入失败；rate 为每秒入库数量
+    """
+    started = time.time()
+    unique_items = {}
+    for item in items:
+        name = item.get('projectname')
+        if name and name not in unique_items:
+            unique_items[name] = item
+    names = list(unique_items)
+    total = len(names)
+
+    inserted = 0
+    existing_count = 0
+    try:
+        for start in range(0, total, INGEST_CHUNK_SIZE):
+            chunk = names[start:start + INGEST_CHUNK_SIZE]
+            existing = {doc['projectname'] for doc in hb.find(
+                {'nowuid': nowuid, 'projectname': {'$in': chunk}}, {'projectname': 1, '_id': 0})}
+            existing_count += len(existing)
+            docs = []
+            for name in chunk:
+                if name in existing:
+                    continue
+                item = unique_items[name]
+                doc = {
+                    'leixing': leixing,
+                    'uid': uid,
+                    'nowuid': nowuid,
+                    'hbid': uuid.uuid4().hex[:24],
+                    'projectname': name,
+                    'state': 0,
+                    'timer': timer,
+                    'remark': item.get('remark', '')
+                }
+                if 'data' in item:
+                    doc['data'] = item['data']
+                if 'files' in item:
+                    doc['files'] = item['files']  # ✅ 发货文件清单（相对商品目录），发货时不再扫描目录
+                docs.append(doc)
+            if docs:
+                if before_insert:
+                    before_insert([unique_items[doc['projectname']] for doc in docs])
+                try:
+                    inserted += len(hb.insert_many(docs, ordered=False).inserted_ids)
+                except pymongo.errors.BulkWriteError as e:
+                    inserted += e.details.get('nInserted', 0)
+                    logging.warning(f"⚠️ 批量上架部分失败：nowuid={nowuid}, 错误数={len(e.details.get('writeErrors', []))}")
+            if progress:
+                progress(min(start + INGEST_CHUNK_SIZE, total), total)
+    except Exception as e:
+        logging.error(f"❌ 批量上架失败：nowuid={nowuid} - {e}")
+
+    if inserted:
+        apply_stock_delta(stock_counters, nowuid, uid, available=inserted)
+        rankings.mark_dirty()
+        stock_manager.schedule_notification(nowuid, names[0], inserted)
+
+    elapsed = max(time.time() - started, 1e-6)
+    result = {
+        'inserted': inserted,
+        'skipped': len(items) - inserted,
+        'duplicates': len(items) - total,
+        'existing': existing_count,
+        'elapsed': elapsed,
+        'rate': inserted / elapsed,
+    }
+    logging.info(f"✅ 批量上架完成：nowuid={nowuid}, 新增={inserted}, 跳过={result['skipped']}"
+                 f"（本批重复={result['duplicates']}, 库里已有={result['existing']}）, "
+                 f"{result['rate']:.0f} 个/秒")
+    return result
+
 
 
 
@@ -395,6 +618,8 @@ def erjifenleibiao(uid, nowuid, projectname, row):
         ''',
         'money': 0
     })
+    catalog_changed()
+    search_index_refresh_product(nowuid)
 
 
 def fenleibiao(uid, projectname,row):
@@ -403,6 +628,7 @@ def fenleibiao(uid, projectname,row):
         'projectname': projectname,
         'row': row
     })
+    catalog_changed()
 
 def user_logging(uid, projectname , user_id, today_money, today_time):
     log_data = {
@@ -442,15 +668,299 @@ def kehuduanurl(api, key):
     except Exception as e:
         logging.error(f"❌ 插入客户端URL失败：{api} - {e}")
 
-# ✅ 新增：实用工具函数
-def get_product_stock(nowuid: str) -> int:
-    """获取商品库存数量"""
+# ✅ 库存计数器（stock_counters）
+def get_stock_snapshot(nowuids=None, uids=None, category=None) -> dict:
+    """
+    读取库存快照（一次索引读取，不扫描 hb）
+    返回 {'products': {nowuid: {'available', 'sold'}}, 'categories': {uid: {'available', 'sold'}}}
+    """
     try:
-        return hb.count_documents({'nowuid': nowuid, 'state': 0})
+        return stock_snapshot(stock_counters, nowuids=nowuids, uids=uids, category=category)
     except Exception as e:
-        logging.error(f"❌ 获取库存失败：nowuid={nowuid} - {e}")
+        logging.error(f"❌ 获取库存快照失败：{e}")
+        return {
+            'products': {n: {'available': 0, 'sold': 0} for n in (nowuids or [])},
+            'categories': {u: {'available': 0, 'sold': 0} for u in (uids or [])},
+        }
+
+def adjust_stock_counters(nowuid: str, uid: str, available: int = 0, sold: int = 0):
+    """hb 状态变化后同步调整库存计数（增量）"""
+    apply_stock_delta(stock_counters, nowuid, uid, available=available, sold=sold)
+
+def reconcile_stock_counters(fix: bool = True) -> dict:
+    """从 hb 全量重算库存计数，返回漂移报告"""
+    report = rebuild_stock_counters(hb, stock_counters, ejfl=ejfl, fix=fix)
+    if report['fixed']:
+        invalidate_category_stock()
+    if report['drift']:
+        logging.warning(f"⚠️ 库存计数漂移 {len(report['drift'])} 条，已修正={report['fixed']}")
+    else:
+        logging.info(f"✅ 库存计数对账完成，无漂移（商品 {report['products']} 个）")
+    return report
+
+# ✅ 商品管理卡片统计：一次聚合返回库存、已售、最后售出时间、销售额
+def product_admin_stats(nowuid: str) -> dict:
+    """
+    hb 上用 $facet 同时统计 state=0/1 的数量，再用 $lookup 汇总 gmjlu 的销售记录，
+    只返回计数结果，不把商品文档拉回本地
+
+    旧购买记录没有 amount 字段时按当前价格 × 数量估算；没有 nowuid 的旧记录启动时已由
+    backfill_gmjlu_nowuid 按商品名补写，这里只走 gmjlu 的 (nowuid, timer) 索引
+
+    Returns:
+        {'available', 'sold', 'last_sale', 'revenue'}
+    """
+    stats = {'available': 0, 'sold': 0, 'last_sale': None, 'revenue': 0.0}
+    product = catalog.product(nowuid) or {}
+    price = float(product.get('money', 0) or 0)
+    pipeline = [
+        {'$match': {'nowuid': nowuid}},
+        {'$facet': {
+            'available': [{'$match': {'state': 0}}, {'$count': 'n'}],
+            'sold': [{'$match': {'state': 1}}, {'$count': 'n'}],
+        }},
+        {'$lookup': {
+            'from': gmjlu.name,
+            'pipeline': [
+                {'$match': {'nowuid': nowuid}},
+                {'$group': {
+                    '_id': None,
+                    'last_sale': {'$max': '$timer'},
+                    'revenue': {'$sum': {'$ifNull': [
+                        '$amount', {'$multiply': [{'$ifNull': ['$count', 1]}, price]}
+                    ]}},
+                }},
+            ],
+            'as': 'sales',
+        }},
+    ]
+    try:
+        doc = next(hb.aggregate(pipeline), None) or {}
+        if doc.get('available'):
+            stats['available'] = doc['available'][0]['n']
+        if doc.get('sold'):
+            stats['sold'] = doc['sold'][0]['n']
+        if doc.get('sales'):
+            stats['last_sale'] = doc['sales'][0].get('last_sale')
+            stats['revenue'] = round(float(doc['sales'][0].get('revenue') or 0), 2)
+    except Exception as e:
+        logging.error(f"❌ 商品统计失败：{nowuid} - {e}")
+    return stats
+
+GMJLU_NOWUID_MIGRATION = 'migration:gmjlu_nowuid'
+
+def backfill_gmjlu_nowuid():
+    """
+    给没有 nowuid 的旧购买记录按商品名补写 nowuid（只执行一次，完成后在 counters 中记录）
+
+    同名商品有多个时无法确定归属，跳过并记录日志。
+    """
+    try:
+        if counters.find_one({'_id': GMJLU_NOWUID_MIGRATION}):
+            return 0
+        by_name = {}
+        for product in catalog.products():
+            by_name.setdefault(product.get('projectname'), []).append(product['nowuid'])
+        filled = 0
+        for name in gmjlu.distinct('projectname', {'nowuid': {'$exists': False}}):
+            nowuids = by_name.get(name) or []
+            if len(nowuids) != 1:
+                logging.warning(f"⚠️ 旧购买记录无法确定商品：{name}（匹配 {len(nowuids)} 个）")
+                continue
+            res = gmjlu.update_many({'nowuid': {'$exists': False}, 'projectname': name},
+                                    {'$set': {'nowuid': nowuids[0]}})
+            filled += res.modified_count
+        counters.update_one({'_id': GMJLU_NOWUID_MIGRATION},
+                            {'$set': {'done_at': datetime.now(), 'filled': filled}}, upsert=True)
+        logging.info(f"✅ 旧购买记录补写 nowuid {filled} 条")
+        return filled
+    except Exception as e:
+        logging.error(f"❌ 旧购买记录补写 nowuid 失败：{e}")
+        return 0
+
+# ✅ 一级分类库存服务（商品列表使用），短时缓存，避免每次点击都查询
+CATEGORY_STOCK_CACHE_SECONDS = 5
+_category_stock_cache = {'data': None, 'expires': 0.0}
+_category_stock_lock = threading.Lock()
+
+def _load_category_stock() -> dict:
+    """优先读取分类计数器；计数器不可用时用一次 $group 统计 hb"""
+    try:
+        return {doc['uid']: max(int(doc.get('available', 0)), 0)
+                for doc in stock_counters.find({'kind': 'category'}, {'uid': 1, 'available': 1})}
+    except Exception as e:
+        logging.error(f"❌ 读取分类库存计数失败，改用聚合统计：{e}")
+    pipeline = [
+        {'$match': {'state': 0}},
+        {'$group': {'_id': '$uid', 'available': {'$sum': 1}}}
+    ]
+    return {row['_id']: row['available'] for row in hb.aggregate(pipeline)}
+
+def search_products(query: str) -> list:
+    """
+    按关键词/区号/国家名搜索商品，结果与库存计数合并
+    只返回分类存在、有库存、已设置价格的商品：[{'nowuid', 'name', 'category', 'price', 'stock'}]
+    """
+    try:
+        _ensure_search_index()
+        nowuids = search_index.search(query)
+    except Exception as e:
+        logging.error(f"❌ 商品搜索失败：{query} - {e}")
+        return []
+    stock_map = get_stock_snapshot(nowuids=nowuids)['products']
+    results = []
+    for nowuid in nowuids:
+        product = catalog.product(nowuid)
+        if not product:
+            continue
+        category = catalog.category(product.get('uid'))
+        if not category:
+            continue
+        stock = stock_map[nowuid]['available']
+        money = product.get('money', 0)
+        if stock <= 0 or money <= 0:
+            continue
+        results.append({
+            'nowuid': nowuid,
+            'name': product['projectname'],
+            'category': category.get('projectname', '未知分类'),
+            'price': money,
+            'stock': stock
+        })
+    return results
+
+def get_category_stock(force: bool = False) -> dict:
+    """返回 {fenlei.uid: 可售数量}，结果缓存 CATEGORY_STOCK_CACHE_SECONDS 秒"""
+    with _category_stock_lock:
+        cached = _category_stock_cache['data']
+        if not force and cached is not None and time.time() < _category_stock_cache['expires']:
+            return cached
+    try:
+        data = _load_category_stock()
+    except Exception as e:
+        logging.error(f"❌ 获取分类库存失败：{e}")
+        return cached or {}
+    with _category_stock_lock:
+        _category_stock_cache['data'] = data
+        _category_stock_cache['expires'] = time.time() + CATEGORY_STOCK_CACHE_SECONDS
+    return data
+
+def invalidate_category_stock():
+    """下次读取时重新加载分类库存（对账修正计数器后调用）"""
+    with _category_stock_lock:
+        _category_stock_cache['expires'] = 0.0
+
+def reserve_stock(nowuid: str, qty: int, buyer_id, uid: str = None, leixing: str = None, sale_time: str = None) -> list:
+    """原子占用 qty 个可售商品并标记为已售，库存不足返回空列表（不会超卖）"""
+    try:
+        items = claim_stock_items(hb, nowuid, qty, buyer_id, sale_time=sale_time, leixing=leixing,
+                                  counters=stock_counters, uid=uid)
+        if items:
+            rankings.mark_dirty()
+        return items
+    except Exception as e:
+        logging.error(f"❌ 占用库存失败：nowuid={nowuid}, qty={qty} - {e}")
+        return []
+
+def release_stock(items: list, nowuid: str = None, uid: str = None) -> int:
+    """释放 reserve_stock 占用的商品（扣款失败等场景）"""
+    if not items:
+        return 0
+    try:
+        return release_stock_items(hb, items[0]['claim_token'], counters=stock_counters, nowuid=nowuid, uid=uid)
+    except Exception as e:
+        logging.error(f"❌ 释放库存失败：nowuid={nowuid} - {e}")
         return 0
 
+# ✅ 余额服务：扣款 / 入账都是一次原子写入，返回变更后的余额，同时记录 balance_ledger 流水
+# reason 为流水业务类型（购买、转账、红包、充值、管理员加款等），ref 为关联单号
+def debit_user_balance(user_id, amount, inc: dict = None, set_fields: dict = None, reason: str = '', ref=None):
+    """余额足够时扣款并返回新余额；余额不足返回 None"""
+    try:
+        return debit_balance(user, user_id, amount, inc=inc, set_fields=set_fields,
+                             ledger=balance_ledger, reason=reason, ref=ref)
+    except Exception as e:
+        logging.error(f"❌ 扣款失败：{user_id} - {amount} - {e}")
+        return None
+
+def credit_user_balance(user_id, amount, inc: dict = None, set_fields: dict = None, reason: str = '', ref=None):
+    """入账（amount 为负时直接扣减，不校验余额）并返回新余额；用户不存在或写入失败返回 None"""
+    try:
+        return credit_balance(user, user_id, amount, inc=inc, set_fields=set_fields,
+                              ledger=balance_ledger, reason=reason, ref=ref)
+    except Exception as e:
+        logging.error(f"❌ 入账失败：{user_id} - {amount} - {e}")
+        return None
+
+# ================================ 余额流水 ================================
+
+def balance_scopes():
+    """需要记账的用户集合：总部 user + 每个代理的 agent_users_*"""
+    scopes = [user]
+    try:
+        for bot_info in agent_bots.find({}, {'agent_bot_id': 1}):
+            if bot_info.get('agent_bot_id'):
+                scopes.append(get_agent_bot_user_collection(bot_info['agent_bot_id']))
+    except Exception as e:
+        logging.error(f"❌ 获取代理用户集合失败：{e}")
+    return scopes
+
+def snapshot_all_balances(day=None):
+    """写入总部和所有代理用户的当日余额快照（每天定时执行）"""
+    results = {}
+    for users in balance_scopes():
+        try:
+            results[users.name] = write_balance_snapshots(users, balance_snapshots, balance_ledger, day=day)
+        except Exception as e:
+            logging.error(f"❌ 余额快照失败：{users.name} - {e}")
+    logging.info(f"✅ 余额快照完成：{results}")
+    return results
+
+def user_balance_as_of(user_id, as_of, users=None):
+    """用户在指定时间的余额（快照 + 流水尾部），users 默认总部 user"""
+    try:
+        return balance_as_of(users if users is not None else user, balance_ledger, balance_snapshots, user_id, as_of)
+    except Exception as e:
+        logging.error(f"❌ 查询历史余额失败：{user_id} - {as_of} - {e}")
+        return None
+
+def platform_balance_total():
+    """总部平台余额合计，有完整快照时读快照 + 流水，否则逐个用户求和"""
+    try:
+        total = platform_balance(user, balance_ledger, balance_snapshots)
+        if total is not None:
+            return total
+    except Exception as e:
+        logging.error(f"❌ 读取余额快照失败：{e}")
+    return sum(i.get('USDT', 0) for i in user.find({'USDT': {'$gt': 0}}, {'USDT': 1}))
+
+def verify_all_balances(workers: int = 8, batch_size: int = 500):
+    """校验总部和所有代理用户的余额与流水，返回每个集合的校验结果列表"""
+    results = []
+    for users in balance_scopes():
+        try:
+            results.append(verify_balances(users, balance_ledger, balance_snapshots,
+                                           workers=workers, batch_size=batch_size))
+        except Exception as e:
+            logging.error(f"❌ 余额校验失败：{users.name} - {e}")
+            results.append({'scope': users.name, 'error': str(e)})
+    return results
+
+def init_stock_counters():
+    """首次部署时 stock_counters 为空，从 hb 全量构建一次"""
+    try:
+        ensure_stock_counter_indexes(stock_counters)
+        if stock_counters.estimated_document_count() == 0 and hb.find_one({}, {'_id': 1}) is not None:
+            logging.info("🔧 初始化库存计数器")
+            reconcile_stock_counters(fix=True)
+    except Exception as e:
+        logging.error(f"❌ 初始化库存计数器失败：{e}")
+
+# ✅ 新增：实用工具函数
+def get_product_stock(nowuid: str) -> int:
+    """获取商品库存数量"""
+    return get_stock_snapshot(nowuids=[nowuid])['products'][nowuid]['available']
+
 def get_user_info(user_id: int) -> dict:
     """获取用户信息"""
     try:
@@ -459,9 +969,15 @@ def get_user_info(user_id: int) -> dict:
         logging.error(f"❌ 获取用户信息失败：user_id={user_id} - {e}")
         return {}
 
-def update_user_balance(user_id: int, amount: float, balance_type: str = 'USDT') -> bool:
-    """更新用户余额"""
+def update_user_balance(user_id: int, amount: float, balance_type: str = 'USDT', reason: str = '余额调整') -> bool:
+    """更新用户余额（USDT 变动记录流水）"""
     try:
+        if balance_type == 'USDT':
+            if credit_balance(user, user_id, amount, ledger=balance_ledger, reason=reason) is not None:
+                logging.info(f"✅ 更新用户余额：user_id={user_id}, {balance_type}+={amount}")
+                return True
+            logging.warning(f"⚠️ 用户余额更新无变化：user_id={user_id}")
+            return False
         result = user.update_one(
             {'user_id': user_id},
             {'$inc': {balance_type: amount}}
@@ -496,28 +1012,302 @@ def keybutton(Row, first):
         logging.error(f"❌ 插入按钮模板失败：{e}")
     
     
+def new_user_doc(key_id, user_id, username, fullname, lastname, state, creation_time, last_contact_time):
+    """新用户的完整文档"""
+    return {
+        'count_id': key_id,
+        'user_id': user_id,
+        'username': username,
+        'fullname': fullname,
+        'lastname': lastname,
+        'state': state,
+        'creation_time': creation_time,
+        'last_contact_time': last_contact_time,
+        'USDT': 0,
+        'zgje': 0,
+        'zgsl': 0,
+        'sign': 0,
+        'lang': 'zh',
+        'verified': False   # ✅ 添加这一行
+    }
+
 def user_data(key_id, user_id, username, fullname, lastname, state, creation_time, last_contact_time):
     try:
-        user.insert_one({
-            'count_id': key_id,
-            'user_id': user_id,
-            'username': username,
-            'fullname': fullname,
-            'lastname': lastname,
-            'state': state,
-            'creation_time': creation_time,
-            'last_contact_time': last_contact_time,
-            'USDT': 0,
-            'zgje': 0,
-            'zgsl': 0,
-            'sign': 0,
-            'lang': 'zh',
-            'verified': False   # ✅ 添加这一行
-        })
+        user.insert_one(new_user_doc(key_id, user_id, username, fullname, lastname, state,
+                                     creation_time, last_contact_time))
         logging.info(f"✅ 新增用户：{user_id} ({username})")
     except Exception as e:
         logging.error(f"❌ 用户写入失败：{user_id} - {e}")
 
+def register_or_touch_user(user_id, username, fullname, lastname=None, now=None):
+    """
+    用户进入（/start、收款、领红包）时调用
+
+    老用户：一次 find_one_and_update 更新用户名、昵称、最后联系时间并返回文档
+    新用户：从 counters 原子分配 count_id 后 upsert（$setOnInsert）。user_id 上有唯一索引，
+    并发注册时落后的一方 upsert 报 DuplicateKeyError，改为读取已写入的文档
+
+    Returns:
+        (用户文档, 是否新用户)；数据库异常返回 (None, False)
+    """
+    now = now or time.strftime('%Y-%m-%d %H:%M:%S', time.localtime())
+    touch = {'username': username, 'fullname': fullname, 'last_contact_time': now}
+    try:
+        doc = user.find_one_and_update({'user_id': user_id}, {'$set': touch},
+                                       return_document=pymongo.ReturnDocument.AFTER)
+        if doc is not None:
+            return doc, False
+        count_id = allocate_count_id(counters, user)
+        fresh = new_user_doc(count_id, user_id, username, fullname, lastname, '1', now, now)
+        try:
+            doc = user.find_one_and_update(
+                {'user_id': user_id},
+                {'$set': touch, '$setOnInsert': {k: v for k, v in fresh.items() if k not in touch}},
+                upsert=True,
+                return_document=pymongo.ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # 并发注册：另一次 upsert 已经写入
+            doc = user.find_one_and_update({'user_id': user_id}, {'$set': touch},
+                                           return_document=pymongo.ReturnDocument.AFTER)
+            return doc, False
+        is_new = doc.get('count_id') == count_id
+        if is_new:
+            logging.info(f"✅ 新增用户：{user_id} ({username})")
+        return doc, is_new
+    except Exception as e:
+        logging.error(f"❌ 用户注册失败：{user_id} - {e}")
+        return None, False
+
+# ================================ 本次 update 的用户文档 ================================
+# 同一个 update 内多个函数需要用户文档时只读一次：第一次读取（优先走 user_cache）后挂到 context 上
+# 返回的是同一份副本，handler 写入 lang / sign / USDT 后直接使用写入的值（如语言切换后的 lang 局部变量）
+
+def load_user(context, user_id):
+    """本次 update 的用户文档，用户不存在返回 None"""
+    loaded = getattr(context, 'uinfo_by_id', None)
+    if loaded is None:
+        loaded = {}
+        try:
+            context.uinfo_by_id = loaded
+        except AttributeError:
+            pass
+    if user_id not in loaded:
+        loaded[user_id] = user_cache.get(user_id)
+    return loaded[user_id]
+
+def user_lang(context, user_id):
+    """用户语言，用户不存在时为 zh"""
+    return (load_user(context, user_id) or {}).get('lang', 'zh')
+
+# ================================ USDT 充值订单 ================================
+# 待支付订单按整数 micro-USDT 金额（amount_micro）唯一，jiexi 用 pending_recharges 批量精确匹配
+pending_recharges = PendingRecharges(topup)
+# 待支付订单按 expire_at 到期（最小堆），expire_topups 任务只处理到期的订单
+topup_expiry = TopupExpiry(topup, pending_recharges)
+
+# 尾数 0.01~0.50：两位小数 50 个，四位小数 0.0100~0.5000 共 4901 个
+_suffix_pools = {}
+
+def _suffix_pool(digits: int):
+    if digits not in _suffix_pools:
+        lo = 10 ** (digits - 2)
+        _suffix_pools[digits] = AmountSlots(amount_slots, 50 * lo - lo + 1)
+    return _suffix_pools[digits]
+
+def _pending_slots(key):
+    """已写入待支付订单的尾数（位图满时据此回收过期占用）"""
+    return {o['amount_slot']['slot'] for o in topup.find(
+        {'status': 'pending', 'amount_slot.key': key}, {'amount_slot': 1})}
+
+def allocate_amount_suffix(key: str, base_amount, digits: int = 2, is_taken=None):
+    """
+    从 key（收款地址 / 支付方式 + 基础金额）的位图中分配一个尾数
+
+    Args:
+        is_taken: 可选，total -> bool，合计金额与其他基础金额的待支付订单相同时换一个尾数
+
+    Returns:
+        (amount_slot, suijishu, total)；尾数全部占用时返回 None
+    """
+    lo = 10 ** (digits - 2)
+    pool = _suffix_pool(digits)
+    held = []
+    try:
+        while True:
+            slot = pool.acquire(key, reclaim=lambda: _pending_slots(key))
+            if slot is None:
+                logging.error(f"❌ 充值金额尾数已用完：{key}")
+                return None
+            suijishu = Decimal(lo + slot) / (10 ** digits)
+            total = Decimal(str(base_amount)) + suijishu
+            if is_taken and is_taken(total):
+                held.append(slot)
+                continue
+            return {'key': key, 'slot': slot}, float(suijishu), float(total)
+    finally:
+        for slot in held:
+            pool.release(key, slot)
+
+def release_topup_slot(order: dict):
+    """订单到账 / 取消 / 过期后释放尾数"""
+    try:
+        _suffix_pool(2).release_order(order)
+    except Exception as e:
+        logging.error(f"❌ 释放充值尾数失败：{e}")
+
+def create_usdt_topup(order: dict, base_amount, digits: int = 2, attempts: int = 20):
+    """
+    写入 USDT 充值订单，尾数 0.01~0.50 由位图分配，保证金额在待支付订单中唯一
+
+    Args:
+        order: 订单的其他字段（bianhao、user_id、timer、expire_at 等），money / suijishu / amount_micro 由本函数填写，
+            未给 expire_at 时按 ORDER_TTL 计算
+        digits: 尾数小数位数
+
+    Returns:
+        写入的订单文档；尾数用完时返回 None
+    """
+    address = (shangtext.find_one({'projectname': '充值地址'}) or {}).get('text', '')
+    key = f"usdt:{address}:{digits}:{format(Decimal(str(base_amount)).normalize(), 'f')}"
+    for _ in range(attempts):
+        allocated = allocate_amount_suffix(key, base_amount, digits,
+                                           is_taken=lambda total: pending_recharges.is_pending(to_micro(total)))
+        if allocated is None:
+            break
+        amount_slot, suijishu, total_money = allocated
+        doc = dict(order, money=total_money, suijishu=suijishu, amount_micro=to_micro(total_money),
+                   amount_slot=amount_slot, cz_type='usdt', status='pending')
+        doc.setdefault('expire_at', datetime.now() + ORDER_TTL)
+        try:
+            topup.insert_one(doc)
+        except DuplicateKeyError:
+            # 与其他基础金额的订单撞金额（内存映射尚未刷新），换一个尾数
+            release_topup_slot(doc)
+            continue
+        pending_recharges.add(doc)
+        topup_expiry.schedule(doc)
+        return doc
+    logging.error(f"❌ 充值金额尾数分配失败：user_id={order.get('user_id')}, base={base_amount}")
+    return None
+
+def allocate_rmb_amount(paytype: str, base_rmb):
+    """
+    微信 / 支付宝订单金额：基础金额 + 0.01~0.50 尾数
+
+    Returns:
+        (amount_slot, suijishu, final_rmb)；尾数用完时返回 None
+    """
+    return allocate_amount_suffix(
+        f"rmb:{paytype}:{format(Decimal(str(base_rmb)).normalize(), 'f')}", base_rmb,
+        is_taken=lambda total: topup.find_one({'money': float(total), 'status': 'pending'}) is not None)
+
+def drop_pending_topups(user_id):
+    """删除用户所有待支付订单（重新下单前），返回被删除的订单"""
+    orders = list(topup.find({'user_id': user_id, 'status': 'pending'}))
+    if orders:
+        topup.delete_many({'_id': {'$in': [o['_id'] for o in orders]}, 'status': 'pending'})
+        for o in orders:
+            pending_recharges.discard(o.get('amount_micro'))
+            release_topup_slot(o)
+    return orders
+
+# ================================ 红包 ================================
+# 创建红包时一次算好全部份额：
+#   amounts 为全部份额（不变），shares 为剩余份额，领取时 $pop 掉最后一个
+#   claims 按领取顺序记录领取人，第 i 个领取人领到的是 amounts[len(amounts) - 1 - i]
+#   领取只有一次 find_one_and_update（$pop 份额 + $addToSet 领取人），不再读 qb 计算金额
+
+def split_red_packet(total, count):
+    """按正态分布（标准差为均值的 1/3）拆分红包，单位 0.01，每份至少 0.01，合计严格等于 total"""
+    remaining = int(round(float(total) * 100))
+    shares = []
+    for left in range(count, 1, -1):
+        mean = remaining / left
+        cents = max(1, int(round(random.normalvariate(mean, mean / 3))))
+        cents = min(cents, remaining - (left - 1))
+        shares.append(cents)
+        remaining -= cents
+    shares.append(remaining)
+    random.shuffle(shares)  # 最后一份是余数，打乱后先领后领机会相同
+    return [round(c / 100, 2) for c in shares]
+
+def create_red_packet(uid, user_id, fullname, money, hbsl, timer):
+    """写入红包并预先拆分好全部份额"""
+    amounts = split_red_packet(money, hbsl)
+    hongbao.insert_one({
+        'uid': uid,
+        'user_id': user_id,
+        'fullname': fullname,
+        'hbmoney': money,
+        'hbsl': hbsl,
+        'timer': timer,
+        'state': 0,
+        'amounts': amounts,
+        'shares': list(amounts),
+        'claimed_by': [],
+        'claims': []
+    })
+
+def _presplit_legacy_red_packet(packet):
+    """升级前创建的红包没有份额数组：按 qb 中已领取的记录补齐一次"""
+    if 'amounts' in packet:
+        return packet
+    claimed = list(qb.find({'uid': packet['uid']}, sort=[('timer', 1)]))
+    left = packet['hbsl'] - len(claimed)
+    remaining = round(packet['hbmoney'] - sum(q['money'] for q in claimed), 2)
+    shares = split_red_packet(remaining, left) if left > 0 and remaining >= 0.01 * left else []
+    amounts = shares + [q['money'] for q in reversed(claimed)]
+    hongbao.update_one({'uid': packet['uid'], 'amounts': {'$exists': False}}, {'$set': {
+        'amounts': amounts,
+        'shares': shares,
+        'claimed_by': [q['user_id'] for q in claimed],
+        'claims': [{'user_id': q['user_id'], 'fullname': q['fullname'], 'timer': q['timer']} for q in claimed],
+        'state': 0 if shares else 1
+    }})
+    return hongbao.find_one({'uid': packet['uid']})
+
+def get_red_packet(uid):
+    """读取红包（旧红包自动补齐份额），不存在返回 None"""
+    packet = hongbao.find_one({'uid': uid})
+    return _presplit_legacy_red_packet(packet) if packet else None
+
+def claim_red_packet(uid, user_id, fullname, timer):
+    """
+    领取一份红包
+
+    Returns:
+        (金额, 领取后的红包文档)；已领过、已抢完或红包不存在时金额为 None，文档为当前红包
+    """
+    for _ in range(2):
+        packet = hongbao.find_one_and_update(
+            {'uid': uid, 'state': 0, 'claimed_by': {'$ne': user_id}, 'shares.0': {'$exists': True}},
+            {'$pop': {'shares': 1},
+             '$addToSet': {'claimed_by': user_id},
+             '$push': {'claims': {'user_id': user_id, 'fullname': fullname, 'timer': timer}}},
+            return_document=pymongo.ReturnDocument.AFTER
+        )
+        if packet is not None:
+            break
+        current = hongbao.find_one({'uid': uid})
+        if current is None or 'amounts' in current:
+            return None, current
+        # 旧红包还没有份额数组：补齐后再领一次
+        _presplit_legacy_red_packet(current)
+    else:
+        return None, get_red_packet(uid)
+    money = packet['amounts'][len(packet['amounts']) - len(packet['claims'])]
+    if not packet['shares']:
+        hongbao.update_one({'uid': uid, 'state': 0}, {'$set': {'state': 1}})
+        packet['state'] = 1
+    return money, packet
+
+def red_packet_claims(packet):
+    """红包领取记录（含金额），按金额从高到低排序"""
+    amounts = packet.get('amounts', [])
+    claims = [dict(c, money=amounts[len(amounts) - 1 - i]) for i, c in enumerate(packet.get('claims', []))]
+    return sorted(claims, key=lambda c: c['money'], reverse=True)
+
 if shangtext.find_one({}) is None:
     logging.info("🔧 初始化 shangtext 数据")
     fstext = '''
@@ -693,7 +1483,7 @@ def get_agent_bot_user_collection(agent_bot_id):
     id_suffix = _get_agent_id_suffix(agent_bot_id)
     collection_name = f"agent_users_{id_suffix}"
     logging.info(f"🔍 获取用户集合: agent_bot_id={agent_bot_id}, collection={collection_name}")
-    return db_manager.bot_db[collection_name]
+    return ensure_dynamic_indexes(db_manager.bot_db[collection_name])
 
 def get_agent_bot_topup_collection(agent_bot_id):
     """获取代理机器人的独立充值记录集合"""
@@ -705,7 +1495,7 @@ def get_agent_bot_gmjlu_collection(agent_bot_id):
     """获取代理机器人的独立购买记录集合"""
     id_suffix = _get_agent_id_suffix(agent_bot_id)
     collection_name = f"agent_gmjlu_{id_suffix}"
-    return db_manager.bot_db[collection_name]
+    return ensure_dynamic_indexes(db_manager.bot_db[collection_name])
 
 def create_agent_user_data(agent_bot_id, user_id, username, fullname, creation_time):
     """在代理机器人中创建独立用户"""
@@ -713,9 +1503,7 @@ def create_agent_user_data(agent_bot_id, user_id, username, fullname, creation_t
         agent_bot_id = normalize_agent_bot_id(agent_bot_id)
         agent_users = get_agent_bot_user_collection(agent_bot_id)
         
-        # 获取该代理机器人的最大count_id
-        last_user = agent_users.find_one(sort=[('count_id', -1)])
-        count_id = (last_user['count_id'] if last_user else 0) + 1
+        count_id = allocate_count_id(counters, agent_users)
         
         agent_users.insert_one({
             'count_id': count_id,                   # 代理内部用户编号
@@ -783,8 +1571,8 @@ def ensure_agent_user_exists(agent_bot_id, user_id, username=None, fullname=None
         logging.error(f"❌ 确保代理用户存在失败：{e}")
         return False, None
 
-def update_agent_bot_user_balance(agent_bot_id, user_id, amount, balance_type='USDT'):
-    """更新代理机器人用户余额（独立系统）"""
+def update_agent_bot_user_balance(agent_bot_id, user_id, amount, balance_type='USDT', reason='管理员调整'):
+    """更新代理机器人用户余额（独立系统），USDT 变动记录流水，扣减时余额不足返回 False"""
     try:
         agent_bot_id = normalize_agent_bot_id(agent_bot_id)
         
@@ -795,6 +1583,14 @@ def update_agent_bot_user_balance(agent_bot_id, user_id, amount, balance_type='U
             return False
         
         agent_users = get_agent_bot_user_collection(agent_bot_id)
+        if balance_type == 'USDT':
+            change = debit_balance if amount < 0 else credit_balance
+            new_balance = change(agent_users, user_id, abs(amount) if amount < 0 else amount,
+                                 ledger=balance_ledger, reason=reason)
+            if new_balance is not None:
+                logging.info(f"✅ 更新代理用户余额：agent_bot_id={agent_bot_id}, user_id={user_id}, {balance_type}+={amount}")
+                return True
+            return False
         result = agent_users.update_one(
             {'user_id': user_id},
             {'$inc': {balance_type: amount}}
@@ -830,12 +1626,8 @@ def get_agent_product_price(agent_bot_id, original_nowuid):
         return None
 
 def get_real_time_stock(original_nowuid):
-    """获取实时库存（从总部）"""
-    try:
-        return hb.count_documents({'nowuid': original_nowuid, 'state': 0})
-    except Exception as e:
-        logging.error(f"❌ 获取实时库存失败：{e}")
-        return 0
+    """获取实时库存（从总部库存计数器）"""
+    return get_product_stock(original_nowuid)
 
 def generate_agent_bot_id():
     """生成代理机器人唯一ID"""
@@ -1202,8 +1994,55 @@ def init_multi_bot_distribution_system():
         logging.error(f"❌ 多机器人分销系统初始化失败：{e}")
         return False
 
+def dedupe_users():
+    """
+    user_id 唯一索引建立前清理重复用户：保留最早写入的文档，删除余额、消费都为 0 的重复文档
+
+    有余额或消费记录的重复文档不自动删除，记录错误等待人工合并（唯一索引届时不会建立）。
+    user_id 已是唯一索引时直接返回。
+    """
+    try:
+        if any(info['key'] == [('user_id', 1)] and info.get('unique') for info in user.index_information().values()):
+            return 0
+        removed = 0
+        for group in user.aggregate([
+            {'$group': {'_id': '$user_id', 'ids': {'$push': '$_id'}, 'n': {'$sum': 1}}},
+            {'$match': {'n': {'$gt': 1}}},
+        ], allowDiskUse=True):
+            extra = sorted(group['ids'])[1:]
+            res = user.delete_many({'_id': {'$in': extra}, 'USDT': {'$in': [0, None]},
+                                    'zgje': {'$in': [0, None]}, 'zgsl': {'$in': [0, None]}})
+            removed += res.deleted_count
+            if res.deleted_count < len(extra):
+                logging.error(f"❌ 重复用户有余额或消费记录，需人工合并：user_id={group['_id']}")
+        if removed:
+            logging.info(f"✅ 清理重复用户 {removed} 条")
+        return removed
+    except Exception as e:
+        logging.error(f"❌ 清理重复用户失败：{e}")
+        return 0
+
+def init_hq_indexes():
+    """按 db_indexes 清单在后台补建总部热点集合的索引"""
+    try:
+        dedupe_users()
+        reconcile_index_manifest(index_databases())
+    except Exception as e:
+        logging.error(f"❌ 启动索引对账失败：{e}")
+
+def index_databases() -> dict:
+    """索引清单中的数据库键到数据库对象的映射"""
+    return {'main': main_db, 'bot': bot_db}
+
+def diagnose_hot_queries() -> list:
+    """对热点查询执行 explain()，返回是否仍为全表扫描"""
+    return explain_hot_queries(index_databases())
+
 # 初始化系统
 init_multi_bot_distribution_system()
+init_hq_indexes()
+init_stock_counters()
+backfill_gmjlu_nowuid()
 
 print("🤖 多机器人分销系统数据表加载完成")
 if __name__ == '__main__':
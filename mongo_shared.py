@@ -0,0 +1,831 @@
+"""
+总部 mongo.py 与代理机器人 agent/agent_bot.py 共用的数据层逻辑
+
+本模块只接收集合对象作为参数，导入时不连接数据库、不读取环境变量：
+- 总部通过 mongo.py 中绑定好集合的包装函数调用
+- 代理机器人直接传入自己 config 中的集合
+"""
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from decimal import Decimal, ROUND_HALF_UP
+
+from pymongo import UpdateOne, ReplaceOne, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+# ================================ 库存计数器 ================================
+# stock_counters 集合文档结构：
+#   商品: {'_id': 'p:<nowuid>', 'kind': 'product',  'nowuid', 'uid', 'available', 'sold', 'updated_at'}
+#   分类: {'_id': 'c:<uid>',    'kind': 'category', 'uid', 'available', 'sold', 'updated_at'}
+# available 对应 hb 中 state=0 的数量，sold 对应 state=1 的数量
+
+def product_counter_id(nowuid):
+    return f'p:{nowuid}'
+
+def category_counter_id(uid):
+    return f'c:{uid}'
+
+def ensure_stock_counter_indexes(counters):
+    """商品计数按一级分类读取（分类页）时使用的索引"""
+    counters.create_index([('kind', 1), ('uid', 1)], background=True)
+
+def apply_stock_delta(counters, nowuid, uid, available=0, sold=0):
+    """
+    原子地调整商品及其一级分类的库存计数（$inc + upsert，一次往返）
+    available/sold 为增量，可以为负数
+    """
+    if not nowuid or (not available and not sold):
+        return
+    now = datetime.now()
+    inc = {'available': available, 'sold': sold}
+    ops = [UpdateOne(
+        {'_id': product_counter_id(nowuid)},
+        {'$inc': inc, '$set': {'kind': 'product', 'nowuid': nowuid, 'uid': uid, 'updated_at': now}},
+        upsert=True
+    )]
+    if uid:
+        ops.append(UpdateOne(
+            {'_id': category_counter_id(uid)},
+            {'$inc': inc, '$set': {'kind': 'category', 'uid': uid, 'updated_at': now}},
+            upsert=True
+        ))
+    try:
+        counters.bulk_write(ops, ordered=False)
+    except Exception as e:
+        # 计数器失败不影响主流程，由对账任务修正
+        logging.error(f"❌ 更新库存计数失败：nowuid={nowuid}, available={available}, sold={sold} - {e}")
+
+def _counter_values(doc):
+    if not doc:
+        return {'available': 0, 'sold': 0}
+    return {
+        'available': max(int(doc.get('available', 0)), 0),
+        'sold': max(int(doc.get('sold', 0)), 0),
+    }
+
+def stock_snapshot(counters, nowuids=None, uids=None, category=None):
+    """
+    一次索引读取返回库存快照
+
+    Args:
+        nowuids: 需要的商品 nowuid 列表
+        uids: 需要的一级分类 uid 列表
+        category: 返回该一级分类下所有商品的计数
+
+    Returns:
+        {'products': {nowuid: {'available', 'sold'}}, 'categories': {uid: {'available', 'sold'}}}
+        请求了但没有计数记录的商品/分类按 0 返回
+    """
+    nowuids = [n for n in (nowuids or []) if n]
+    uids = [u for u in (uids or []) if u]
+    ids = [product_counter_id(n) for n in nowuids] + [category_counter_id(u) for u in uids]
+
+    conditions = []
+    if ids:
+        conditions.append({'_id': {'$in': ids}})
+    if category:
+        conditions.append({'kind': 'product', 'uid': category})
+
+    snapshot = {
+        'products': {n: _counter_values(None) for n in nowuids},
+        'categories': {u: _counter_values(None) for u in uids},
+    }
+    if not conditions:
+        return snapshot
+
+    query = conditions[0] if len(conditions) == 1 else {'$or': conditions}
+    for doc in counters.find(query):
+        if doc.get('kind') == 'category':
+            snapshot['categories'][doc['uid']] = _counter_values(doc)
+        else:
+            snapshot['products'][doc['nowuid']] = _counter_values(doc)
+    return snapshot
+
+def rebuild_stock_counters(hb, counters, ejfl=None, fix=True):
+    """
+    从 hb 全量重新统计库存计数，并与现有计数器比对
+
+    fix=True 时按差值 $inc 修正计数器（不整条覆盖），对账期间并发购买 / 上架的 $inc 不会丢失。
+    统计与读取计数器之间发生的变化仍可能被算进差值，因此该任务应在低峰期运行，下一轮对账会再次修正。
+
+    Returns:
+        {'products': 商品数, 'categories': 分类数, 'drift': [{'_id', 'expected', 'actual'}], 'fixed': bool}
+    """
+    # 商品所属分类以 ejfl 为准，hb 中的 uid 仅作回退
+    product_uid = {}
+    if ejfl is not None:
+        for doc in ejfl.find({}, {'nowuid': 1, 'uid': 1}):
+            product_uid[doc.get('nowuid')] = doc.get('uid')
+
+    pipeline = [
+        {'$match': {'state': {'$in': [0, 1]}}},
+        {'$group': {
+            '_id': '$nowuid',
+            'uid': {'$first': '$uid'},
+            'available': {'$sum': {'$cond': [{'$eq': ['$state', 0]}, 1, 0]}},
+            'sold': {'$sum': {'$cond': [{'$eq': ['$state', 1]}, 1, 0]}},
+        }}
+    ]
+
+    expected = {}
+    category_totals = {}
+    for row in hb.aggregate(pipeline, allowDiskUse=True):
+        nowuid = row['_id']
+        if not nowuid:
+            continue
+        uid = product_uid.get(nowuid) or row.get('uid')
+        expected[product_counter_id(nowuid)] = {
+            'kind': 'product', 'nowuid': nowuid, 'uid': uid,
+            'available': row['available'], 'sold': row['sold']
+        }
+        if uid:
+            total = category_totals.setdefault(uid, {'available': 0, 'sold': 0})
+            total['available'] += row['available']
+            total['sold'] += row['sold']
+
+    for uid, total in category_totals.items():
+        expected[category_counter_id(uid)] = {'kind': 'category', 'uid': uid, **total}
+
+    actual = {doc['_id']: doc for doc in counters.find({})}
+
+    drift = []
+    ops = []
+    now = datetime.now()
+    for counter_id, values in expected.items():
+        current = actual.get(counter_id)
+        current_values = {'available': current.get('available', 0), 'sold': current.get('sold', 0)} if current else None
+        if current_values != {'available': values['available'], 'sold': values['sold']}:
+            drift.append({'_id': counter_id, 'expected': values, 'actual': current_values})
+            base = current_values or {'available': 0, 'sold': 0}
+            meta = {k: v for k, v in values.items() if k not in ('available', 'sold')}
+            ops.append(UpdateOne({'_id': counter_id}, {
+                '$inc': {'available': values['available'] - base['available'], 'sold': values['sold'] - base['sold']},
+                '$set': dict(meta, updated_at=now),
+            }, upsert=True))
+    for counter_id, current in actual.items():
+        if counter_id not in expected and (current.get('available') or current.get('sold')):
+            current_values = {'available': current.get('available', 0), 'sold': current.get('sold', 0)}
+            drift.append({'_id': counter_id, 'expected': None, 'actual': current_values})
+            ops.append(UpdateOne({'_id': counter_id}, {
+                '$inc': {'available': -current_values['available'], 'sold': -current_values['sold']},
+                '$set': {'updated_at': now},
+            }))
+
+    if fix and ops:
+        counters.bulk_write(ops, ordered=False)
+
+    return {
+        'products': sum(1 for v in expected.values() if v['kind'] == 'product'),
+        'categories': len(category_totals),
+        'drift': drift,
+        'fixed': bool(fix and ops),
+    }
+
+# ================================ 库存原子占用 ================================
+# 占用流程：按 claim_token 标记 -> 按 token 取回
+#   1. 读取 qty 个候选 _id，update_many({'_id': {'$in': ids}, 'state': 0}, {'$set': {'state': 1, 'claim_token': token}})
+#      过滤条件中的 state=0 保证同一件商品只会被一个买家改成已售
+#   2. 被并发买家抢走的差额用 find_one_and_update 逐个补齐（由服务端挑选下一件可售商品）
+#   3. 补不齐说明库存不足，整体释放（全有或全无）
+#   4. find({'claim_token': token}) 一次取回占用到的完整文档
+# 无竞争时一次购买为 3 次往返：读候选 / 批量标记 / 按 token 取回
+
+def claim_stock_items(hb, nowuid, qty, buyer_id, sale_time=None, leixing=None,
+                      counters=None, uid=None, extra_set=None):
+    """
+    原子地占用 qty 个可售商品，返回占用到的 hb 文档列表
+
+    库存不足时返回空列表，且不会留下任何被占用的商品。
+    counters 不为空时同步调整库存计数（uid 为商品所属一级分类）。
+    """
+    if qty <= 0:
+        return []
+    sale_time = sale_time or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    token = f'{buyer_id}:{uuid.uuid4().hex}'
+
+    query = {'nowuid': nowuid, 'state': 0}
+    if leixing:
+        query['leixing'] = leixing
+
+    update_set = {'state': 1, 'yssj': sale_time, 'sale_time': sale_time, 'gmid': buyer_id, 'claim_token': token}
+    if extra_set:
+        update_set.update(extra_set)
+
+    candidates = [doc['_id'] for doc in hb.find(query, {'_id': 1}).limit(qty)]
+    if len(candidates) < qty:
+        logging.info(f"ℹ️ 库存不足，占用失败：nowuid={nowuid}, 需要={qty}, 可得={len(candidates)}")
+        return []
+
+    claimed = hb.update_many({'_id': {'$in': candidates}, 'state': 0}, {'$set': update_set}).modified_count
+    while claimed < qty:
+        doc = hb.find_one_and_update(query, {'$set': update_set}, projection={'_id': 1})
+        if doc is None:
+            break
+        claimed += 1
+
+    if claimed < qty:
+        release_stock_items(hb, token)
+        logging.info(f"ℹ️ 库存不足，占用失败：nowuid={nowuid}, 需要={qty}, 可得={claimed}")
+        return []
+
+    items = list(hb.find({'claim_token': token}))
+    if counters is not None:
+        apply_stock_delta(counters, nowuid, uid, available=-len(items), sold=len(items))
+    return items
+
+def release_stock_items(hb, token, counters=None, nowuid=None, uid=None):
+    """释放某次占用（例如扣款失败时），商品恢复为可售"""
+    result = hb.update_many(
+        {'claim_token': token, 'state': 1},
+        {'$set': {'state': 0}, '$unset': {'yssj': '', 'sale_time': '', 'gmid': '', 'claim_token': ''}}
+    )
+    if counters is not None and result.modified_count:
+        apply_stock_delta(counters, nowuid, uid, available=result.modified_count, sold=-result.modified_count)
+    return result.modified_count
+
+# ================================ 余额原子变更 ================================
+# 余额（USDT）原来是 "读出 -> Python 计算 -> $set 写回"，并发点击时会丢失更新。
+# 现在一次 find_one_and_update 完成校验和修改：
+#   扣款过滤条件带 USDT >= 金额，余额不足时不匹配任何文档，不会扣成负数
+#   更新使用聚合管道，服务端按 BALANCE_DIGITS 位小数 $round，避免浮点累计误差
+#   累计字段（zgje、zgsl 等）和需要顺带重置的字段（sign）在同一次写入中完成
+# 需要 MongoDB 4.2+（管道更新 / $round）
+
+BALANCE_DIGITS = 6
+BALANCE_QUANT = Decimal(1).scaleb(-BALANCE_DIGITS)
+
+
+def balance_amount(value):
+    """金额按 BALANCE_DIGITS 位小数取整（Decimal 计算，返回 float 以兼容现有数据）"""
+    return float(Decimal(str(value)).quantize(BALANCE_QUANT, rounding=ROUND_HALF_UP))
+
+
+def _balance_pipeline(delta, inc=None, set_fields=None, entry=None):
+    new_balance = {'$round': [{'$add': [{'$ifNull': ['$USDT', 0]}, delta]}, BALANCE_DIGITS]}
+    fields = {'USDT': new_balance}
+    for field, value in (inc or {}).items():
+        added = {'$add': [{'$ifNull': [f'${field}', 0]}, value]}
+        if not isinstance(value, int):  # 数量类字段保持整数，金额类字段取整
+            added = {'$round': [{'$add': [{'$ifNull': [f'${field}', 0]}, balance_amount(value)]}, BALANCE_DIGITS]}
+        fields[field] = added
+    for field, value in (set_fields or {}).items():
+        fields[field] = {'$literal': value}
+    if entry is not None:
+        # 同一个 $set 阶段内引用的都是修改前的值：序号 +1，流水余额与新余额同一表达式
+        seq = {'$add': [{'$ifNull': ['$ledger_seq', 0]}, 1]}
+        fields['ledger_seq'] = seq
+        fields['ledger_last'] = {
+            'seq': seq,
+            'delta': {'$literal': delta},
+            'balance': new_balance,
+            'reason': {'$literal': entry.get('reason', '')},
+            'ref': {'$literal': entry.get('ref')},
+            'at': {'$literal': entry['at']},
+        }
+    return [{'$set': fields}]
+
+
+def _ledger_entry(users, user_id, doc):
+    scope = users.name
+    last = doc['ledger_last']
+    return dict(last, _id=f"{scope}:{user_id}:{last['seq']}", scope=scope, user_id=user_id)
+
+
+def _write_ledger(ledger, users, user_id, doc):
+    """余额修改成功后写入流水；写入失败时 ledger_last 仍保存在用户文档上，由快照任务补写"""
+    try:
+        ledger.insert_one(_ledger_entry(users, user_id, doc))
+    except DuplicateKeyError:
+        pass
+    except Exception as e:
+        logging.error(f"❌ 写入余额流水失败（等待快照任务补写）：{users.name} {user_id} - {e}")
+
+
+def _change_balance(users, query, user_id, delta, inc, set_fields, ledger, reason, ref):
+    entry = {'reason': reason, 'ref': ref, 'at': datetime.now()} if ledger is not None else None
+    projection = {'USDT': 1, '_id': 0}
+    if entry is not None:
+        projection['ledger_last'] = 1
+    doc = users.find_one_and_update(
+        query,
+        _balance_pipeline(delta, inc, set_fields, entry),
+        projection=projection,
+        return_document=ReturnDocument.AFTER
+    )
+    if doc is None:
+        return None
+    if entry is not None:
+        _write_ledger(ledger, users, user_id, doc)
+    return doc['USDT']
+
+
+def debit_balance(users, user_id, amount, inc=None, set_fields=None, ledger=None, reason='', ref=None):
+    """
+    余额足够时扣款，返回扣款后的余额；余额不足或用户不存在返回 None
+
+    Args:
+        users: 用户集合（总部 user 或代理 agent_users_*）
+        inc: 同时累加的字段，如 {'zgje': 金额, 'zgsl': 数量}
+        set_fields: 同时设置的字段，如 {'sign': 0}
+        ledger: balance_ledger 集合，传入时记录一条流水
+        reason / ref: 流水的业务类型和关联单号
+    """
+    amount = balance_amount(amount)
+    return _change_balance(users, {'user_id': user_id, 'USDT': {'$gte': amount}}, user_id,
+                           -amount, inc, set_fields, ledger, reason, ref)
+
+
+def credit_balance(users, user_id, amount, inc=None, set_fields=None, ledger=None, reason='', ref=None):
+    """入账（amount 可以为负，不做余额校验），返回入账后的余额；用户不存在返回 None"""
+    return _change_balance(users, {'user_id': user_id}, user_id,
+                           balance_amount(amount), inc, set_fields, ledger, reason, ref)
+
+# ================================ 余额流水与快照 ================================
+# balance_ledger：每次余额变更一条，只追加
+#   {_id: "{scope}:{user_id}:{seq}", scope, user_id, seq, delta, balance, reason, ref, at}
+#   scope 为用户集合名（总部 user，代理 agent_users_*），seq 在修改余额的同一次 find_one_and_update
+#   中递增（用户文档上的 ledger_seq），同时把整条流水写入用户文档的 ledger_last。
+#   MongoDB 单机不支持多文档事务，随后插入 balance_ledger 若失败，快照任务会用 ledger_last 补写；
+#   序号不连续说明中间的流水丢失，由校验命令报告。
+# balance_snapshots：每天每个用户一条 {_id: "{scope}:{user_id}:{date}", scope, user_id, date, seq, balance, at}
+#   seq / balance 取自同一个用户文档，快照之后的流水就是 seq 更大的那些
+#   每次快照完成后写一条 {_id: "{scope}:{date}", scope, date, at, users, complete} 标记
+
+LEDGER_BATCH_SIZE = 1000
+
+
+def _same_amount(a, b):
+    return abs(balance_amount(a or 0) - balance_amount(b or 0)) < float(BALANCE_QUANT)
+
+
+def write_balance_snapshots(users, snapshots, ledger, day=None, batch_size=LEDGER_BATCH_SIZE):
+    """
+    为 users 中的每个用户写入 day（默认今天，'%Y-%m-%d'）的余额快照，并补写丢失的最后一条流水
+
+    Returns:
+        {'users': 快照数, 'repaired': 补写的流水数}
+    """
+    scope = users.name
+    run_at = datetime.now()
+    day = day or run_at.strftime('%Y-%m-%d')
+    written = repaired = 0
+    ops, lasts = [], []
+
+    def flush():
+        nonlocal repaired
+        if ops:
+            snapshots.bulk_write(ops, ordered=False)
+        if lasts:
+            found = {d['_id'] for d in ledger.find({'_id': {'$in': [e['_id'] for e in lasts]}}, {'_id': 1})}
+            missing = [e for e in lasts if e['_id'] not in found]
+            if missing:
+                try:
+                    ledger.insert_many(missing, ordered=False)
+                except BulkWriteError:
+                    pass
+                repaired += len(missing)
+        ops.clear()
+        lasts.clear()
+
+    cursor = users.find({}, {'user_id': 1, 'USDT': 1, 'ledger_seq': 1, 'ledger_last': 1, '_id': 0})
+    for doc in cursor:
+        user_id = doc.get('user_id')
+        if user_id is None:
+            continue
+        ops.append(ReplaceOne({'_id': f"{scope}:{user_id}:{day}"}, {
+            'scope': scope, 'user_id': user_id, 'date': day, 'at': run_at,
+            'seq': doc.get('ledger_seq', 0), 'balance': balance_amount(doc.get('USDT', 0) or 0),
+        }, upsert=True))
+        if doc.get('ledger_last'):
+            lasts.append(_ledger_entry(users, user_id, doc))
+        written += 1
+        if len(ops) >= batch_size:
+            flush()
+    flush()
+    snapshots.replace_one({'_id': f"{scope}:{day}"}, {
+        'scope': scope, 'date': day, 'at': run_at, 'users': written, 'complete': True,
+    }, upsert=True)
+    if repaired:
+        logging.warning(f"⚠️ {scope} 补写了 {repaired} 条丢失的余额流水")
+    return {'users': written, 'repaired': repaired}
+
+
+def balance_as_of(users, ledger, snapshots, user_id, as_of):
+    """
+    用户在 as_of（datetime）时的余额：最近一条不晚于 as_of 的快照 + 之后的流水尾部
+
+    流水记录的是变更后的余额，尾部只需取 as_of 之前的最后一条。
+    """
+    scope = users.name
+    snap = snapshots.find_one({'scope': scope, 'user_id': user_id, 'at': {'$lte': as_of}},
+                              sort=[('at', -1)])
+    query = {'scope': scope, 'user_id': user_id, 'at': {'$lte': as_of}}
+    if snap:
+        query['seq'] = {'$gt': snap['seq']}
+    last = ledger.find_one(query, sort=[('seq', -1)])
+    if last:
+        return last['balance']
+    if snap:
+        return snap['balance']
+    # 没有更早的快照和流水：第一条流水之前的余额，没有流水说明余额从未变动
+    first = ledger.find_one({'scope': scope, 'user_id': user_id}, sort=[('seq', 1)])
+    if first:
+        return balance_amount(first['balance'] - first['delta'])
+    doc = users.find_one({'user_id': user_id}, {'USDT': 1})
+    return balance_amount((doc or {}).get('USDT', 0) or 0)
+
+
+def platform_balance(users, ledger, snapshots):
+    """
+    全平台余额合计：最近一次完整快照的合计 + 快照之后的流水变动
+
+    没有完整快照时返回 None，由调用方回退到逐个用户求和。
+    """
+    scope = users.name
+    marker = snapshots.find_one({'scope': scope, 'complete': True}, sort=[('at', -1)])
+    if not marker:
+        return None
+    total = next(snapshots.aggregate([
+        {'$match': {'scope': scope, 'date': marker['date'], 'user_id': {'$exists': True}}},
+        {'$group': {'_id': None, 'total': {'$sum': '$balance'}}},
+    ]), {}).get('total', 0)
+    # 快照进行中写入的流水可能已经计入快照，按用户快照的 seq 排除
+    tail = next(ledger.aggregate([
+        {'$match': {'scope': scope, 'at': {'$gte': marker['at']}}},
+        {'$lookup': {
+            'from': snapshots.name,
+            'let': {'uid': '$user_id', 'seq': '$seq'},
+            'pipeline': [
+                {'$match': {'scope': scope, 'date': marker['date']}},
+                {'$match': {'$expr': {'$and': [{'$eq': ['$user_id', '$$uid']},
+                                               {'$gte': ['$seq', '$$seq']}]}}},
+                {'$limit': 1},
+            ],
+            'as': 'covered',
+        }},
+        {'$match': {'covered': []}},
+        {'$group': {'_id': None, 'total': {'$sum': '$delta'}}},
+    ]), {}).get('total', 0)
+    return balance_amount(total + tail)
+
+
+def _verify_batch(users, ledger, snapshots, docs, recheck=True):
+    scope = users.name
+    ids = [d['user_id'] for d in docs]
+    base = {}
+    for snap in snapshots.aggregate([
+        {'$match': {'scope': scope, 'user_id': {'$in': ids}}},
+        {'$sort': {'at': -1}},
+        {'$group': {'_id': '$user_id', 'seq': {'$first': '$seq'}, 'balance': {'$first': '$balance'}}},
+    ]):
+        base[snap['_id']] = snap
+    entries = {}
+    tails = [{'user_id': uid, 'seq': {'$gt': base[uid]['seq']}} if uid in base else {'user_id': uid} for uid in ids]
+    for entry in ledger.find({'scope': scope, '$or': tails}, {'user_id': 1, 'seq': 1, 'delta': 1, 'balance': 1},
+                             sort=[('seq', 1)]):
+        entries.setdefault(entry['user_id'], []).append(entry)
+
+    result = {'checked': 0, 'ok': 0, 'untracked': 0, 'problems': []}
+    for doc in docs:
+        uid = doc['user_id']
+        usdt = doc.get('USDT', 0) or 0
+        snap = base.get(uid)
+        rows = entries.get(uid, [])
+        result['checked'] += 1
+        if not snap and not rows and not doc.get('ledger_seq'):
+            result['untracked'] += 1
+            continue
+        start_seq = snap['seq'] if snap else 0
+        problem = None
+        if [r['seq'] for r in rows] != list(range(start_seq + 1, (doc.get('ledger_seq') or 0) + 1)):
+            problem = ('gap', f"流水序号不连续：快照 {start_seq}，流水 {len(rows)} 条，当前 {doc.get('ledger_seq', 0)}")
+        else:
+            running = snap['balance'] if snap else (rows[0]['balance'] - rows[0]['delta'] if rows else usdt)
+            for r in rows:
+                running = balance_amount(running + r['delta'])
+                if not _same_amount(running, r['balance']):
+                    problem = ('chain', f"第 {r['seq']} 条流水余额 {r['balance']}，按变动累计应为 {running}")
+                    break
+            if not problem and not _same_amount(running, usdt):
+                problem = ('mismatch', f"账户余额 {usdt}，流水累计 {running}")
+        if problem:
+            result['problems'].append({'user_id': uid, 'kind': problem[0], 'detail': problem[1]})
+        else:
+            result['ok'] += 1
+    if recheck and result['problems']:
+        # 校验期间余额发生变动会误报，重新读取有问题的用户再校验一次
+        retry_ids = [p['user_id'] for p in result['problems']]
+        fresh = list(users.find({'user_id': {'$in': retry_ids}}, {'user_id': 1, 'USDT': 1, 'ledger_seq': 1, '_id': 0}))
+        again = _verify_batch(users, ledger, snapshots, fresh, recheck=False)
+        result['ok'] += again['ok']
+        result['untracked'] += again['untracked']
+        result['problems'] = again['problems']
+    return result
+
+
+def verify_balances(users, ledger, snapshots, workers=8, batch_size=500):
+    """
+    按批并行校验每个用户的 USDT 与 "最近快照 + 后续流水" 是否一致
+
+    Returns:
+        {'scope', 'checked', 'ok', 'untracked', 'problems': [{'user_id', 'kind', 'detail'}], 'seconds'}
+        kind：gap 流水缺失 / chain 流水前后不连贯 / mismatch 余额被绕过流水修改
+    """
+    started = time.time()
+    total = {'scope': users.name, 'checked': 0, 'ok': 0, 'untracked': 0, 'problems': []}
+    batch, futures = [], []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for doc in users.find({'user_id': {'$exists': True}}, {'user_id': 1, 'USDT': 1, 'ledger_seq': 1, '_id': 0}):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                futures.append(pool.submit(_verify_batch, users, ledger, snapshots, batch))
+                batch = []
+        if batch:
+            futures.append(pool.submit(_verify_batch, users, ledger, snapshots, batch))
+        for future in futures:
+            part = future.result()
+            for key in ('checked', 'ok', 'untracked'):
+                total[key] += part[key]
+            total['problems'].extend(part['problems'])
+    total['seconds'] = time.time() - started
+    return total
+
+# ================================ 用户编号分配 ================================
+# count_id 原来是 find_one(sort count_id -1) + 1，整表排序，并发注册时撞号再重试；
+# 现在每个用户集合在 counters 集合中有一个计数器 {_id: 'count_id:{集合名}', seq}，$inc 原子分配。
+# 计数器不存在时先用集合中现有的最大 count_id 初始化（$max，多个进程同时初始化也不会回退）
+
+def count_id_counter(users):
+    return f"count_id:{users.name}"
+
+
+def allocate_count_id(counters, users):
+    """为 users 集合分配下一个 count_id"""
+    name = count_id_counter(users)
+    doc = counters.find_one_and_update({'_id': name}, {'$inc': {'seq': 1}}, return_document=ReturnDocument.AFTER)
+    if doc is None:
+        last = users.find_one({'count_id': {'$type': 'number'}}, {'count_id': 1}, sort=[('count_id', -1)])
+        try:
+            counters.update_one({'_id': name}, {'$max': {'seq': int(last['count_id']) if last else 0}}, upsert=True)
+        except DuplicateKeyError:
+            pass  # 其他进程同时完成了初始化
+        doc = counters.find_one_and_update({'_id': name}, {'$inc': {'seq': 1}}, return_document=ReturnDocument.AFTER)
+    return doc['seq']
+
+# ================================ 商品目录缓存 ================================
+# fenlei（一级分类）+ ejfl（二级分类/商品）只在管理员编辑目录时变化，整棵树缓存在进程内存中
+# 失效方式：
+#   - MongoDB 支持 change stream（副本集）时，后台线程监听 fenlei/ejfl 的变更立即失效
+#   - 否则每 check_interval 秒读一次 catalog_meta 中的版本号，管理员修改目录后调用 bump_catalog_version
+# 版本号保存在数据库中，总部和各代理进程都能感知同一次修改
+
+CATALOG_META_ID = 'catalog'
+
+def bump_catalog_version(meta):
+    """目录被修改后递增版本号"""
+    try:
+        meta.update_one(
+            {'_id': CATALOG_META_ID},
+            {'$inc': {'version': 1}, '$set': {'updated_at': datetime.now()}},
+            upsert=True
+        )
+    except Exception as e:
+        logging.error(f"❌ 更新目录版本号失败：{e}")
+
+class CatalogCache:
+    """
+    商品目录内存缓存，按 uid / nowuid 索引，分类和商品均按 row 排序
+
+    返回的都是文档副本，调用方可以随意修改
+    """
+
+    def __init__(self, fenlei, ejfl, meta, check_interval=2.0, watch=True):
+        self.fenlei = fenlei
+        self.ejfl = ejfl
+        self.meta = meta
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._loaded = False
+        self._version = None
+        self._checked_at = 0.0
+        self._watching = False
+        self._categories = []
+        self._category_by_uid = {}
+        self._product_by_nowuid = {}
+        self._products_by_uid = {}
+        if watch:
+            threading.Thread(target=self._watch, name='catalog-watch', daemon=True).start()
+
+    # ---------- 失效 ----------
+
+    def _watch(self):
+        """监听 fenlei/ejfl 变更，不支持 change stream 时退回版本号检查"""
+        pipeline = [{'$match': {'ns.coll': {'$in': [self.fenlei.name, self.ejfl.name]}}}]
+        try:
+            with self.fenlei.database.watch(pipeline) as stream:
+                self._watching = True
+                # 监听建立之前的修改可能没有被感知，这里统一失效一次
+                self.invalidate()
+                logging.info("✅ 商品目录缓存使用 change stream 失效")
+                for _ in stream:
+                    self.invalidate()
+        except Exception as e:
+            logging.info(f"ℹ️ change stream 不可用，商品目录缓存改用版本号失效：{e}")
+        finally:
+            self._watching = False
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._loaded = False
+
+    def _current_version(self):
+        doc = self.meta.find_one({'_id': CATALOG_META_ID}, {'version': 1})
+        return doc.get('version', 0) if doc else 0
+
+    def _ensure_fresh(self):
+        now = time.time()
+        with self._lock:
+            if self._loaded and (self._watching or now - self._checked_at < self.check_interval):
+                return
+            loaded = self._loaded
+        try:
+            version = self._current_version()
+        except Exception as e:
+            logging.error(f"❌ 读取目录版本号失败：{e}")
+            if loaded:
+                return
+            version = None
+        with self._lock:
+            self._checked_at = now
+            if self._loaded and version == self._version:
+                return
+        self._reload(version)
+
+    def _reload(self, version):
+        with self._lock:
+            generation = self._generation
+        categories = list(self.fenlei.find({}, sort=[('row', 1)]))
+        products = list(self.ejfl.find({}, sort=[('uid', 1), ('row', 1)]))
+
+        products_by_uid = {}
+        for product in products:
+            products_by_uid.setdefault(product.get('uid'), []).append(product)
+
+        with self._lock:
+            self._categories = categories
+            self._category_by_uid = {c['uid']: c for c in categories if 'uid' in c}
+            self._product_by_nowuid = {p['nowuid']: p for p in products if 'nowuid' in p}
+            self._products_by_uid = products_by_uid
+            self._version = version
+            # 加载期间发生过失效则不标记为已加载，下次读取重新加载
+            self._loaded = generation == self._generation
+
+    # ---------- 读取 ----------
+
+    def categories(self):
+        """全部一级分类（按 row 排序）"""
+        self._ensure_fresh()
+        return [dict(c) for c in self._categories]
+
+    def category(self, uid):
+        self._ensure_fresh()
+        doc = self._category_by_uid.get(uid)
+        return dict(doc) if doc else None
+
+    def product(self, nowuid):
+        self._ensure_fresh()
+        doc = self._product_by_nowuid.get(nowuid)
+        return dict(doc) if doc else None
+
+    def products(self, uid=None):
+        """某个一级分类下的商品（按 row 排序），uid 为空时返回全部商品"""
+        self._ensure_fresh()
+        if uid is None:
+            return [dict(p) for p in self._product_by_nowuid.values()]
+        return [dict(p) for p in self._products_by_uid.get(uid, [])]
+
+# ================================ 用户文档缓存 ================================
+# 几乎每个回调开头都要 find_one 用户文档取 lang / state / sign，同一个 update 内还会重复读取
+#   UserCache：热点用户的 TTL + LRU 缓存，返回文档副本
+#   CachedUsers：包装用户集合，按 user_id 过滤的写操作执行后立即失效对应用户（write-through），
+#                无法确定用户的写操作（update_many、按 username 过滤等）清空整个缓存；其余属性直接转发
+# 缓存只在本进程内有效，其他进程对同一集合的修改最多在 ttl 秒后可见
+
+class UserCache:
+
+    def __init__(self, users, ttl=30.0, max_size=5000):
+        self.users = users
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._docs = OrderedDict()      # user_id -> (过期时间, 文档)
+        # 读库期间该用户被失效过则不写回缓存，防止失效前读到的旧文档被写回：
+        # _generation 每次失效加一，_invalidated 记录最近失效的用户 -> 失效时的 _generation（按 LRU 最多 max_size 个），
+        # 被挤出的记录汇总到 _evicted_at，_cleared_at 为最近一次清空全部
+        self._generation = 0
+        self._invalidated = OrderedDict()
+        self._evicted_at = 0
+        self._cleared_at = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        """返回用户文档副本，用户不存在返回 None（不缓存不存在的用户）"""
+        now = time.time()
+        with self._lock:
+            cached = self._docs.get(user_id)
+            if cached and cached[0] > now:
+                self._docs.move_to_end(user_id)
+                self.hits += 1
+                return dict(cached[1])
+            self.misses += 1
+            generation = self._generation
+        doc = self.users.find_one({'user_id': user_id})
+        if doc is None:
+            return None
+        with self._lock:
+            if not self._invalidated_since(user_id, generation):
+                self._docs[user_id] = (now + self.ttl, doc)
+                self._docs.move_to_end(user_id)
+                while len(self._docs) > self.max_size:
+                    self._docs.popitem(last=False)
+        return dict(doc)
+
+    def _invalidated_since(self, user_id, generation):
+        """generation 之后该用户是否被失效过（记录已被挤出时按最近挤出的失效保守判断）"""
+        if self._cleared_at > generation:
+            return True
+        if user_id in self._invalidated:
+            return self._invalidated[user_id] > generation
+        return self._evicted_at > generation
+
+    def invalidate(self, user_id=None):
+        """失效一个用户；user_id 为 None 时清空全部"""
+        with self._lock:
+            self._generation += 1
+            if user_id is None:
+                self._docs.clear()
+                self._invalidated.clear()
+                self._cleared_at = self._generation
+            else:
+                self._docs.pop(user_id, None)
+                self._invalidated[user_id] = self._generation
+                self._invalidated.move_to_end(user_id)
+                while len(self._invalidated) > self.max_size:
+                    _, evicted = self._invalidated.popitem(last=False)
+                    self._evicted_at = max(self._evicted_at, evicted)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {'size': len(self._docs), 'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': self.hits / total if total else 0.0}
+
+
+class CachedUsers:
+    """用户集合包装：写操作后失效 UserCache，读操作和其他属性直接转发给原集合"""
+
+    _FILTER_WRITES = ('update_one', 'update_many', 'replace_one', 'delete_one', 'delete_many',
+                      'find_one_and_update', 'find_one_and_replace', 'find_one_and_delete')
+
+    def __init__(self, collection, cache):
+        self._collection = collection
+        self.cache = cache
+
+    def __getattr__(self, name):
+        attr = getattr(self._collection, name)
+        if name in self._FILTER_WRITES:
+            def write(filter, *args, **kwargs):
+                try:
+                    return attr(filter, *args, **kwargs)
+                finally:
+                    self._invalidate(filter, single=not name.endswith('_many'))
+            return write
+        if name == 'insert_one':
+            def insert(document, *args, **kwargs):
+                try:
+                    return attr(document, *args, **kwargs)
+                finally:
+                    self.cache.invalidate(document.get('user_id'))
+            return insert
+        if name in ('insert_many', 'bulk_write', 'drop'):
+            def bulk(*args, **kwargs):
+                try:
+                    return attr(*args, **kwargs)
+                finally:
+                    self.cache.invalidate()
+            return bulk
+        return attr
+
+    def _invalidate(self, filter, single):
+        user_id = filter.get('user_id') if isinstance(filter, dict) else None
+        if single and user_id is not None and not isinstance(user_id, dict):
+            self.cache.invalidate(user_id)
+        else:
+            self.cache.invalidate()
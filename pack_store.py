@@ -0,0 +1,186 @@
+"""
+按商品打包存储的账号文件（协议号 / 号包）
+
+原来每个协议号是 协议号/{nowuid}/ 下的两个散文件，每个号包是 号包/{nowuid}/ 下的整棵目录，
+时间长了就是几百万个 inode。现在每个 nowuid 只有两个文件，和原目录放在同一级：
+
+    协议号/{nowuid}.pack   数据文件，只追加，依次存放各文件内容
+    协议号/{nowuid}.idx    索引，每行一条 JSON：
+                           {"name": projectname, "files": [[相对路径, 偏移, 长度], ...]}
+
+- 写入：先追加数据并 fsync，再追加索引行；中途崩溃只会在数据文件尾部留下无人引用的字节
+- 同名商品重复写入时以最后一条索引为准
+- 读取：数据文件用 mmap 映射，索引按文件大小变化增量加载；代理通过 FILE_BASE_PATH 读取同一份文件
+
+本模块不访问数据库。
+"""
+import json
+import mmap
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows 开发环境没有 fcntl，只依赖进程内锁
+    fcntl = None
+
+PACK_SUFFIX = '.pack'
+INDEX_SUFFIX = '.idx'
+
+
+def pack_paths(product_dir):
+    """商品目录（协议号/{nowuid}）对应的数据文件和索引文件路径"""
+    product_dir = product_dir.rstrip('/\\')
+    return product_dir + PACK_SUFFIX, product_dir + INDEX_SUFFIX
+
+
+def has_pack(product_dir):
+    return os.path.exists(pack_paths(product_dir)[1])
+
+
+_write_locks = {}
+_write_locks_guard = threading.Lock()
+
+
+def _write_lock(path):
+    with _write_locks_guard:
+        return _write_locks.setdefault(path, threading.Lock())
+
+
+class PackWriter:
+    """
+    追加写入一个商品的数据文件
+
+    用法：
+        with PackWriter('协议号/xxx') as writer:
+            writer.add(projectname, [(相对路径, bytes), ...])
+    """
+
+    def __init__(self, product_dir):
+        self.data_path, self.index_path = pack_paths(product_dir)
+        self._lock = _write_lock(self.data_path)
+        self._data = None
+        self._index = None
+        self._pending = {}
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.data_path) or '.', exist_ok=True)
+        self._lock.acquire()
+        try:
+            self._data = open(self.data_path, 'ab')
+            if fcntl:
+                fcntl.flock(self._data.fileno(), fcntl.LOCK_EX)
+            self._data.seek(0, os.SEEK_END)
+            self._index = open(self.index_path, 'a', encoding='utf-8')
+        except Exception:
+            self._close()
+            raise
+        return self
+
+    def add(self, name, files):
+        """写入商品文件（同一商品可以分多次添加），索引在 flush() / 退出时统一落盘"""
+        entries = self._pending.setdefault(name, [])
+        for rel_path, data in files:
+            offset = self._data.tell()
+            self._data.write(data)
+            entries.append([rel_path, offset, len(data)])
+
+    def flush(self):
+        if not self._pending:
+            return
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        self._index.write(''.join(json.dumps({'name': name, 'files': files}, ensure_ascii=False) + '\n'
+                                  for name, files in self._pending.items()))
+        self._index.flush()
+        os.fsync(self._index.fileno())
+        self._pending = {}
+
+    def _close(self):
+        for handle in (self._index, self._data):
+            if handle:
+                handle.close()
+        self._lock.release()
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self._close()
+
+
+class PackReader:
+    """读取一个商品的数据文件（mmap），索引在文件增长后增量加载"""
+
+    def __init__(self, product_dir):
+        self.data_path, self.index_path = pack_paths(product_dir)
+        self._lock = threading.Lock()
+        self._index = {}
+        self._index_size = 0
+        self._map = None
+        self._map_size = 0
+
+    def _refresh(self):
+        size = os.path.getsize(self.index_path)
+        if size > self._index_size:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                f.seek(self._index_size)
+                chunk = f.read()
+            # 只处理完整的行，写到一半的行留到下次
+            complete = chunk[:chunk.rfind('\n') + 1]
+            for line in complete.splitlines():
+                if line.strip():
+                    row = json.loads(line)
+                    self._index[row['name']] = row['files']
+            self._index_size += len(complete.encode('utf-8'))
+        data_size = os.path.getsize(self.data_path)
+        if data_size != self._map_size:
+            if self._map:
+                self._map.close()
+            self._map = None
+            if data_size:
+                with open(self.data_path, 'rb') as f:
+                    self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._map_size = data_size
+
+    def names(self):
+        with self._lock:
+            self._refresh()
+            return set(self._index)
+
+    def files(self, name):
+        """
+        Returns:
+            [(相对路径, bytes)]，商品不在包内时返回 None
+        """
+        with self._lock:
+            self._refresh()
+            entries = self._index.get(name)
+            if entries is None:
+                return None
+            return [(rel_path, self._map[offset:offset + length] if length else b'')
+                    for rel_path, offset, length in entries]
+
+    def close(self):
+        with self._lock:
+            if self._map:
+                self._map.close()
+            self._map = None
+            self._map_size = 0
+
+
+_readers = {}
+_readers_guard = threading.Lock()
+
+
+def pack_reader(product_dir):
+    """每个数据文件共用一个 PackReader；没有打包存储时返回 None"""
+    if not has_pack(product_dir):
+        return None
+    key = pack_paths(product_dir)[0]
+    with _readers_guard:
+        reader = _readers.get(key)
+        if reader is None:
+            reader = _readers[key] = PackReader(product_dir)
+        return reader
@@ -0,0 +1,128 @@
+"""
+商品排行（/hot、/new 使用）
+
+按库存、近 24 小时 / 7 天销量（来自 gmjlu）、上架时间预先计算前 N 名，保存在内存中。
+
+刷新时机：
+- 定时任务周期性刷新
+- 购买、补货后调用 mark_dirty()，下一次定时检查时刷新
+
+本模块不在导入时访问数据库，集合由调用方传入。
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from mongo_shared import stock_snapshot
+
+RANKING_KINDS = ('stock', 'sales_24h', 'sales_7d', 'newest')
+
+
+def sales_since(gmjlu, since, name_to_nowuid):
+    """
+    统计 since 之后各商品的销量
+
+    gmjlu.timer 为 '%Y-%m-%d %H:%M:%S' 字符串，可以直接按字符串比较；
+    新记录带 nowuid，旧记录只有 projectname，按二级分类名映射回 nowuid
+    """
+    pipeline = [
+        {'$match': {'timer': {'$gte': since.strftime('%Y-%m-%d %H:%M:%S')}}},
+        {'$group': {
+            '_id': {'$ifNull': ['$nowuid', '$projectname']},
+            'units': {'$sum': {'$ifNull': ['$count', 1]}},
+        }}
+    ]
+    known = set(name_to_nowuid.values())
+    sales = {}
+    for row in gmjlu.aggregate(pipeline, allowDiskUse=True):
+        key = row['_id']
+        nowuid = key if key in known else name_to_nowuid.get(key)
+        if nowuid:
+            sales[nowuid] = sales.get(nowuid, 0) + int(row['units'] or 0)
+    return sales
+
+
+def compute_rankings(catalog, counters, gmjlu, top_n=50, now=None):
+    """
+    计算各排行榜前 top_n 名
+
+    Returns:
+        {kind: [{'nowuid', 'stock', 'sales_24h', 'sales_7d'}]}
+        只包含分类存在且已设置价格的商品
+    """
+    now = now or datetime.now()
+    products = [p for p in catalog.products()
+                if catalog.category(p.get('uid')) and p.get('money', 0) > 0]
+    nowuids = [p['nowuid'] for p in products]
+    name_to_nowuid = {p.get('projectname'): p['nowuid'] for p in products}
+
+    stock = stock_snapshot(counters, nowuids=nowuids)['products']
+    sales_24h = sales_since(gmjlu, now - timedelta(days=1), name_to_nowuid)
+    sales_7d = sales_since(gmjlu, now - timedelta(days=7), name_to_nowuid)
+
+    entries = {
+        p['nowuid']: {
+            'nowuid': p['nowuid'],
+            'stock': stock[p['nowuid']]['available'],
+            'sales_24h': sales_24h.get(p['nowuid'], 0),
+            'sales_7d': sales_7d.get(p['nowuid'], 0),
+        }
+        for p in products
+    }
+    created = {p['nowuid']: p['_id'] for p in products}
+
+    def top(key, require=None):
+        candidates = [e for e in entries.values() if require is None or e[require] > 0]
+        return sorted(candidates, key=key)[:top_n]
+
+    return {
+        'stock': top(lambda e: -e['stock'], require='stock'),
+        'sales_24h': top(lambda e: (-e['sales_24h'], -e['stock']), require='sales_24h'),
+        'sales_7d': top(lambda e: (-e['sales_7d'], -e['stock']), require='sales_7d'),
+        'newest': sorted(entries.values(), key=lambda e: created[e['nowuid']], reverse=True)[:top_n],
+    }
+
+
+class RankingService:
+    """内存中的排行榜，定时或事件触发刷新"""
+
+    def __init__(self, catalog, counters, gmjlu, top_n=50, max_age=600):
+        self.catalog = catalog
+        self.counters = counters
+        self.gmjlu = gmjlu
+        self.top_n = top_n
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._rankings = {kind: [] for kind in RANKING_KINDS}
+        self._refreshed_at = 0.0
+        self._dirty = True
+
+    def mark_dirty(self):
+        """购买、补货后调用，下一次 refresh_if_needed 时重新计算"""
+        self._dirty = True
+
+    def refresh(self):
+        started = time.time()
+        self._dirty = False
+        try:
+            rankings = compute_rankings(self.catalog, self.counters, self.gmjlu, self.top_n)
+        except Exception as e:
+            self._dirty = True
+            logging.error(f"❌ 刷新商品排行失败：{e}")
+            return
+        with self._lock:
+            self._rankings = rankings
+            self._refreshed_at = time.time()
+        logging.info(f"✅ 商品排行已刷新，用时 {time.time() - started:.2f} 秒")
+
+    def refresh_if_needed(self):
+        if self._dirty or time.time() - self._refreshed_at >= self.max_age:
+            self.refresh()
+
+    def top(self, kind, limit=10):
+        """读取排行榜前 limit 名（从未刷新过时先同步刷新一次）"""
+        if not self._refreshed_at:
+            self.refresh()
+        with self._lock:
+            return [dict(e) for e in self._rankings.get(kind, [])[:limit]]
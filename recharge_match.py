@@ -0,0 +1,299 @@
+"""
+USDT 充值订单按精确金额匹配（总部 topup + qukuai）
+
+- 金额统一换算为整数 micro-USDT（TRC20 USDT 的最小单位，1 USDT = 1_000_000），
+  待支付订单保存在 topup.amount_micro，status=pending 的订单上有部分唯一索引，
+  同一时刻不会有两个待支付订单金额相同
+- PendingRecharges 在内存中保存 金额 -> 订单 的映射，下单、取消、过期、到账时同步更新，
+  并定期按索引全量刷新（兜底其他途径的修改）；刷新期间 add() 登记的订单会合并保留，
+  没有 amount_micro 的旧 USDT 订单在刷新时按 money 补写
+- match() 对一批链上转账只做一次 $in 查询；映射中一个候选都没有时不查库。
+  映射只是优化：没匹配上的转账由调用方保留到 UNMATCHED_GRACE 之后（见 unmatched_expired），
+  期间映射刷新后会再次匹配
+- settle() 先把订单从 pending 原子改为 success（记下 txid 和 qukuai_id），再把 qukuai 行从
+  state 0 原子改为 1，只有抢到 qukuai 行的任务入账，两次 jiexi 同时处理同一笔转账时只有一次能入账。
+  两步之间进程中断时订单已是 success、qukuai 行仍是 state 0：下一轮该行匹配不到待支付订单，
+  由 resume() 按 qukuai_id 找回订单继续入账，已付款的转账不会因订单过期而丢失
+- TopupExpiry 按订单的 expire_at 维护最小堆，到期任务只处理堆顶已到期的订单，
+  不再每 3 秒全表扫描 topup
+
+本模块只接收集合对象作为参数，导入时不连接数据库。
+"""
+import heapq
+import logging
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, ROUND_HALF_UP
+
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+MICRO = 1_000_000
+
+PENDING_FILTER = {'status': 'pending', 'amount_micro': {'$exists': True}}
+
+# 充值订单有效期
+ORDER_TTL = timedelta(minutes=10)
+
+# 未匹配的转账保留多久才判定失败：订单有效期 + 一个刷新周期的余量
+UNMATCHED_GRACE = ORDER_TTL + timedelta(minutes=2)
+
+
+def to_micro(amount):
+    """金额（USDT）-> 整数 micro-USDT"""
+    return int((Decimal(str(amount)) * MICRO).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def from_micro(micro):
+    return float(Decimal(int(micro)) / MICRO)
+
+
+def unmatched_expired(row, now=None):
+    """
+    未匹配的 qukuai 行是否可以判定失败：写入时间（ObjectId）早于 UNMATCHED_GRACE
+
+    对应订单可能刚下单、映射还没刷新到，过早标记 state 2 会让已付款的转账永远不再匹配。
+    """
+    try:
+        seen_at = row['_id'].generation_time
+    except (KeyError, AttributeError):
+        return True
+    now = now or datetime.now(timezone.utc)
+    return now - seen_at >= UNMATCHED_GRACE
+
+
+class PendingRecharges:
+    """
+    待支付 USDT 订单的内存映射 {amount_micro: {'_id', 'user_id'}}
+
+    Args:
+        topup: topup 集合
+        refresh_interval: 全量刷新间隔（秒）
+    """
+
+    def __init__(self, topup, refresh_interval=60.0):
+        self.topup = topup
+        self.refresh_interval = refresh_interval
+        self._lock = threading.Lock()
+        self._orders = {}
+        self._added = {}
+        self._loaded_at = 0.0
+
+    def backfill_legacy(self):
+        """给没有 amount_micro 的待支付 USDT 订单按 money 补写，返回补写数量"""
+        filled = 0
+        for doc in self.topup.find({'status': 'pending', 'cz_type': {'$in': ['usdt', 'USDT']},
+                                    'amount_micro': {'$exists': False}, 'money': {'$exists': True}},
+                                   {'money': 1}):
+            try:
+                res = self.topup.update_one({'_id': doc['_id'], 'amount_micro': {'$exists': False}},
+                                            {'$set': {'amount_micro': to_micro(doc['money'])}})
+                filled += res.modified_count
+            except DuplicateKeyError:
+                logging.error(f"❌ 旧充值订单金额与其他待支付订单重复，无法自动匹配：{doc['_id']} {doc['money']}")
+        return filled
+
+    def refresh(self):
+        started = time.time()
+        self.backfill_legacy()
+        orders = {doc['amount_micro']: {'_id': doc['_id'], 'user_id': doc.get('user_id')}
+                  for doc in self.topup.find(PENDING_FILTER, {'amount_micro': 1, 'user_id': 1})}
+        with self._lock:
+            # 查询期间 add() 登记的订单可能不在结果里，保留下来
+            for amount, added_at in self._added.items():
+                if added_at >= started and amount in self._orders:
+                    orders.setdefault(amount, self._orders[amount])
+            self._added = {a: t for a, t in self._added.items() if t >= started}
+            self._orders = orders
+            self._loaded_at = started
+        return len(orders)
+
+    def _ensure_fresh(self):
+        if time.time() - self._loaded_at >= self.refresh_interval:
+            try:
+                self.refresh()
+            except Exception as e:
+                logging.error(f"❌ 刷新待支付充值订单失败：{e}")
+
+    def add(self, order):
+        """下单后登记"""
+        with self._lock:
+            self._orders[order['amount_micro']] = {'_id': order['_id'], 'user_id': order.get('user_id')}
+            self._added[order['amount_micro']] = time.time()
+
+    def discard(self, amount_micro):
+        """到账、取消、过期后移除"""
+        if amount_micro is None:
+            return
+        with self._lock:
+            self._orders.pop(amount_micro, None)
+            self._added.pop(amount_micro, None)
+
+    def is_pending(self, amount_micro):
+        self._ensure_fresh()
+        with self._lock:
+            return amount_micro in self._orders
+
+    def __len__(self):
+        with self._lock:
+            return len(self._orders)
+
+    # ---------- 匹配与入账 ----------
+
+    def match(self, amounts):
+        """
+        一批链上金额 -> 待支付订单
+
+        Returns:
+            {amount_micro: topup 文档}，没有对应订单的金额不在结果中
+        """
+        self._ensure_fresh()
+        with self._lock:
+            candidates = [a for a in set(amounts) if a in self._orders]
+        if not candidates:
+            return {}
+        return {doc['amount_micro']: doc
+                for doc in self.topup.find({'amount_micro': {'$in': candidates}, 'status': 'pending'})}
+
+    def settle(self, qukuai, row, order):
+        """
+        把一笔链上转账结算到订单
+
+        Returns:
+            结算后的订单文档；订单已不是 pending 或转账已被其他任务处理时返回 None
+        """
+        settled = self.topup.find_one_and_update(
+            {'_id': order['_id'], 'status': 'pending'},
+            {'$set': {
+                'status': 'success',
+                'success_time': datetime.now(),
+                'txid': row.get('txid'),
+                'from_address': row.get('from_address'),
+                'qukuai_id': row['_id'],
+            }},
+            return_document=ReturnDocument.AFTER
+        )
+        if settled is None:
+            # 订单在匹配后被取消、过期或已被其他任务结算：qukuai 行保持 state 0，按未匹配处理
+            return None
+        self.discard(order['amount_micro'])
+        return self._claim(qukuai, row, settled)
+
+    def resume(self, qukuai, row):
+        """
+        找回上次已改为 success、但 qukuai 行还没标记的订单（settle 两步之间中断）
+
+        Returns:
+            订单文档；没有这样的订单或转账已被其他任务处理时返回 None
+        """
+        order = self.topup.find_one({'qukuai_id': row['_id'], 'status': 'success'})
+        if order is None:
+            return None
+        return self._claim(qukuai, row, order)
+
+    @staticmethod
+    def _claim(qukuai, row, order):
+        claimed = qukuai.find_one_and_update(
+            {'_id': row['_id'], 'state': 0},
+            {'$set': {'state': 1, 'topup_id': order['_id']}}
+        )
+        return order if claimed is not None else None
+
+
+class TopupExpiry:
+    """
+    待支付充值订单的到期调度（最小堆，按 expire_at 排序）
+
+    - 下单时 schedule()，启动时 rebuild() 按 status=pending 的索引查询重建，
+      没有 expire_at 的旧订单按 time / timer + ORDER_TTL 补写
+    - pop_expired() 只弹出已到期的堆顶，每个订单用 find_one_and_delete 条件删除，
+      已到账、已取消、已被重新下单删掉的订单自然跳过
+    - 每 sweep_interval 秒做一次 {status: pending, expire_at <= now} 的索引查询兜底
+      （其他进程写入或调度器漏掉的订单），代价只和到期订单数有关
+
+    Args:
+        topup: topup 集合
+        pending: PendingRecharges，订单过期后同步移除金额
+        sweep_interval: 兜底查询间隔（秒）
+    """
+
+    def __init__(self, topup, pending=None, sweep_interval=60.0):
+        self.topup = topup
+        self.pending = pending
+        self.sweep_interval = sweep_interval
+        self._lock = threading.Lock()
+        self._heap = []
+        self._swept_at = 0.0
+
+    @staticmethod
+    def expire_at_for(order):
+        """订单到期时间：优先 expire_at，旧订单按创建时间推算"""
+        if isinstance(order.get('expire_at'), datetime):
+            return order['expire_at']
+        created = order.get('time')
+        if not isinstance(created, datetime):
+            try:
+                created = datetime.strptime(order['timer'], '%Y-%m-%d %H:%M:%S')
+            except (KeyError, TypeError, ValueError):
+                created = datetime.now()
+        return created + ORDER_TTL
+
+    def schedule(self, order):
+        """登记一个待支付订单（需已写入 expire_at）"""
+        with self._lock:
+            heapq.heappush(self._heap, (self.expire_at_for(order), str(order['_id']), order['_id']))
+
+    def rebuild(self):
+        """启动时从待支付订单重建堆，返回订单数"""
+        heap = []
+        for doc in self.topup.find({'status': 'pending'}, {'expire_at': 1, 'time': 1, 'timer': 1}):
+            expire_at = self.expire_at_for(doc)
+            if doc.get('expire_at') != expire_at:
+                self.topup.update_one({'_id': doc['_id'], 'status': 'pending'},
+                                      {'$set': {'expire_at': expire_at}})
+            heap.append((expire_at, str(doc['_id']), doc['_id']))
+        heapq.heapify(heap)
+        with self._lock:
+            self._heap = heap
+            self._swept_at = time.time()
+        return len(heap)
+
+    def _take(self, order_id, now):
+        doc = self.topup.find_one_and_delete({'_id': order_id, 'status': 'pending', 'expire_at': {'$lte': now}})
+        if doc is not None and self.pending is not None:
+            self.pending.discard(doc.get('amount_micro'))
+        return doc
+
+    def pop_expired(self, now=None):
+        """
+        删除已到期的待支付订单
+
+        Returns:
+            被删除的订单文档列表（调用方负责删除充值详情消息、通知用户）
+        """
+        now = now or datetime.now()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap)[2])
+        expired = []
+        for order_id in due:
+            try:
+                doc = self._take(order_id, now)
+            except Exception as e:
+                logging.error(f"❌ 删除过期充值订单失败：{order_id} {e}")
+                continue
+            if doc is not None:
+                expired.append(doc)
+
+        if time.time() - self._swept_at >= self.sweep_interval:
+            self._swept_at = time.time()
+            try:
+                for doc in self.topup.find({'status': 'pending', 'expire_at': {'$lte': now}}, {'_id': 1}):
+                    taken = self._take(doc['_id'], now)
+                    if taken is not None:
+                        expired.append(taken)
+            except Exception as e:
+                logging.error(f"❌ 过期充值订单兜底查询失败：{e}")
+        return expired
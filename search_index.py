@@ -0,0 +1,191 @@
+"""
+商品搜索索引（区号 / 国家名 / 关键词 -> nowuid）
+
+由 ejfl.projectname 构建的内存倒排索引：
+- 商品名按字符二元组（bigram）建倒排表，查询时取各 bigram 倒排表的交集，再做一次子串校验，
+  结果与原来的 "关键词 in 商品名" 完全一致，但不再遍历整个目录
+- "+94" 这类区号与国家名互为别名：搜 "+94" 也能命中只写了 "斯里兰卡" 的商品，反之亦然
+- 新增/改名商品时调用 update_product 增量维护，不需要整体重建
+
+本模块不访问数据库，总部 mongo.py 负责用商品目录构建和维护。
+"""
+import re
+import threading
+
+# 常见区号与国家名（中文 / 英文），用于区号与国家名互相扩展
+DIALING_CODES = {
+    '1': ['美国', '加拿大', 'usa', 'canada'],
+    '7': ['俄罗斯', '哈萨克斯坦', 'russia', 'kazakhstan'],
+    '20': ['埃及', 'egypt'],
+    '27': ['南非', 'south africa'],
+    '30': ['希腊', 'greece'],
+    '31': ['荷兰', 'netherlands'],
+    '32': ['比利时', 'belgium'],
+    '33': ['法国', 'france'],
+    '34': ['西班牙', 'spain'],
+    '36': ['匈牙利', 'hungary'],
+    '39': ['意大利', 'italy'],
+    '40': ['罗马尼亚', 'romania'],
+    '41': ['瑞士', 'switzerland'],
+    '43': ['奥地利', 'austria'],
+    '44': ['英国', 'uk', 'united kingdom'],
+    '45': ['丹麦', 'denmark'],
+    '46': ['瑞典', 'sweden'],
+    '47': ['挪威', 'norway'],
+    '48': ['波兰', 'poland'],
+    '49': ['德国', 'germany'],
+    '51': ['秘鲁', 'peru'],
+    '52': ['墨西哥', 'mexico'],
+    '54': ['阿根廷', 'argentina'],
+    '55': ['巴西', 'brazil'],
+    '56': ['智利', 'chile'],
+    '57': ['哥伦比亚', 'colombia'],
+    '58': ['委内瑞拉', 'venezuela'],
+    '60': ['马来西亚', 'malaysia'],
+    '61': ['澳大利亚', '澳洲', 'australia'],
+    '62': ['印度尼西亚', '印尼', 'indonesia'],
+    '63': ['菲律宾', 'philippines'],
+    '64': ['新西兰', 'new zealand'],
+    '65': ['新加坡', 'singapore'],
+    '66': ['泰国', 'thailand'],
+    '81': ['日本', 'japan'],
+    '82': ['韩国', 'korea'],
+    '84': ['越南', 'vietnam'],
+    '86': ['中国', 'china'],
+    '90': ['土耳其', 'turkey'],
+    '91': ['印度', 'india'],
+    '92': ['巴基斯坦', 'pakistan'],
+    '93': ['阿富汗', 'afghanistan'],
+    '94': ['斯里兰卡', 'sri lanka'],
+    '95': ['缅甸', 'myanmar'],
+    '98': ['伊朗', 'iran'],
+    '212': ['摩洛哥', 'morocco'],
+    '213': ['阿尔及利亚', 'algeria'],
+    '233': ['加纳', 'ghana'],
+    '234': ['尼日利亚', 'nigeria'],
+    '254': ['肯尼亚', 'kenya'],
+    '351': ['葡萄牙', 'portugal'],
+    '353': ['爱尔兰', 'ireland'],
+    '380': ['乌克兰', 'ukraine'],
+    '852': ['香港', 'hong kong'],
+    '853': ['澳门', 'macau'],
+    '855': ['柬埔寨', 'cambodia'],
+    '856': ['老挝', 'laos'],
+    '880': ['孟加拉', 'bangladesh'],
+    '886': ['台湾', 'taiwan'],
+    '966': ['沙特', 'saudi arabia'],
+    '971': ['阿联酋', 'uae'],
+    '977': ['尼泊尔', 'nepal'],
+    '998': ['乌兹别克斯坦', 'uzbekistan'],
+}
+
+COUNTRY_TO_CODE = {name: code for code, names in DIALING_CODES.items() for name in names}
+
+_CODE_RE = re.compile(r'^\+(\d{1,4})$')
+
+
+def _normalize(text):
+    return (text or '').lower()
+
+
+def _grams(text):
+    """单字 + 相邻二元组"""
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+def expand_keyword(keyword):
+    """关键词扩展：区号 <-> 国家名"""
+    keywords = [keyword]
+    match = _CODE_RE.match(keyword)
+    if match:
+        keywords += DIALING_CODES.get(match.group(1), [])
+    elif keyword in COUNTRY_TO_CODE:
+        code = COUNTRY_TO_CODE[keyword]
+        keywords.append(f'+{code}')
+        keywords += [name for name in DIALING_CODES[code] if name != keyword]
+    return keywords
+
+
+class ProductSearchIndex:
+    """商品名倒排索引，线程安全"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._postings = {}   # gram -> set(nowuid)
+        self._names = {}      # nowuid -> 归一化商品名
+        self._order = {}      # nowuid -> 目录顺序
+        self._next_order = 0
+        self.built = False
+
+    def build(self, products):
+        """用完整商品列表重建索引（products 为 ejfl 文档，按目录顺序）"""
+        with self._lock:
+            self._postings = {}
+            self._names = {}
+            self._order = {}
+            self._next_order = 0
+            for doc in products:
+                self._add(doc['nowuid'], doc.get('projectname', ''))
+            self.built = True
+
+    def _add(self, nowuid, projectname):
+        name = _normalize(projectname)
+        self._names[nowuid] = name
+        if nowuid not in self._order:
+            self._order[nowuid] = self._next_order
+            self._next_order += 1
+        for gram in _grams(name):
+            self._postings.setdefault(gram, set()).add(nowuid)
+
+    def _remove(self, nowuid):
+        name = self._names.pop(nowuid, None)
+        if name is None:
+            return
+        for gram in _grams(name):
+            posting = self._postings.get(gram)
+            if posting is not None:
+                posting.discard(nowuid)
+                if not posting:
+                    del self._postings[gram]
+
+    def update_product(self, nowuid, projectname):
+        """新增或改名商品时增量更新"""
+        with self._lock:
+            self._remove(nowuid)
+            self._add(nowuid, projectname)
+
+    def remove_product(self, nowuid):
+        with self._lock:
+            self._remove(nowuid)
+            self._order.pop(nowuid, None)
+
+    def _match(self, keyword):
+        grams = _grams(keyword) if len(keyword) > 1 else {keyword}
+        grams = [g for g in grams if len(g) == min(len(keyword), 2)]
+        postings = [self._postings.get(g) for g in grams]
+        if not postings or any(p is None for p in postings):
+            return set()
+        candidates = set.intersection(*postings)
+        return {nowuid for nowuid in candidates if keyword in self._names[nowuid]}
+
+    def search(self, query):
+        """
+        返回匹配的 nowuid 列表（按目录顺序）
+
+        整句子串匹配，或按空格拆分后任一关键词匹配；区号与国家名互相扩展
+        """
+        query = _normalize(query).strip()
+        if not query:
+            return []
+        keywords = []
+        for keyword in [query] + query.split():
+            for expanded in expand_keyword(keyword):
+                if expanded not in keywords:
+                    keywords.append(expanded)
+        with self._lock:
+            matched = set()
+            for keyword in keywords:
+                matched |= self._match(keyword)
+            return sorted(matched, key=lambda nowuid: self._order.get(nowuid, 0))
@@ -0,0 +1,382 @@
+"""
+TronGrid / TronScan 转账查询客户端（代理充值轮询共用）
+
+- 一个进程一个 requests.Session，连接池复用 TCP / TLS 连接
+- TRON_API_KEYS 中每个密钥一个令牌桶（每秒 key_rate 次），按轮转顺序取有令牌的密钥；
+  返回 429 的密钥按 Retry-After（默认 cooldown 秒）冷却，冷却期内不再使用，不会立即重试
+- 每个端点（TronGrid、每个 TronScan 地址）一个熔断器：连续失败 failure_threshold 次后打开，
+  reset_timeout 秒后放行一次试探请求，成功即关闭
+- 参数完全相同的并发请求合并为一次，其他调用方等待同一结果
+
+本模块不访问数据库。离线压测见 tron_stub.py。
+"""
+import logging
+import threading
+import time
+from decimal import Decimal
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_TRONSCAN_BASES = (
+    "https://apilist.tronscanapi.com/api/token_trc20/transfers",
+    "https://apilist.tronscan.org/api/token_trc20/transfers",
+)
+
+
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个，最多 capacity 个"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(rate, 1))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self):
+        """取一个令牌，成功返回 0，否则返回还需等待的秒数"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate if self.rate > 0 else float('inf')
+
+
+class CircuitBreaker:
+    """熔断器：closed -> open（连续失败）-> half_open（到期放行一次试探）-> closed"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_until = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_until == 0:
+            return 'closed'
+        return 'open' if time.monotonic() < self.opened_until else 'half_open'
+
+    def allow(self):
+        with self._lock:
+            if self.opened_until == 0:
+                return True
+            if time.monotonic() < self.opened_until or self._trial:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_until = 0.0
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                self.opened_until = time.monotonic() + self.reset_timeout
+            self._trial = False
+
+    def release_trial(self):
+        """allow() 放行的试探请求因本地原因（无令牌、无可用密钥、密钥限流）没有发出时归还试探名额"""
+        with self._lock:
+            self._trial = False
+
+    def open_for(self, seconds):
+        """端点限流时直接打开一段时间"""
+        with self._lock:
+            self.opened_until = max(self.opened_until, time.monotonic() + seconds)
+            self._trial = False
+
+
+class _InFlight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+def _retry_after(response, default):
+    try:
+        return max(float(response.headers.get('Retry-After')), 1.0)
+    except (TypeError, ValueError):
+        return default
+
+
+class TronClient:
+    """
+    Args:
+        contract: USDT 合约地址
+        api_keys: TronGrid 密钥列表；为空时 TronGrid 按 keyless_rate 无密钥访问
+        key_rate: 每个密钥每秒请求数
+        cooldown: 429 未带 Retry-After 时的冷却秒数
+        max_wait: 所有密钥都没有令牌时最多等待的秒数，超过则本次不请求 TronGrid
+    """
+
+    def __init__(self, contract, trongrid_base="https://api.trongrid.io", tronscan_bases=DEFAULT_TRONSCAN_BASES,
+                 api_keys=(), key_header="TRON-PRO-API-KEY", key_rate=10.0, keyless_rate=1.0, tronscan_rate=2.0,
+                 cooldown=30.0, failure_threshold=5, reset_timeout=30.0, max_wait=2.0, pool_size=20, timeout=10):
+        self.contract = contract
+        self.trongrid_base = trongrid_base.rstrip('/')
+        self.tronscan_bases = [b for i, b in enumerate(tronscan_bases) if b and b not in tronscan_bases[:i]]
+        self.api_keys = list(api_keys)
+        self.key_header = key_header
+        self.cooldown = cooldown
+        self.max_wait = max_wait
+        self.timeout = timeout
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self._keys_lock = threading.Lock()
+        self._key_index = 0
+        self._keys = {key: {'bucket': TokenBucket(key_rate), 'cooldown_until': 0.0}
+                      for key in (self.api_keys or [None])}
+        if not self.api_keys:
+            self._keys[None]['bucket'] = TokenBucket(keyless_rate)
+        self._tronscan_bucket = TokenBucket(tronscan_rate)
+
+        self._breakers = {}
+        self._breaker_args = (failure_threshold, reset_timeout)
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'calls': 0, 'requests': 0, 'deduped': 0, 'throttled': 0, 'errors': 0,
+                       'breaker_skips': 0, 'no_key': 0}
+
+    # ---------- 内部工具 ----------
+
+    def _count(self, name, n=1):
+        with self._stats_lock:
+            self._stats[name] += n
+
+    def _breaker(self, endpoint):
+        with self._inflight_lock:
+            breaker = self._breakers.get(endpoint)
+            if breaker is None:
+                breaker = self._breakers[endpoint] = CircuitBreaker(*self._breaker_args)
+            return breaker
+
+    def _acquire_key(self):
+        """
+        按轮转顺序取一个未冷却且有令牌的密钥（无密钥模式返回 None 也视为成功）
+
+        Returns:
+            (ok, key)
+        """
+        deadline = time.monotonic() + self.max_wait
+        while True:
+            now = time.monotonic()
+            wait = None
+            with self._keys_lock:
+                keys = list(self._keys)
+                for i in range(len(keys)):
+                    key = keys[(self._key_index + i) % len(keys)]
+                    state = self._keys[key]
+                    if state['cooldown_until'] > now:
+                        wait = min(wait, state['cooldown_until'] - now) if wait is not None else state['cooldown_until'] - now
+                        continue
+                    need = state['bucket'].take()
+                    if need == 0:
+                        self._key_index = (self._key_index + i + 1) % len(keys)
+                        return True, key
+                    wait = min(wait, need) if wait is not None else need
+            if wait is None or now + wait > deadline:
+                return False, None
+            time.sleep(wait)
+
+    def _cool_down(self, key, seconds):
+        with self._keys_lock:
+            self._keys[key]['cooldown_until'] = time.monotonic() + seconds
+        logging.warning(f"⚠️ TronGrid 密钥限流，冷却 {seconds:.0f} 秒：{(key or '无密钥')[:6]}")
+
+    def _dedupe(self, key, fn):
+        """参数相同的并发请求只执行一次"""
+        with self._inflight_lock:
+            call = self._inflight.get(key)
+            owner = call is None
+            if owner:
+                call = self._inflight[key] = _InFlight()
+        if not owner:
+            self._count('deduped')
+            call.event.wait(self.timeout * 3)
+            return list(call.result) if call.result is not None else None
+        try:
+            call.result = fn()
+        finally:
+            with self._inflight_lock:
+                self._inflight.pop(key, None)
+            call.event.set()
+        return call.result
+
+    # ---------- TronGrid ----------
+
+    def _trongrid_request(self, url, params):
+        breaker = self._breaker('trongrid')
+        for _ in range(len(self._keys)):
+            if not breaker.allow():
+                self._count('breaker_skips')
+                return None
+            ok, key = self._acquire_key()
+            if not ok:
+                breaker.release_trial()
+                self._count('no_key')
+                return None
+            headers = {self.key_header: key} if key else {}
+            self._count('requests')
+            try:
+                r = self.session.get(url, params=params, headers=headers, timeout=self.timeout)
+            except requests.RequestException as e:
+                self._count('errors')
+                breaker.failure()
+                logging.warning(f"⚠️ TronGrid 请求异常：{e}")
+                return None
+            if r.status_code == 429:
+                # 只冷却当前密钥，换下一个密钥；没有其他可用密钥时本轮放弃
+                self._count('throttled')
+                self._cool_down(key, _retry_after(r, self.cooldown))
+                breaker.release_trial()
+                continue
+            if r.status_code != 200:
+                self._count('errors')
+                if r.status_code >= 500:
+                    breaker.failure()
+                else:
+                    breaker.success()
+                logging.warning(f"⚠️ TronGrid 非 200：{r.status_code}")
+                return None
+            breaker.success()
+            try:
+                return (r.json() or {}).get('data') or []
+            except ValueError:
+                self._count('errors')
+                return None
+        return None
+
+    def trc20_transfers(self, to_address, limit=50, since_ms=None):
+        """TronGrid 转入 to_address 的 USDT 转账（已规范化）；失败返回 None"""
+        url = f"{self.trongrid_base}/v1/accounts/{to_address}/transactions/trc20"
+        params = {"limit": min(int(limit), 200), "contract_address": self.contract}
+        if since_ms:
+            params.update({"only_to": "true", "min_timestamp": int(since_ms), "order_by": "block_timestamp,asc"})
+        items = self._dedupe(('trongrid', url, tuple(sorted(params.items()))),
+                             lambda: self._trongrid_request(url, params))
+        if items is None:
+            return None
+        return normalize_trongrid(items, to_address)
+
+    # ---------- TronScan ----------
+
+    def _tronscan_request(self, base, params):
+        breaker = self._breaker(base)
+        if not breaker.allow():
+            self._count('breaker_skips')
+            return None
+        if self._tronscan_bucket.take() > 0:
+            breaker.release_trial()
+            self._count('no_key')
+            return None
+        self._count('requests')
+        try:
+            r = self.session.get(base, params=params, timeout=self.timeout)
+        except requests.RequestException as e:
+            self._count('errors')
+            breaker.failure()
+            logging.warning(f"⚠️ TronScan 请求异常 url={base}: {e}")
+            return None
+        if r.status_code == 429:
+            self._count('throttled')
+            breaker.open_for(_retry_after(r, self.cooldown))
+            return None
+        if r.status_code != 200:
+            self._count('errors')
+            breaker.failure()
+            logging.warning(f"⚠️ TronScan 非 200: {r.status_code} url={base}")
+            return None
+        breaker.success()
+        try:
+            data = r.json() or {}
+        except ValueError:
+            self._count('errors')
+            return None
+        return data.get("token_transfers") or data.get("data") or []
+
+    def tronscan_transfers(self, to_address, limit=50, since_ms=None):
+        """TronScan 转入 to_address 的 USDT 转账（原始字段）；所有地址都失败返回 None"""
+        params = {
+            "toAddress": to_address,
+            "contract": self.contract,
+            "contract_address": self.contract,
+            "limit": min(int(limit), 200),
+            "sort": "-timestamp",
+        }
+        if since_ms:
+            params["sort"] = "timestamp"
+            params["start_timestamp"] = int(since_ms)
+        for base in self.tronscan_bases:
+            items = self._dedupe(('tronscan', base, tuple(sorted(params.items()))),
+                                 lambda base=base: self._tronscan_request(base, params))
+            if items is not None:
+                return items
+        return None
+
+    # ---------- 对外 ----------
+
+    def token_transfers(self, to_address, limit=50, since_ms=None):
+        """
+        有密钥时先查 TronGrid，请求失败才查 TronScan；都失败返回 []
+
+        TronGrid 成功返回空列表是正常结果（增量轮询大多没有新转账），不再额外请求 TronScan。
+        """
+        self._count('calls')
+        items = None
+        if self.api_keys:
+            items = self.trc20_transfers(to_address, limit, since_ms)
+        if items is None:
+            items = self.tronscan_transfers(to_address, limit, since_ms)
+        return items or []
+
+    def stats(self):
+        now = time.monotonic()
+        with self._stats_lock:
+            stats = dict(self._stats)
+        with self._keys_lock:
+            stats['keys_cooling'] = sum(1 for s in self._keys.values() if s['cooldown_until'] > now)
+        with self._inflight_lock:
+            stats['breakers'] = {endpoint: b.state for endpoint, b in self._breakers.items()}
+        return stats
+
+
+def normalize_trongrid(items, to_address):
+    """TronGrid trc20 转账 -> 与 TronScan 兼容的字段（amount_str 为 4 位小数，quant 为原始整数金额）"""
+    norm = []
+    for it in items:
+        if (it.get("to") or "").lower() != to_address.lower():
+            continue
+        token_info = it.get("token_info") or {}
+        dec = int(token_info.get("decimals") or 6)
+        amount_str = None
+        if it.get("value") is not None:
+            try:
+                amount_str = str((Decimal(str(it["value"])) / Decimal(10 ** dec)).quantize(Decimal("0.0001")))
+            except Exception:
+                amount_str = None
+        norm.append({
+            "to_address": it.get("to"),
+            "from_address": it.get("from"),
+            "amount_str": amount_str,
+            "quant": it.get("value"),
+            "block_ts": it.get("block_timestamp"),
+            "transaction_id": it.get("transaction_id"),
+            "tokenInfo": {"tokenDecimal": dec},
+        })
+    return norm
@@ -0,0 +1,293 @@
+"""
+TronGrid / TronScan 本地桩服务与离线压测
+
+StubTronServer 在本机端口上模拟两个接口，返回预先生成的 USDT 转账：
+- GET /v1/accounts/{address}/transactions/trc20   （TronGrid，支持 min_timestamp / order_by / limit）
+- GET /api/token_trc20/transfers                   （TronScan，支持 toAddress / start_timestamp / sort / limit）
+可以模拟延迟、每个密钥的限流（超过后返回 429 + Retry-After）和随机 500，并统计每类响应次数。
+
+也可以在其他脚本里当作夹具使用：
+    with StubTronServer(addresses=['Txxx'], key_rate=5) as stub:
+        client = TronClient(contract, trongrid_base=stub.url, tronscan_bases=(stub.tronscan_url,), api_keys=[...])
+
+用法：
+    python tron_stub.py serve [--port 18090]              只启动桩服务
+    python tron_stub.py bench [--pollers 100] [--rounds 5] 启动桩服务并用 TronClient 并发轮询
+    python tron_stub.py check                             熔断器半开路径自检
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from tron_client import TronClient
+
+STUB_CONTRACT = 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t'
+
+
+def make_transfers(addresses, per_address=200, start_ms=None):
+    """每个地址生成 per_address 笔转账，时间每笔递增 3 秒"""
+    start_ms = start_ms or int(time.time() * 1000) - per_address * 3000
+    transfers = {}
+    for address in addresses:
+        rows = []
+        for i in range(per_address):
+            rows.append({
+                'transaction_id': f'{address[-6:]}{i:058x}',
+                'block_timestamp': start_ms + i * 3000,
+                'from': f'TStubFrom{i % 50:025d}',
+                'to': address,
+                'value': str(random.randint(10, 500) * 1_000_000 + random.randint(0, 9999) * 100),
+                'token_info': {'decimals': 6, 'symbol': 'USDT', 'address': STUB_CONTRACT},
+            })
+        transfers[address] = rows
+    return transfers
+
+
+class StubTronServer:
+    """
+    Args:
+        addresses: 有转账数据的收款地址
+        latency: 每个请求的处理延迟（秒）
+        key_rate: 每个密钥（无密钥按来源 IP）每秒允许的请求数，0 为不限
+        error_rate: 随机返回 500 的比例
+    """
+
+    def __init__(self, addresses=('TStubReceiveAddress000000000000000',), per_address=200, port=0,
+                 latency=0.05, key_rate=0, error_rate=0.0, key_header='TRON-PRO-API-KEY'):
+        self.transfers = make_transfers(addresses, per_address)
+        self.latency = latency
+        self.key_rate = key_rate
+        self.error_rate = error_rate
+        self.key_header = key_header
+        self.hits = Counter()
+        self._windows = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), self._handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    @property
+    def tronscan_url(self):
+        return f"{self.url}/api/token_trc20/transfers"
+
+    def _throttled(self, client_key):
+        """按秒计数的固定窗口限流"""
+        if not self.key_rate:
+            return False
+        window = int(time.time())
+        with self._lock:
+            start, count = self._windows.get(client_key, (window, 0))
+            if start != window:
+                start, count = window, 0
+            self._windows[client_key] = (start, count + 1)
+            return count + 1 > self.key_rate
+
+    def _query(self, address, since_ms, ascending, limit):
+        rows = [r for r in self.transfers.get(address, []) if not since_ms or r['block_timestamp'] >= since_ms]
+        rows.sort(key=lambda r: r['block_timestamp'], reverse=not ascending)
+        return rows[:limit]
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for k, v in (headers or {}).items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                parsed = urlparse(self.path)
+                qs = {k: v[-1] for k, v in parse_qs(parsed.query).items()}
+                kind = 'trongrid' if parsed.path.startswith('/v1/accounts/') else 'tronscan'
+                with stub._lock:
+                    stub.hits[kind] += 1
+                if stub.latency:
+                    time.sleep(stub.latency)
+                client_key = self.headers.get(stub.key_header) or self.client_address[0]
+                if stub._throttled((kind, client_key)):
+                    with stub._lock:
+                        stub.hits['429'] += 1
+                    return self._reply(429, {'Error': 'rate limited'}, {'Retry-After': '1'})
+                if stub.error_rate and random.random() < stub.error_rate:
+                    with stub._lock:
+                        stub.hits['500'] += 1
+                    return self._reply(500, {'Error': 'stub error'})
+                limit = min(int(qs.get('limit', 50)), 200)
+                if kind == 'trongrid':
+                    address = parsed.path.split('/')[3]
+                    rows = stub._query(address, int(qs.get('min_timestamp', 0)),
+                                       qs.get('order_by', '').endswith(',asc'), limit)
+                    return self._reply(200, {'data': rows, 'success': True})
+                if parsed.path == '/api/token_trc20/transfers':
+                    address = qs.get('toAddress', '')
+                    rows = stub._query(address, int(qs.get('start_timestamp', 0)), qs.get('sort') == 'timestamp', limit)
+                    return self._reply(200, {'token_transfers': [{
+                        'transaction_id': r['transaction_id'],
+                        'block_ts': r['block_timestamp'],
+                        'from_address': r['from'],
+                        'to_address': r['to'],
+                        'quant': r['value'],
+                        'tokenInfo': {'tokenDecimal': 6},
+                    } for r in rows]})
+                return self._reply(404, {'Error': 'not found'})
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='tron-stub', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+
+def bench(args):
+    addresses = [f'TStubReceiveAddress{i:015d}' for i in range(args.addresses)]
+    keys = [f'stub-key-{i}' for i in range(args.keys)]
+    with StubTronServer(addresses, per_address=args.transfers, latency=args.latency,
+                        key_rate=args.key_rate, error_rate=args.error_rate) as stub:
+        client = TronClient(STUB_CONTRACT, trongrid_base=stub.url, tronscan_bases=(stub.tronscan_url,),
+                            api_keys=keys, key_rate=args.key_rate or 100, tronscan_rate=args.key_rate or 100,
+                            cooldown=1.0, reset_timeout=2.0, pool_size=args.pollers)
+        results = Counter()
+        lock = threading.Lock()
+        start_event = threading.Event()
+
+        def poller(i):
+            address = addresses[i % len(addresses)]
+            start_event.wait()
+            for _ in range(args.rounds):
+                items = client.token_transfers(address, limit=200)
+                with lock:
+                    results['ok' if len(items) == min(args.transfers, 200) else 'empty_or_short'] += 1
+                time.sleep(args.interval)
+
+        threads = [threading.Thread(target=poller, args=(i,)) for i in range(args.pollers)]
+        for t in threads:
+            t.start()
+        began = time.time()
+        start_event.set()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - began
+
+    stats = client.stats()
+    calls = args.pollers * args.rounds
+    upstream = stub.hits['trongrid'] + stub.hits['tronscan']
+    print(f"轮询线程: {args.pollers}  每线程轮数: {args.rounds}  地址: {args.addresses}  密钥: {args.keys}")
+    print(f"耗时: {elapsed:.2f}s  调用: {calls}  成功: {results['ok']}  无结果/不完整: {results['empty_or_short']}")
+    print(f"上游请求: {upstream}（TronGrid {stub.hits['trongrid']} / TronScan {stub.hits['tronscan']}）"
+          f"  429: {stub.hits['429']}  500: {stub.hits['500']}")
+    print(f"合并请求: {stats['deduped']}  熔断跳过: {stats['breaker_skips']}  无可用令牌: {stats['no_key']}"
+          f"  冷却中密钥: {stats['keys_cooling']}  熔断器: {stats['breakers']}")
+    print(f"每次调用平均上游请求: {upstream / max(calls, 1):.2f}")
+    return 0
+
+
+def check(args):
+    """
+    熔断器半开自检：熔断到期后放行的试探请求因本地原因没有发出（TronScan 无令牌、TronGrid 无可用密钥），
+    令牌 / 密钥恢复后下一次请求必须能正常发出，而不是一直被熔断器拒绝
+    """
+    address = 'TStubReceiveAddress000000000000000'
+    failed = []
+    with StubTronServer([address], per_address=20, latency=0) as stub:
+        # TronScan：半开试探时令牌桶为空
+        client = TronClient(STUB_CONTRACT, trongrid_base=stub.url, tronscan_bases=(stub.tronscan_url,),
+                            tronscan_rate=0.1, failure_threshold=1, reset_timeout=0.2)
+        breaker = client._breaker(stub.tronscan_url)
+        breaker.failure()
+        time.sleep(0.3)
+        client._tronscan_bucket.tokens = 0
+        first = client.tronscan_transfers(address)
+        client._tronscan_bucket.tokens = client._tronscan_bucket.capacity
+        second = client.tronscan_transfers(address)
+        if first is not None or not second:
+            failed.append(f'TronScan 无令牌后未恢复：first={first is not None} second={len(second or [])}')
+
+        # TronGrid：半开试探时唯一的密钥没有令牌
+        client = TronClient(STUB_CONTRACT, trongrid_base=stub.url, tronscan_bases=(stub.tronscan_url,),
+                            api_keys=['stub-key'], key_rate=0.1, max_wait=0,
+                            failure_threshold=1, reset_timeout=0.2)
+        breaker = client._breaker('trongrid')
+        breaker.failure()
+        time.sleep(0.3)
+        bucket = client._keys['stub-key']['bucket']
+        bucket.tokens = 0
+        first = client.trc20_transfers(address)
+        bucket.tokens = bucket.capacity
+        second = client.trc20_transfers(address)
+        if first is not None or not second:
+            failed.append(f'TronGrid 无可用密钥后未恢复：first={first is not None} second={len(second or [])}')
+
+    for line in failed:
+        print(f"❌ {line}")
+    if not failed:
+        print("✅ 熔断器半开路径正常")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TronGrid / TronScan 本地桩服务与离线压测')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+
+    serve_p = sub.add_parser('serve', help='只启动桩服务')
+    serve_p.add_argument('--port', type=int, default=18090)
+    serve_p.add_argument('--address', action='append', help='收款地址（可重复）')
+    serve_p.add_argument('--transfers', type=int, default=200, help='每个地址的转账数')
+    serve_p.add_argument('--latency', type=float, default=0.05)
+    serve_p.add_argument('--key-rate', type=int, default=0, help='每个密钥每秒请求上限，0 为不限')
+    serve_p.add_argument('--error-rate', type=float, default=0.0)
+
+    bench_p = sub.add_parser('bench', help='并发轮询压测')
+    bench_p.add_argument('--pollers', type=int, default=100, help='并发轮询线程数（模拟代理数）')
+    bench_p.add_argument('--rounds', type=int, default=5, help='每个线程的轮询次数')
+    bench_p.add_argument('--interval', type=float, default=0.2, help='每轮间隔（秒）')
+    bench_p.add_argument('--addresses', type=int, default=1, help='收款地址数')
+    bench_p.add_argument('--transfers', type=int, default=200, help='每个地址的转账数')
+    bench_p.add_argument('--keys', type=int, default=3, help='模拟的 API 密钥数')
+    bench_p.add_argument('--key-rate', type=int, default=10, help='每个密钥每秒请求上限')
+    bench_p.add_argument('--latency', type=float, default=0.05)
+    bench_p.add_argument('--error-rate', type=float, default=0.0)
+
+    sub.add_parser('check', help='熔断器半开路径自检')
+
+    args = parser.parse_args()
+    if args.cmd == 'check':
+        raise SystemExit(check(args))
+    if args.cmd == 'serve':
+        stub = StubTronServer(args.address or ['TStubReceiveAddress000000000000000'], per_address=args.transfers,
+                              port=args.port, latency=args.latency, key_rate=args.key_rate, error_rate=args.error_rate)
+        print(f"✅ 桩服务已启动: TronGrid {stub.url}  TronScan {stub.tronscan_url}")
+        try:
+            stub._server.serve_forever()
+        except KeyboardInterrupt:
+            stub._server.server_close()
+        raise SystemExit(0)
+    raise SystemExit(bench(args))